@@ -1,15 +1,167 @@
 import json
+import math
 import multiprocessing as mp
 import os
-from typing import Optional
+import queue
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
 
 import numpy as np
-import sounddevice as sd
-from moviepy.editor import AudioFileClip, VideoFileClip
-from scipy.io.wavfile import write
 from pathlib import Path
 import time
 
+from merge_scheduler import MergeScheduler, run_merge_job
+from wav_writer import StreamingWavWriter
+
+CAPTURE_MODES = ("blocking", "callback")
+
+
+def default_input_stream(*args, **kwargs):
+    # Imported lazily: without PortAudio, importing sounddevice raises, and the
+    # recorder can still run on an injected `input_stream_factory`
+    import sounddevice as sd
+
+    return sd.InputStream(*args, **kwargs)
+
+
+class AudioRingBuffer:
+    """Single-producer single-consumer ring of fixed-size audio chunks. The PortAudio
+    callback pushes and the writer pops; each side only advances its own counter, so
+    no lock is needed between them."""
+
+    def __init__(self, slot_num: int, chunk_size: int, channels: int):
+        self.slot_num = slot_num
+        self.chunk_size = chunk_size
+        self.data = np.zeros((slot_num, chunk_size, channels), dtype=np.float32)
+        self.frame_nums = np.zeros(slot_num, dtype=np.int64)
+        self.adc_times = np.zeros(slot_num, dtype=np.float64)
+        self.write_count = 0
+        """Only advanced by the producer, after the slot is filled."""
+        self.read_count = 0
+        """Only advanced by the consumer, after the slot is consumed."""
+
+    def __len__(self):
+        return self.write_count - self.read_count
+
+    def push(self, indata: np.ndarray, adc_time: float) -> bool:
+        """Returns False (and drops the chunk) if the ring is full."""
+        if self.write_count - self.read_count >= self.slot_num:
+            return False
+        idx = self.write_count % self.slot_num
+        frame_num = min(len(indata), self.chunk_size)
+        self.data[idx, :frame_num] = indata[:frame_num]
+        self.frame_nums[idx] = frame_num
+        self.adc_times[idx] = adc_time
+        self.write_count += 1
+        return True
+
+    def peek(self) -> Optional[Tuple[np.ndarray, float]]:
+        """Returns a view of the oldest chunk and its ADC time. Call `release` when
+        done with it."""
+        if self.read_count == self.write_count:
+            return None
+        idx = self.read_count % self.slot_num
+        return self.data[idx, : self.frame_nums[idx]], float(self.adc_times[idx])
+
+    def release(self):
+        self.read_count += 1
+
+
+class AudioSegmentWriter:
+    """Writes the captured stream to `<file_name>.wav` with its metadata, and switches
+    to the next segment's file at a boundary on the `time.monotonic()` clock. The
+    chunk straddling the boundary is split at the boundary sample, so consecutive
+    segments neither lose nor repeat a sample."""
+
+    def __init__(
+        self,
+        audio_dir: str,
+        meta_data_dir: str,
+        sample_rate: int,
+        channels: int,
+        capture_mode: str,
+        counters: Optional[Dict[str, int]] = None,
+    ):
+        self.audio_dir = audio_dir
+        self.meta_data_dir = meta_data_dir
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.capture_mode = capture_mode
+        self.precise_timing = capture_mode == "callback"
+        """Chunk times come from the ADC clock rather than being estimated."""
+        self.counters = counters if counters is not None else {}
+        """Capture counters, shared with the capture callback. Every segment's
+        metadata holds the totals so far."""
+        self.file_name = ""
+        self.wav_writer: Optional[StreamingWavWriter] = None
+        self.start_time = 0.0
+        self.written_frame_num = 0
+        self.chunk_timestamps: List[Tuple[int, float]] = []
+        """Per-chunk (first sample index, `time.monotonic()` time of that sample)."""
+        self.rollover: Optional[Tuple[str, float]] = None
+
+    def open(self, file_name: str, start_time: float):
+        self.file_name = file_name
+        self.start_time = start_time
+        self.written_frame_num = 0
+        self.chunk_timestamps = []
+        self.wav_writer = StreamingWavWriter(
+            f"{self.audio_dir}/{file_name}.wav",
+            self.sample_rate,
+            self.channels,
+            dtype=np.float32,
+        )
+
+    def request_rollover(self, file_name: str, boundary: float):
+        self.rollover = (file_name, boundary)
+
+    def write(self, data: np.ndarray, monotonic_time: float):
+        """Writes a chunk whose first sample was captured at `monotonic_time`."""
+        if self.rollover is not None:
+            file_name, boundary = self.rollover
+            split_idx = max(0, math.ceil((boundary - monotonic_time) * self.sample_rate))
+            if split_idx < len(data):
+                self.rollover = None
+                if split_idx > 0:
+                    self.write_chunk(data[:split_idx], monotonic_time)
+                split_time = monotonic_time + split_idx / self.sample_rate
+                stop_time = time.time() - (time.monotonic() - split_time)
+                self.close(stop_time)
+                self.open(file_name, stop_time)
+                data = data[split_idx:]
+                monotonic_time = split_time
+        self.write_chunk(data, monotonic_time)
+
+    def write_chunk(self, data: np.ndarray, monotonic_time: float):
+        self.chunk_timestamps.append((self.written_frame_num, monotonic_time))
+        self.wav_writer.write(data)
+        self.written_frame_num += len(data)
+
+    def close(self, stop_time: float):
+        self.wav_writer.close()
+        meta_data = {
+            "start_time": self.start_time,
+            "stop_time": stop_time,
+            "capture_mode": self.capture_mode,
+            "sample_rate": self.sample_rate,
+            "recorded_frame_num": self.written_frame_num,
+            **self.counters,
+        }
+        if self.precise_timing:
+            if self.chunk_timestamps:
+                first_sample_time = self.chunk_timestamps[0][1]
+                meta_data["first_sample_monotonic_time"] = first_sample_time
+                meta_data["first_sample_time"] = time.time() - (
+                    time.monotonic() - first_sample_time
+                )
+            np.save(
+                f"{self.meta_data_dir}/{self.file_name}_audio_timestamps.npy",
+                np.array(self.chunk_timestamps, dtype=np.float64).reshape(-1, 2),
+            )
+        with open(f"{self.meta_data_dir}/{self.file_name}_audio.json", "w") as f:
+            json.dump(meta_data, f)
+        print(f"Audio saved to {self.audio_dir}/{self.file_name}.wav")
+
 
 class AudioRecorder:
     def __init__(
@@ -19,19 +171,38 @@ class AudioRecorder:
         channels: int = 2,  # use `sd.query_devices(device_id)["max_input_channels"])` to get the number of channels
         chunk_size: int = 1024,
         data_dir: str = str(Path(__file__).parent.parent) + "/recordings",
+        capture_mode: str = "blocking",
+        ring_buffer_slots: int = 256,
+        input_stream_factory: Optional[Callable] = None,
+        merge_workers: int = 1,
     ):
+        assert (
+            capture_mode in CAPTURE_MODES
+        ), f"capture_mode should be one of {CAPTURE_MODES}"
         self.device_id = device_id
         self.sample_rate = sample_rate
         self.file_name = ""
         self.channels = channels
         self.chunk_size = chunk_size
+        self.capture_mode = capture_mode
+        self.ring_buffer_slots = ring_buffer_slots
+        self.input_stream_factory = (
+            input_stream_factory
+            if input_stream_factory is not None
+            else default_input_stream
+        )
+        """Builds the input stream, takes the same arguments as `sd.InputStream`."""
         self.data_dir = data_dir
         self.audio_dir = data_dir + "/audios"
         self.process: Optional[mp.Process] = None
         self.stop_event = mp.Event()
+        self.rollover_queue: "mp.Queue[Tuple[str, float]]" = mp.Queue()
         os.makedirs(self.audio_dir, exist_ok=True)
         self.meta_data_dir = data_dir + "/meta_data"
         os.makedirs(self.meta_data_dir, exist_ok=True)
+        self.merge_scheduler = MergeScheduler(
+            f"{self.meta_data_dir}/merge_jobs.json", max_workers=merge_workers
+        )
 
     def start_recording(self, file_name: str):
         self.stop_event.clear()
@@ -52,6 +223,22 @@ class AudioRecorder:
         self.process = mp.Process(target=self.record)
         self.process.start()
 
+    def rollover(self, file_name: str, boundary: float):
+        """Continues recording into `file_name` from the first sample captured at or
+        after `boundary` (`time.monotonic()`)."""
+        if self.process is None or not self.process.is_alive():
+            print("AudioRecorder is not recording")
+            return
+        self.rollover_queue.put((file_name, boundary))
+        self.file_name = file_name
+
+    def poll_rollover(self, segment_writer: AudioSegmentWriter):
+        while True:
+            try:
+                segment_writer.request_rollover(*self.rollover_queue.get_nowait())
+            except queue.Empty:
+                return
+
     def stop_recording(self):
         if self.process is not None and self.process.is_alive():
             self.stop_event.set()
@@ -61,80 +248,137 @@ class AudioRecorder:
             print("AudioRecorder is not recording")
 
     def record(self):
+        if self.capture_mode == "callback":
+            self.record_with_callback()
+        else:
+            self.record_blocking()
+
+    def record_blocking(self):
         print("AudioRecorder started")
-        audio_data = np.array([])
-        with sd.InputStream(
+        segment_writer = AudioSegmentWriter(
+            self.audio_dir,
+            self.meta_data_dir,
+            self.sample_rate,
+            self.channels,
+            "blocking",
+        )
+        with self.input_stream_factory(
             samplerate=self.sample_rate,
             channels=self.channels,
             dtype="float32",
             device=self.device_id,
         ) as stream:
-            audio_start_time = time.time()
+            segment_writer.open(self.file_name, time.time())
             while not self.stop_event.is_set():
                 data, overflowed = stream.read(self.chunk_size)
                 if overflowed:
                     print("Warning: Audio buffer overflowed")
-                audio_data = np.concatenate((audio_data, data.ravel()))
+                self.poll_rollover(segment_writer)
+                # Only an estimate, the read returns once the last sample is in
+                segment_writer.write(
+                    data, time.monotonic() - len(data) / self.sample_rate
+                )
             audio_stop_time = time.time()
-        write(
-            f"{self.audio_dir}/{self.file_name}.wav",
+        segment_writer.close(audio_stop_time)
+
+    def record_with_callback(self):
+        """Lets PortAudio push chunks from its callback into an `AudioRingBuffer`, and
+        drains the ring to disk in this thread. The callback never allocates or blocks,
+        so disk stalls only show up as ring overflows instead of device overflows."""
+        print("AudioRecorder started (callback mode)")
+        ring = AudioRingBuffer(self.ring_buffer_slots, self.chunk_size, self.channels)
+        data_ready = threading.Event()
+        counters = {
+            "input_overflow_num": 0,
+            "input_underflow_num": 0,
+            "ring_overflow_num": 0,
+        }
+
+        def callback(indata, frames, time_info, status):
+            if status.input_overflow:
+                counters["input_overflow_num"] += 1
+            if status.input_underflow:
+                counters["input_underflow_num"] += 1
+            if not ring.push(indata, time_info.inputBufferAdcTime):
+                counters["ring_overflow_num"] += 1
+            data_ready.set()
+
+        segment_writer = AudioSegmentWriter(
+            self.audio_dir,
+            self.meta_data_dir,
             self.sample_rate,
-            audio_data.reshape(-1, self.channels),
+            self.channels,
+            "callback",
+            counters,
         )
-        with open(f"{self.meta_data_dir}/{self.file_name}_audio.json", "w") as f:
-            json.dump({"start_time": audio_start_time, "stop_time": audio_stop_time}, f)
-        print(f"Audio saved to {self.audio_dir}/{self.file_name}.wav")
 
-    def start_merging_to_video(self, raw_video_dir: str, video_dir: str):
-        merge_process = mp.Process(
-            target=self.merge_to_video,
-            args=(
-                raw_video_dir,
-                video_dir,
-            ),
+        def drain(stream_time_offset: float):
+            while True:
+                chunk = ring.peek()
+                if chunk is None:
+                    return
+                data, adc_time = chunk
+                segment_writer.write(data, adc_time + stream_time_offset)
+                ring.release()
+
+        stream = self.input_stream_factory(
+            samplerate=self.sample_rate,
+            channels=self.channels,
+            dtype="float32",
+            device=self.device_id,
+            blocksize=self.chunk_size,
+            callback=callback,
+        )
+        with stream:
+            segment_writer.open(self.file_name, time.time())
+            # PortAudio reports ADC times in its own stream clock
+            stream_time_offset = time.monotonic() - stream.time
+            while not self.stop_event.is_set():
+                data_ready.wait(timeout=0.1)
+                data_ready.clear()
+                self.poll_rollover(segment_writer)
+                drain(stream_time_offset)
+            audio_stop_time = time.time()
+        drain(stream_time_offset)
+        segment_writer.close(audio_stop_time)
+        if any(counters.values()):
+            print(f"Warning: audio capture reported {counters}")
+
+    def merge_job_paths(
+        self,
+        raw_video_dir: str,
+        video_dir: str,
+        file_name: str = "",
+        video_file_name: str = "",
+    ):
+        """`video_file_name` names a video recorded alongside the audio `file_name`,
+        e.g. by a second camera; it defaults to `file_name`."""
+        if file_name == "":
+            file_name = self.file_name
+        if video_file_name == "":
+            video_file_name = file_name
+        return dict(
+            file_name=video_file_name,
+            raw_video_path=f"{raw_video_dir}/{video_file_name}.mp4",
+            audio_path=f"{self.audio_dir}/{file_name}.wav",
+            video_meta_path=f"{self.meta_data_dir}/{video_file_name}_video.json",
+            audio_meta_path=f"{self.meta_data_dir}/{file_name}_audio.json",
+            output_path=f"{video_dir}/{video_file_name}.mp4",
+        )
+
+    def start_merging_to_video(
+        self,
+        raw_video_dir: str,
+        video_dir: str,
+        file_name: str = "",
+        video_file_name: str = "",
+    ):
+        self.merge_scheduler.submit(
+            **self.merge_job_paths(raw_video_dir, video_dir, file_name, video_file_name)
         )
-        merge_process.start()
-
-    def merge_to_video(self, raw_video_dir: str, video_dir: str):
-        start_time = time.monotonic()
-        timeout = 1.0
-        while not os.path.exists(f"{raw_video_dir}/{self.file_name}.mp4"):
-            if time.monotonic() - start_time > timeout:
-                print(f"{raw_video_dir}/{self.file_name}.mp4 does not exist.")
-                return
-            else:
-                time.sleep(0.1)
-
-        # with open(f"{self.meta_data_dir}/{self.file_name}_video.json", "r") as f:
-        #     video_meta_data = json.load(f)
-        # with open(f"{self.meta_data_dir}/{self.file_name}_audio.json", "r") as f:
-        #     audio_meta_data = json.load(f)
-
-        # # Audio recording starts earlier than video
-        # start_time_diff = video_meta_data["start_time"] - audio_meta_data["start_time"]
-
-        # final_start_time = max(
-        #     video_meta_data["start_time"], audio_meta_data["start_time"]
-        # )
-        # final_stop_time = min(
-        #     video_meta_data["stop_time"], audio_meta_data["stop_time"]
-        # )
-        # Crop video clip and audio clip according to the start and stop time
-        video_clip = VideoFileClip(f"{raw_video_dir}/{self.file_name}.mp4")
-        # video_clip: VideoFileClip = video_clip.subclip(
-        #     final_start_time - video_meta_data["start_time"],
-        #     final_stop_time - video_meta_data["start_time"],
-        # )
-        audio_clip = AudioFileClip(f"{self.audio_dir}/{self.file_name}.wav")
-        # audio_clip = audio_clip.subclip(
-        #     final_start_time - audio_meta_data["start_time"],
-        #     final_stop_time - audio_meta_data["start_time"],
-        # )
-
-        final_clip: VideoFileClip = video_clip.set_audio(audio_clip)
-        final_clip.write_videofile(f"{video_dir}/{self.file_name}.mp4")
-        print(f"Audio merged to {video_dir}/{self.file_name}.mp4")
 
+    def merge_to_video(self, raw_video_dir: str, video_dir: str, file_name: str = ""):
+        run_merge_job(self.merge_job_paths(raw_video_dir, video_dir, file_name))
 
 if __name__ == "__main__":
     audio_recorder = AudioRecorder()
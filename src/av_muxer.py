@@ -0,0 +1,145 @@
+from fractions import Fraction
+from typing import Any, Dict, Iterator
+
+import av
+import numpy as np
+from scipy.io import wavfile
+
+AUDIO_LAYOUTS = {1: "mono", 2: "stereo"}
+
+
+def compute_audio_offset(
+    video_meta_data: Dict[str, Any], audio_meta_data: Dict[str, Any]
+) -> float:
+    """Seconds between the first audio sample and the first video frame. Positive
+    means the audio started earlier and its head has to be skipped. Uses the
+    monotonic capture times when both files have them, the wall clock otherwise
+    (older recordings, or a video without any encoded frame)."""
+    video_start = video_meta_data.get("start_monotonic_time")
+    audio_start = audio_meta_data.get("first_sample_monotonic_time")
+    if video_start is not None and audio_start is not None:
+        return video_start - audio_start
+    audio_start_time = audio_meta_data.get("first_sample_time")
+    if audio_start_time is None:
+        audio_start_time = audio_meta_data["start_time"]
+    return video_meta_data["start_time"] - audio_start_time
+
+
+def encode_audio(
+    audio_stream: av.audio.stream.AudioStream,
+    samples: np.ndarray,
+    sample_rate: int,
+    audio_offset: float,
+    max_duration: float,
+    start_time: float = 0.0,
+    chunk_size: int = 1024,
+) -> Iterator[av.Packet]:
+    """Lazily encodes `samples` (frames, channels) into packets of `audio_stream`,
+    aligned so that the first video frame, presented at `start_time`, lines up
+    with audio time `audio_offset`."""
+    channels = samples.shape[1]
+    offset_frames = int(round(audio_offset * sample_rate))
+    if offset_frames > 0:
+        samples = samples[offset_frames:]
+        silence_frames = 0
+    else:
+        silence_frames = -offset_frames
+    total_frames = int(
+        min(silence_frames + len(samples), max_duration * sample_rate)
+    )
+    is_planar = audio_stream.format.is_planar
+    start_pts = int(round(start_time * sample_rate))
+    pts = 0
+    while pts < total_frames:
+        frame_num = min(chunk_size, total_frames - pts)
+        chunk = np.zeros((frame_num, channels), dtype=np.float32)
+        src_start = pts - silence_frames
+        src_stop = src_start + frame_num
+        if src_stop > 0:
+            dst_start = max(0, -src_start)
+            chunk[dst_start:] = samples[max(0, src_start) : src_stop]
+        if audio_stream.format.name.startswith("s16"):
+            chunk = (np.clip(chunk, -1, 1) * 32767).astype(np.int16)
+        array = np.ascontiguousarray(chunk.T) if is_planar else chunk.reshape(1, -1)
+        frame = av.AudioFrame.from_ndarray(
+            array, format=audio_stream.format.name, layout=AUDIO_LAYOUTS[channels]
+        )
+        frame.sample_rate = sample_rate
+        frame.pts = start_pts + pts
+        frame.time_base = Fraction(1, sample_rate)
+        yield from audio_stream.encode(frame)
+        pts += frame_num
+    yield from audio_stream.encode()
+
+
+def mux_audio_video(
+    video_path: str,
+    audio_path: str,
+    output_path: str,
+    audio_offset: float = 0.0,
+    audio_codec: str = "aac",
+    audio_bitrate: int = 192000,
+):
+    """Muxes a WAV file into a video without re-encoding the video: the H.264
+    packets are stream-copied and only the audio is encoded (or stored as PCM with
+    `audio_codec="pcm_s16le"` for containers that allow it). Merge time scales with
+    file size instead of decode cost."""
+    sample_rate, samples = wavfile.read(audio_path, mmap=True)
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    if samples.dtype.kind in "iu":
+        samples = samples.astype(np.float32) / np.iinfo(samples.dtype).max
+    assert (
+        samples.shape[1] in AUDIO_LAYOUTS
+    ), f"Only {list(AUDIO_LAYOUTS.keys())} audio channels are supported"
+
+    with av.open(video_path) as video_input, av.open(output_path, mode="w") as output:
+        in_video = video_input.streams.video[0]
+        if hasattr(output, "add_stream_from_template"):
+            out_video = output.add_stream_from_template(in_video)
+        else:
+            out_video = output.add_stream(template=in_video)
+        out_audio = output.add_stream(audio_codec, rate=sample_rate)
+        out_audio.layout = AUDIO_LAYOUTS[samples.shape[1]]
+        if audio_codec != "pcm_s16le":
+            out_audio.bit_rate = audio_bitrate
+
+        # Without an edit list (e.g. fragmented MP4) the first frame is presented
+        # after the B-frame delay, not at 0
+        if in_video.start_time is not None:
+            video_start = float(in_video.start_time * in_video.time_base)
+        else:
+            video_start = 0.0
+        if in_video.duration is not None:
+            video_duration = float(in_video.duration * in_video.time_base)
+        elif video_input.duration is not None:
+            video_duration = video_input.duration / av.time_base
+        else:
+            video_duration = float("inf")
+        audio_packets = encode_audio(
+            out_audio,
+            samples,
+            sample_rate,
+            audio_offset,
+            video_duration,
+            start_time=video_start,
+        )
+        pending_audio = next(audio_packets, None)
+
+        # Interleave by timestamp so the muxer never has to buffer a whole stream
+        for packet in video_input.demux(in_video):
+            if packet.dts is None:
+                continue
+            packet_time = float(packet.dts * packet.time_base)
+            while (
+                pending_audio is not None
+                and pending_audio.pts is not None
+                and float(pending_audio.pts * pending_audio.time_base) <= packet_time
+            ):
+                output.mux(pending_audio)
+                pending_audio = next(audio_packets, None)
+            packet.stream = out_video
+            output.mux(packet)
+        while pending_audio is not None:
+            output.mux(pending_audio)
+            pending_audio = next(audio_packets, None)
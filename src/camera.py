@@ -0,0 +1,109 @@
+from typing import Any, Dict, Optional, Tuple, Union
+
+from frame_bus import SharedFrameCapture
+from frame_capture import CapturedFrame, FrameCapture
+from live_stream import LiveStreamHub
+from preview_hub import PreviewHub
+from video_encoder import EncoderProcess, VideoEncoderWorker
+
+
+class Camera:
+    """One capture device with its own capture thread, preview encoders (MJPEG and
+    H.264) and recording encoder. Frames of every camera are stamped with `time.monotonic()` at capture,
+    so recordings of several cameras share one clock.
+
+    With `shared_memory`, capture and recording encoder each run in a process of
+    their own and exchange frames through a `FrameBus` instead; only the preview
+    encoder stays in this process."""
+
+    def __init__(
+        self,
+        camera_idx: int,
+        device: Union[int, str] = 0,
+        resolution: Tuple[int, int] = (1440, 720),
+        preview_resolution: Optional[Tuple[int, int]] = None,
+        preview_quality: int = 80,
+        adaptive_preview: bool = True,
+        live_preview_bitrate: int = 1000000,
+        shared_memory: bool = False,
+        **encoder_kwargs: Any,
+    ):
+        """`encoder_kwargs` go to `VideoEncoderWorker`."""
+        self.camera_idx = camera_idx
+        self.device = device
+        self.shared_memory = shared_memory
+        self.capture: Union[FrameCapture, SharedFrameCapture]
+        self.encoder_worker: Union[VideoEncoderWorker, EncoderProcess]
+        if shared_memory:
+            self.capture = SharedFrameCapture(device=device, resolution=resolution)
+            self.encoder_worker = EncoderProcess(self.capture.bus, **encoder_kwargs)
+        else:
+            self.capture = FrameCapture(device=device, resolution=resolution)
+            self.capture.consumers.append(self.record_frame)
+            self.encoder_worker = VideoEncoderWorker(**encoder_kwargs)
+        self.preview_hub = PreviewHub(
+            self.capture,
+            resolution=preview_resolution,
+            quality=preview_quality,
+            adaptive=adaptive_preview,
+        )
+        self.live_stream_hub = LiveStreamHub(
+            self.capture, resolution=preview_resolution, bitrate=live_preview_bitrate
+        )
+        self.is_recording = False
+        self.record_start_monotonic = 0.0
+        """Frames captured before this time are not recorded, see `start_recording`."""
+        self.recorded_frame_num = 0
+
+    def start(self):
+        self.capture.start()
+        if isinstance(self.encoder_worker, EncoderProcess):
+            # Forked after the frame bus exists, so it shares its memory
+            self.encoder_worker.launch()
+        self.preview_hub.start()
+        self.live_stream_hub.start()
+
+    def release(self):
+        self.live_stream_hub.stop()
+        self.preview_hub.stop()
+        if isinstance(self.encoder_worker, EncoderProcess):
+            self.encoder_worker.shutdown()
+        self.capture.release()
+
+    def record_frame(self, captured: CapturedFrame):
+        """Called from the capture thread for every frame, whether or not anyone is
+        watching the preview."""
+        if not self.is_recording or captured.timestamp < self.record_start_monotonic:
+            return
+        if self.encoder_worker.submit(captured.frame, captured.timestamp):
+            self.recorded_frame_num += 1
+
+    def start_recording(self, file_path: str, start_monotonic: float):
+        """Opens `file_path` and records from the first frame captured at or after
+        `start_monotonic`. Giving every camera the same start time lines their first
+        frames up to within one frame interval."""
+        if isinstance(self.encoder_worker, EncoderProcess):
+            # Replaces the encoder process if it died during a previous recording
+            self.encoder_worker.launch()
+            self.encoder_worker.start(
+                file_path,
+                self.capture.width,
+                self.capture.height,
+                self.capture.frame_rate,
+                start_monotonic,
+            )
+        else:
+            self.encoder_worker.start(
+                file_path,
+                self.capture.width,
+                self.capture.height,
+                self.capture.frame_rate,
+            )
+        self.recorded_frame_num = 0
+        self.record_start_monotonic = start_monotonic
+        self.is_recording = True
+
+    def stop_recording(self) -> Dict[str, Any]:
+        """Blocks until the encoder has finished the file, returns its stats."""
+        self.is_recording = False
+        return self.encoder_worker.stop()
@@ -0,0 +1,44 @@
+import time
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+
+class ClockSync:
+    """Estimates the offset between a client's clock and `time.monotonic()` from
+    ping/pong exchanges, NTP style.
+
+    The server stamps a ping with its send time, the client answers with its own
+    clock reading, and the server stamps the arrival. Assuming a symmetric path, the
+    client read its clock half a round trip after the send. Of the recent samples,
+    the one with the smallest round trip has the least queuing noise and is used.
+    """
+
+    def __init__(self, window: int = 16):
+        self.samples: Deque[Tuple[float, float]] = deque(maxlen=window)
+        """(round trip time, client clock - local clock)"""
+
+    def add_sample(
+        self, send_time: float, client_time: float, receive_time: Optional[float] = None
+    ):
+        if receive_time is None:
+            receive_time = time.monotonic()
+        rtt = receive_time - send_time
+        if rtt < 0:
+            return
+        self.samples.append((rtt, client_time - (send_time + rtt / 2)))
+
+    @property
+    def is_synced(self) -> bool:
+        return len(self.samples) > 0
+
+    @property
+    def rtt(self) -> float:
+        return min(self.samples)[0] if self.samples else 0.0
+
+    @property
+    def offset(self) -> float:
+        return min(self.samples)[1] if self.samples else 0.0
+
+    def to_local(self, client_time: float) -> float:
+        """Converts a client clock reading to `time.monotonic()`."""
+        return client_time - self.offset
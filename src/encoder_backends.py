@@ -0,0 +1,195 @@
+"""Pluggable H.264 encoders behind `VideoEncoderWorker`.
+
+Every backend turns BGR frames into an mp4 file:
+- "pyav": libavcodec through PyAV, software x264 by default. Runs anywhere.
+- "gst_x264": GStreamer `x264enc`. Runs anywhere GStreamer is installed.
+- "gst_nvidia": GStreamer `nvv4l2h264enc` on Jetson.
+
+The GStreamer backends import `gi` lazily, so machines without GStreamer can still use
+PyAV.
+"""
+
+from abc import ABC, abstractmethod
+from fractions import Fraction
+from typing import Any, Dict, Optional, Type
+
+import av
+import numpy as np
+import numpy.typing as npt
+
+
+VIDEO_TIME_BASE = Fraction(1, 90000)
+"""Time base of recorded video PTS, the 90 kHz MPEG clock."""
+
+
+class EncoderBackend(ABC):
+    """Encodes BGR frames of a fixed size into one mp4 file at a time. Called from a
+    single encoder thread."""
+
+    def __init__(self, fragmented: bool = False, fragment_duration: float = 1.0):
+        self.fragmented = fragmented
+        self.fragment_duration = fragment_duration
+        self.file_path = ""
+
+    @abstractmethod
+    def open(self, file_path: str, width: int, height: int, frame_rate: float):
+        pass
+
+    @abstractmethod
+    def encode(self, frame: npt.NDArray[np.uint8], timestamp: float):
+        """Encodes one BGR frame captured at `timestamp` (`time.monotonic()`)."""
+
+    @abstractmethod
+    def close(self):
+        """Flushes the encoder and finishes the file."""
+
+
+class PyAVEncoder(EncoderBackend):
+    """`preset`, `tune` and `crf` are passed to the codec (x264 option names), and
+    `threads` sets the codec's thread count (0 lets it decide). With `bitrate`, the
+    encoder targets that many bit/s instead of a constant quality.
+
+    Frames are stamped with their capture time relative to the first frame, in
+    `VIDEO_TIME_BASE` units, so the file keeps the real timing of a camera that
+    delivers fewer frames than advertised or of frames dropped on the way.
+    """
+
+    def __init__(
+        self,
+        fragmented: bool = False,
+        fragment_duration: float = 1.0,
+        codec: str = "h264",
+        preset: str = "veryfast",
+        tune: str = "",
+        crf: Optional[int] = 23,
+        threads: int = 0,
+        bitrate: Optional[int] = None,
+    ):
+        super().__init__(fragmented, fragment_duration)
+        self.codec = codec
+        self.preset = preset
+        self.tune = tune
+        self.crf = crf
+        self.threads = threads
+        self.bitrate = bitrate
+        self.container = None
+        self.stream = None
+        self.first_timestamp: Optional[float] = None
+        self.last_pts = -1
+
+    def open(self, file_path: str, width: int, height: int, frame_rate: float):
+        self.file_path = file_path
+        container_options = {}
+        if self.fragmented:
+            container_options["movflags"] = "frag_keyframe+empty_moov+default_base_moof"
+        self.container = av.open(file_path, mode="w", options=container_options)
+        codec_options = {"preset": self.preset, "threads": str(self.threads)}
+        if self.tune:
+            codec_options["tune"] = self.tune
+        if self.crf is not None and self.bitrate is None:
+            codec_options["crf"] = str(self.crf)
+        self.stream = self.container.add_stream(
+            self.codec, rate=round(frame_rate), options=codec_options
+        )
+        self.stream.width = width
+        self.stream.height = height
+        self.stream.pix_fmt = "yuv420p"
+        self.stream.codec_context.time_base = VIDEO_TIME_BASE
+        self.stream.time_base = VIDEO_TIME_BASE
+        self.first_timestamp = None
+        self.last_pts = -1
+        if self.bitrate is not None:
+            self.stream.bit_rate = self.bitrate
+        if self.fragmented:
+            # Fragments are cut at keyframes
+            self.stream.codec_context.gop_size = max(
+                1, round(frame_rate * self.fragment_duration)
+            )
+
+    def encode(self, frame: npt.NDArray[np.uint8], timestamp: float):
+        # swscale converts BGR to YUV directly, no intermediate RGB copy
+        video_frame = av.VideoFrame.from_ndarray(frame, format="bgr24")
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        # PTS must increase strictly, even if two frames share a timestamp
+        pts = max(
+            round((timestamp - self.first_timestamp) / VIDEO_TIME_BASE),
+            self.last_pts + 1,
+        )
+        video_frame.pts = pts
+        video_frame.time_base = VIDEO_TIME_BASE
+        self.last_pts = pts
+        for packet in self.stream.encode(video_frame):
+            self.container.mux(packet)
+
+    def close(self):
+        for packet in self.stream.encode():
+            self.container.mux(packet)
+        self.container.close()
+
+
+class GstreamerEncoder(EncoderBackend):
+    """Wraps a `GstreamerPipeline` with the given `encoder` ("x264" or "nvidia"). The
+    pipeline is rebuilt for every file, since its caps depend on the frame size."""
+
+    def __init__(
+        self,
+        fragmented: bool = False,
+        fragment_duration: float = 1.0,
+        encoder: str = "x264",
+        bitrate: int = 8000000,
+        speed_preset: str = "veryfast",
+        tune: str = "",
+        threads: int = 0,
+    ):
+        super().__init__(fragmented, fragment_duration)
+        self.encoder = encoder
+        self.bitrate = bitrate
+        self.speed_preset = speed_preset
+        self.tune = tune
+        self.threads = threads
+        self.pipeline = None
+
+    def open(self, file_path: str, width: int, height: int, frame_rate: float):
+        from gstreamer_pipeline import GstreamerPipeline
+
+        self.file_path = file_path
+        self.pipeline = GstreamerPipeline(
+            resolution=(width, height),
+            framerate=round(frame_rate),
+            bitrate=self.bitrate,
+            fragment_duration=(
+                round(self.fragment_duration * 1000) if self.fragmented else 0
+            ),
+            encoder=self.encoder,
+            speed_preset=self.speed_preset,
+            tune=self.tune,
+            threads=self.threads,
+        )
+        self.pipeline.start_recording(file_path)
+
+    def encode(self, frame: npt.NDArray[np.uint8], timestamp: float):
+        self.pipeline.encode_img(frame, timestamp)
+
+    def close(self):
+        self.pipeline.stop_recording()
+        self.pipeline = None
+
+
+ENCODER_BACKENDS: Dict[str, Type[EncoderBackend]] = {
+    "pyav": PyAVEncoder,
+    "gst_x264": GstreamerEncoder,
+    "gst_nvidia": GstreamerEncoder,
+}
+DEFAULT_BACKEND_OPTIONS: Dict[str, Dict[str, Any]] = {
+    "gst_x264": {"encoder": "x264"},
+    "gst_nvidia": {"encoder": "nvidia"},
+}
+
+
+def make_encoder_backend(name: str, **options: Any) -> EncoderBackend:
+    """Builds the backend registered as `name`; `options` go to its constructor."""
+    assert (
+        name in ENCODER_BACKENDS
+    ), f"encoder backend should be one of {tuple(ENCODER_BACKENDS)}"
+    return ENCODER_BACKENDS[name](**{**DEFAULT_BACKEND_OPTIONS.get(name, {}), **options})
@@ -0,0 +1,364 @@
+"""Frames shared between processes without pickling.
+
+The capture process writes frames into a `FrameBus`, a ring of frame slots in
+`multiprocessing.shared_memory`, and every other process reads them in place as NumPy
+views. Capture, recording encoder and web server then each run in an interpreter of
+their own instead of sharing one GIL.
+"""
+
+import asyncio
+import multiprocessing as mp
+import time
+from multiprocessing import shared_memory
+from typing import Optional, Tuple, Union
+
+import cv2
+import numpy as np
+import numpy.typing as npt
+
+from frame_capture import CapturedFrame
+
+BUS_HEADER_DTYPE = np.dtype(
+    [
+        ("ring_size", np.int64),
+        ("slot_size", np.int64),
+        ("latest_seq", np.int64),
+        ("frame_rate", np.float64),
+        ("width", np.int32),
+        ("height", np.int32),
+    ]
+)
+SLOT_HEADER_DTYPE = np.dtype(
+    [
+        ("version", np.int64),
+        ("seq", np.int64),
+        ("timestamp", np.float64),
+        ("height", np.int32),
+        ("width", np.int32),
+        ("channels", np.int32),
+        ("padding", np.int32),
+    ]
+)
+ALIGNMENT = 64
+
+
+def align(size: int) -> int:
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class FrameBus:
+    """A ring of `ring_size` frame slots of up to `max_shape` (height, width, channels)
+    uint8 pixels in shared memory, written by one process and read by any number of
+    processes forked after it was created.
+
+    Every slot header works as a seqlock: its version is odd while the writer fills
+    the slot and even once the frame is complete. Slot `seq % ring_size` holds frames
+    `seq`, `seq + ring_size`, ..., so the slot still holds frame `seq` exactly when
+    its version is `2 * (seq // ring_size + 1)`. A reader checks that before and after
+    touching the pixels: if it still holds, the pixels it read are frame `seq` and
+    not half of a newer frame. Headers are only accessed under `cond`, whose lock
+    also orders the pixel writes against the header updates on weakly ordered CPUs.
+    """
+
+    def __init__(self, max_shape: Tuple[int, int, int] = (720, 1440, 3), ring_size: int = 8):
+        assert ring_size >= 2, "ring_size should be at least 2"
+        self.max_shape = max_shape
+        self.ring_size = ring_size
+        self.slot_size = align(int(np.prod(max_shape)))
+        self.slot_header_offset = align(BUS_HEADER_DTYPE.itemsize)
+        self.data_offset = self.slot_header_offset + align(
+            SLOT_HEADER_DTYPE.itemsize * ring_size
+        )
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=self.data_offset + self.slot_size * ring_size
+        )
+        self.header = np.ndarray((), dtype=BUS_HEADER_DTYPE, buffer=self.shm.buf)
+        self.slot_headers = np.ndarray(
+            (ring_size,),
+            dtype=SLOT_HEADER_DTYPE,
+            buffer=self.shm.buf,
+            offset=self.slot_header_offset,
+        )
+        self.data = np.ndarray(
+            (ring_size, self.slot_size),
+            dtype=np.uint8,
+            buffer=self.shm.buf,
+            offset=self.data_offset,
+        )
+        self.header["ring_size"] = ring_size
+        self.header["slot_size"] = self.slot_size
+        self.header["latest_seq"] = -1
+        self.header["frame_rate"] = 0.0
+        self.header["height"] = max_shape[0]
+        self.header["width"] = max_shape[1]
+        self.slot_headers[:] = 0
+        self.slot_headers["seq"] = -1
+        self.cond = mp.Condition()
+        self.writing_seq = -1
+        """Frame being written by `begin_write`, only meaningful in the writer."""
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def latest_seq(self) -> int:
+        with self.cond:
+            return int(self.header["latest_seq"])
+
+    def set_format(self, width: int, height: int, frame_rate: float):
+        """Published by the writer once the device is open."""
+        with self.cond:
+            self.header["width"] = width
+            self.header["height"] = height
+            self.header["frame_rate"] = frame_rate
+
+    def get_format(self) -> Tuple[int, int, float]:
+        """(width, height, frame rate) published by the writer."""
+        with self.cond:
+            return (
+                int(self.header["width"]),
+                int(self.header["height"]),
+                float(self.header["frame_rate"]),
+            )
+
+    def slot_view(self, idx: int, shape: Tuple[int, ...]) -> npt.NDArray[np.uint8]:
+        return self.data[idx, : int(np.prod(shape))].reshape(shape)
+
+    def complete_version(self, seq: int) -> int:
+        return 2 * (seq // self.ring_size + 1)
+
+    def begin_write(self, shape: Tuple[int, int, int]) -> npt.NDArray[np.uint8]:
+        """Marks the slot of the next frame as being written and returns it as an
+        array of `shape` to fill. Calling it again before `end_write`, e.g. after a
+        failed read, reuses the same slot."""
+        assert int(np.prod(shape)) <= self.slot_size, (
+            f"Frame of shape {shape} does not fit in a slot of {self.max_shape}"
+        )
+        with self.cond:
+            seq = int(self.header["latest_seq"]) + 1
+            idx = seq % self.ring_size
+            self.slot_headers["version"][idx] = self.complete_version(seq) - 1
+        self.writing_seq = seq
+        return self.slot_view(idx, shape)
+
+    def end_write(self, shape: Tuple[int, int, int], timestamp: float) -> int:
+        """Publishes the frame filled since `begin_write`, captured at `timestamp`
+        (`time.monotonic()`), and wakes up waiting readers. Returns its seq."""
+        seq = self.writing_seq
+        idx = seq % self.ring_size
+        with self.cond:
+            self.slot_headers["seq"][idx] = seq
+            self.slot_headers["timestamp"][idx] = timestamp
+            self.slot_headers["height"][idx] = shape[0]
+            self.slot_headers["width"][idx] = shape[1]
+            self.slot_headers["channels"][idx] = shape[2]
+            self.slot_headers["version"][idx] = self.complete_version(seq)
+            self.header["latest_seq"] = seq
+            self.cond.notify_all()
+        self.writing_seq = -1
+        return seq
+
+    def is_intact(self, seq: int) -> bool:
+        """Whether the slot of frame `seq` still holds it, complete."""
+        if seq < 0:
+            return False
+        idx = seq % self.ring_size
+        with self.cond:
+            return (
+                self.slot_headers["version"][idx] == self.complete_version(seq)
+                and self.slot_headers["seq"][idx] == seq
+            )
+
+    def get_frame(self, seq: int) -> Optional[CapturedFrame]:
+        """Returns frame `seq` as a view into shared memory if it is still in the
+        ring, otherwise None. The view is overwritten `ring_size` frames later; check
+        `is_intact(seq)` after using it, or use `read_frame` to get a copy."""
+        if seq < 0:
+            return None
+        idx = seq % self.ring_size
+        with self.cond:
+            if (
+                self.slot_headers["version"][idx] != self.complete_version(seq)
+                or self.slot_headers["seq"][idx] != seq
+            ):
+                return None
+            timestamp = float(self.slot_headers["timestamp"][idx])
+            shape = (
+                int(self.slot_headers["height"][idx]),
+                int(self.slot_headers["width"][idx]),
+                int(self.slot_headers["channels"][idx]),
+            )
+        return CapturedFrame(seq, timestamp, self.slot_view(idx, shape))
+
+    def read_frame(
+        self, seq: int, out: Optional[npt.NDArray[np.uint8]] = None
+    ) -> Optional[CapturedFrame]:
+        """Copies frame `seq` out of shared memory, into `out` if given. Returns None
+        if the frame is gone, or was overwritten while it was being copied."""
+        captured = self.get_frame(seq)
+        if captured is None:
+            return None
+        if out is None:
+            frame = captured.frame.copy()
+        else:
+            frame = out
+            np.copyto(frame, captured.frame)
+        if not self.is_intact(seq):
+            return None
+        return CapturedFrame(seq, captured.timestamp, frame)
+
+    def get_latest(self) -> Optional[CapturedFrame]:
+        return self.get_frame(self.latest_seq)
+
+    def wait_for_frame(
+        self, after_seq: int, timeout: Optional[float] = None
+    ) -> Optional[CapturedFrame]:
+        """Blocks the calling thread until a frame newer than `after_seq` is available
+        and returns the latest one."""
+        with self.cond:
+            if not self.cond.wait_for(
+                lambda: self.header["latest_seq"] > after_seq, timeout=timeout
+            ):
+                return None
+        return self.get_latest()
+
+    def close(self):
+        """Detaches this process. The views of this bus must not be used afterwards."""
+        self.header = None
+        self.slot_headers = None
+        self.data = None
+        self.shm.close()
+
+    def unlink(self):
+        """Frees the shared memory once every process has closed it. Called by the
+        creator."""
+        self.shm.unlink()
+
+
+class SharedFrameCapture:
+    """Reads a `cv2.VideoCapture` in a dedicated process straight into the slots of a
+    `FrameBus`. In this process it offers the reading side of `FrameCapture`
+    (`get_frame`, `wait_for_frame`, ...), so a `PreviewHub` can sit on top of it, and
+    processes forked after it, e.g. `EncoderProcess`, read `bus` directly.
+
+    Frames larger than `max_resolution` (the requested `resolution` by default) are
+    dropped, since the slots are sized before the device is opened.
+    """
+
+    def __init__(
+        self,
+        device: Union[int, str] = 0,
+        resolution: Tuple[int, int] = (1440, 720),
+        ring_size: int = 8,
+        max_resolution: Optional[Tuple[int, int]] = None,
+    ):
+        self.device = device
+        self.resolution = resolution
+        max_width, max_height = max_resolution or resolution
+        self.bus = FrameBus((max_height, max_width, 3), ring_size)
+        self.process: Optional[mp.Process] = None
+        self.stop_event = mp.Event()
+        self.opened_event = mp.Event()
+        self.released = False
+
+    @property
+    def width(self) -> int:
+        return self.bus.get_format()[0]
+
+    @property
+    def height(self) -> int:
+        return self.bus.get_format()[1]
+
+    @property
+    def frame_rate(self) -> float:
+        return self.bus.get_format()[2]
+
+    def start(self, open_timeout: float = 10.0):
+        """Starts the capture process and waits until the device reported its
+        resolution and frame rate."""
+        if self.process is not None and self.process.is_alive():
+            return
+        self.stop_event.clear()
+        self.opened_event.clear()
+        self.process = mp.Process(target=self.run, daemon=True)
+        self.process.start()
+        if not self.opened_event.wait(open_timeout):
+            print(f"Camera {self.device} did not open within {open_timeout} s")
+
+    def stop(self):
+        self.stop_event.set()
+        if self.process is not None:
+            self.process.join()
+            self.process = None
+
+    def release(self):
+        if self.released:
+            return
+        self.stop()
+        self.released = True
+        self.bus.close()
+        self.bus.unlink()
+        print(f"Camera {self.device} released")
+
+    def run(self):
+        cap = cv2.VideoCapture()
+        cap.open(self.device)
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or self.resolution[0]
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or self.resolution[1]
+        self.bus.set_format(width, height, cap.get(cv2.CAP_PROP_FPS))
+        self.opened_event.set()
+        print(
+            f"Camera {self.device} initialized with resolution {(width, height)}, fps {cap.get(cv2.CAP_PROP_FPS)} (capture process)"
+        )
+        shape = (height, width, 3)
+        try:
+            while not self.stop_event.is_set():
+                slot = self.bus.begin_write(shape)
+                success, img = cap.read(slot)
+                timestamp = time.monotonic()
+                if not success:
+                    time.sleep(0.1)
+                    continue
+                if img is not slot:
+                    if img.shape != slot.shape:
+                        if img.size > self.bus.slot_size:
+                            print(
+                                f"Camera {self.device} frame {img.shape[1]}x{img.shape[0]} does not fit the frame bus, dropped"
+                            )
+                            continue
+                        shape = img.shape
+                        self.bus.set_format(shape[1], shape[0], self.frame_rate)
+                        slot = self.bus.begin_write(shape)
+                    slot[...] = img
+                self.bus.end_write(shape, timestamp)
+        finally:
+            cap.release()
+
+    def get_frame(self, seq: int) -> Optional[CapturedFrame]:
+        return self.bus.get_frame(seq)
+
+    def get_latest(self) -> Optional[CapturedFrame]:
+        return self.bus.get_latest()
+
+    def is_intact(self, seq: int) -> bool:
+        return self.bus.is_intact(seq)
+
+    def read_frame(self, seq: int) -> Optional[CapturedFrame]:
+        return self.bus.read_frame(seq)
+
+    def wait_for_frame(
+        self, after_seq: int, timeout: Optional[float] = None
+    ) -> Optional[CapturedFrame]:
+        return self.bus.wait_for_frame(after_seq, timeout)
+
+    async def wait_for_frame_async(
+        self, after_seq: int, timeout: Optional[float] = None
+    ) -> Optional[CapturedFrame]:
+        """Same as `wait_for_frame` but suspends the coroutine instead of blocking the
+        event loop."""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.bus.wait_for_frame, after_seq, timeout
+        )
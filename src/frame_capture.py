@@ -0,0 +1,209 @@
+import asyncio
+import threading
+import time
+from typing import Callable, List, NamedTuple, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+import numpy.typing as npt
+
+
+class CapturedFrame(NamedTuple):
+    seq: int
+    """Monotonically increasing frame number, starting from 0 after `start`."""
+    timestamp: float
+    """`time.monotonic()` right after the frame was read from the device."""
+    frame: npt.NDArray[np.uint8]
+    """BGR image. This is a view into the ring buffer, which the capture thread starts
+    overwriting `ring_size - 1` frames later. Check `is_intact(seq)` after using it,
+    or use `read_frame` to get a copy."""
+
+
+class FrameCapture:
+    """Owns a `cv2.VideoCapture` and reads it at the full sensor rate in a dedicated
+    thread. Frames are written into a fixed-size ring of preallocated buffers, so any
+    number of consumers can read the latest frame without touching the device."""
+
+    def __init__(
+        self,
+        device: Union[int, str] = 0,
+        resolution: Tuple[int, int] = (1440, 720),
+        ring_size: int = 8,
+    ):
+        assert ring_size >= 2, "ring_size should be at least 2"
+        self.device = device
+        self.resolution = resolution
+        self.ring_size = ring_size
+        self.cap = cv2.VideoCapture()
+
+        self.width = resolution[0]
+        self.height = resolution[1]
+        self.frame_rate = 0.0
+        self.frames = np.empty((ring_size, self.height, self.width, 3), dtype=np.uint8)
+        self.timestamps = np.zeros(ring_size, dtype=np.float64)
+        self.slot_seqs = np.full(ring_size, -1, dtype=np.int64)
+        self.latest_seq = -1
+
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        self.cond = threading.Condition()
+        self.consumers: List[Callable[[CapturedFrame], None]] = []
+        """Called from the capture thread for every new frame. Must not block for long.
+        The frame is intact until the callback returns; keep a copy beyond that."""
+        self.async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def open(self):
+        if not self.cap.isOpened():
+            self.cap.open(self.device)
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or self.resolution[0]
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or self.resolution[1]
+        self.frame_rate = self.cap.get(cv2.CAP_PROP_FPS)
+        self.allocate_ring(self.height, self.width)
+        print(
+            f"Camera {self.device} initialized with resolution {(self.width, self.height)}, fps {self.frame_rate}"
+        )
+
+    def allocate_ring(self, height: int, width: int):
+        with self.cond:
+            self.frames = np.empty(
+                (self.ring_size, height, width, 3), dtype=np.uint8
+            )
+            self.timestamps[:] = 0
+            self.slot_seqs[:] = -1
+            self.height, self.width = height, width
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        if not self.cap.isOpened():
+            self.open()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def release(self):
+        self.stop()
+        if self.cap.isOpened():
+            self.cap.release()
+        print(f"Camera {self.device} released")
+
+    def run(self):
+        seq = self.latest_seq + 1
+        while not self.stop_event.is_set():
+            idx = seq % self.ring_size
+            with self.cond:
+                # The slot no longer holds its previous frame once the read starts
+                self.slot_seqs[idx] = -1
+            slot = self.frames[idx]
+            success, img = self.cap.read(slot)
+            timestamp = time.monotonic()
+            if not success:
+                time.sleep(0.1)
+                continue
+            if img is not slot:
+                # The device delivered a different resolution than the ring was
+                # allocated for. Reallocate once and keep going.
+                if img.shape != slot.shape:
+                    print(
+                        f"Camera {self.device} resolution changed to {img.shape[1]}x{img.shape[0]}"
+                    )
+                    self.allocate_ring(img.shape[0], img.shape[1])
+                self.frames[idx][...] = img
+
+            with self.cond:
+                self.slot_seqs[idx] = seq
+                self.timestamps[idx] = timestamp
+                self.latest_seq = seq
+                waiters = self.async_waiters
+                self.async_waiters = []
+                self.cond.notify_all()
+
+            captured = CapturedFrame(seq, timestamp, self.frames[idx])
+            for loop, future in waiters:
+                loop.call_soon_threadsafe(set_future_result, future, captured)
+            for consumer in list(self.consumers):
+                consumer(captured)
+            seq += 1
+
+    def get_frame(self, seq: int) -> Optional[CapturedFrame]:
+        """Returns frame `seq` as a view into the ring if it is still there, otherwise
+        None. See `CapturedFrame.frame` for how long the view holds."""
+        if seq < 0:
+            return None
+        idx = seq % self.ring_size
+        with self.cond:
+            if self.slot_seqs[idx] != seq:
+                return None
+            return CapturedFrame(seq, float(self.timestamps[idx]), self.frames[idx])
+
+    def is_intact(self, seq: int) -> bool:
+        """Whether the slot of frame `seq` still holds it, i.e. the capture thread has
+        not started overwriting it."""
+        if seq < 0:
+            return False
+        with self.cond:
+            return self.slot_seqs[seq % self.ring_size] == seq
+
+    def read_frame(self, seq: int) -> Optional[CapturedFrame]:
+        """Copies frame `seq` out of the ring. Returns None if the frame is gone, or
+        was overwritten while it was being copied."""
+        captured = self.get_frame(seq)
+        if captured is None:
+            return None
+        frame = captured.frame.copy()
+        if not self.is_intact(seq):
+            return None
+        return CapturedFrame(seq, captured.timestamp, frame)
+
+    def get_latest(self) -> Optional[CapturedFrame]:
+        return self.get_frame(self.latest_seq)
+
+    def wait_for_frame(
+        self, after_seq: int, timeout: Optional[float] = None
+    ) -> Optional[CapturedFrame]:
+        """Blocks the calling thread until a frame newer than `after_seq` is available
+        and returns the latest one."""
+        with self.cond:
+            if not self.cond.wait_for(
+                lambda: self.latest_seq > after_seq, timeout=timeout
+            ):
+                return None
+        return self.get_latest()
+
+    async def wait_for_frame_async(
+        self, after_seq: int, timeout: Optional[float] = None
+    ) -> Optional[CapturedFrame]:
+        """Same as `wait_for_frame` but suspends the coroutine instead of blocking the
+        event loop."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.cond:
+            if self.latest_seq > after_seq:
+                future = None
+            else:
+                self.async_waiters.append((loop, future))
+        if future is None:
+            return self.get_latest()
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            with self.cond:
+                self.async_waiters = [
+                    waiter for waiter in self.async_waiters if waiter[1] is not future
+                ]
+        return self.get_latest()
+
+
+def set_future_result(future: asyncio.Future, result):
+    if not future.done():
+        future.set_result(result)
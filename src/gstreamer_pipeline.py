@@ -1,12 +1,15 @@
+import argparse
 import time
 import gi
 import numpy as np
 gi.require_version("Gst", '1.0')
-from gi.repository import Gst, GLib # type: ignore
+from gi.repository import Gst # type: ignore
 import numpy.typing as npt
-import cv2
+from typing import List, Optional, Union
 import sys
-import os
+
+from frame_capture import CapturedFrame, FrameCapture
+from recording_session import camera_file_name
 def bus_call(bus, message, loop):
     t = message.type
     if t == Gst.MessageType.EOS:
@@ -21,74 +24,118 @@ def bus_call(bus, message, loop):
         loop.quit()
     return True
 
+GST_ENCODERS = ("nvidia", "x264")
+INPUT_FORMATS = ("BGR", "I420")
+
+
 class GstreamerPipeline:
 
-    def __init__(self, resolution: tuple[int, int] = (1920, 1080), framerate: int=30, bitrate:int = 8000000):
+    def __init__(self, resolution: tuple[int, int] = (1920, 1080), framerate: int=30, bitrate:int = 8000000, fragment_duration: int = 0, encoder: str = "nvidia", speed_preset: str = "veryfast", tune: str = "", threads: int = 0, input_format: str = "BGR", pool_size: int = 8):
+        """fragment_duration: if > 0, write fragmented MP4 with fragments of this many
+        milliseconds, so the file is playable while recording and survives a crash.
+        encoder: "nvidia" for the Jetson hardware encoder, "x264" for software x264enc,
+        which works on any machine. speed_preset, tune and threads only apply to x264.
+        input_format: layout of the frames passed to `encode_img`, "BGR" as captured by
+        OpenCV or planar "I420" (shape (height * 3 // 2, width)), which the encoders
+        take without any conversion.
+        pool_size: number of preallocated frame buffers. `encode_img` blocks when all
+        of them are still queued in the pipeline."""
+        assert encoder in GST_ENCODERS, f"encoder should be one of {GST_ENCODERS}"
+        assert input_format in INPUT_FORMATS, f"input_format should be one of {INPUT_FORMATS}"
         Gst.init(None)
         self.pipeline = Gst.Pipeline.new("gst-video-record")
 
         self.appsrc = Gst.ElementFactory.make("appsrc", "video_source")
-        appsrc_caps = Gst.Caps.from_string(f"video/x-raw,format=RGBA,width={resolution[0]},height={resolution[1]},framerate={framerate}/1")
+        appsrc_caps = Gst.Caps.from_string(f"video/x-raw,format={input_format},width={resolution[0]},height={resolution[1]},framerate={framerate}/1")
         self.appsrc.set_property("caps", appsrc_caps)
+        self.appsrc.set_property("format", Gst.Format.TIME)
+
+        # Frames are copied into buffers from this pool, which return to it once the
+        # encoder is done with them, so no memory is allocated per frame
+        if input_format == "BGR":
+            self.frame_shape: tuple[int, ...] = (resolution[1], resolution[0], 3)
+        else:
+            self.frame_shape = (resolution[1] * 3 // 2, resolution[0])
+        frame_size = int(np.prod(self.frame_shape))
+        self.buffer_pool = Gst.BufferPool.new()
+        pool_config = self.buffer_pool.get_config()
+        Gst.BufferPool.config_set_params(pool_config, appsrc_caps, frame_size, pool_size, pool_size)
+        self.buffer_pool.set_config(pool_config)
+
+        keyframe_interval = max(1, framerate * fragment_duration // 1000) if fragment_duration > 0 else 0
+        pre_converter = None
+        if encoder == "nvidia":
+            if input_format == "BGR":
+                # nvvidconv takes BGRx but not packed BGR
+                pre_converter = Gst.ElementFactory.make("videoconvert", "pre_converter")
+                if pre_converter:
+                    pre_converter.set_property("n-threads", 0)
+            converter = Gst.ElementFactory.make("nvvidconv", "converter")
 
-        converter = Gst.ElementFactory.make("nvvidconv", "converter")
+            capsfilter = Gst.ElementFactory.make("capsfilter", "nvmm_caps")
+            caps = Gst.Caps.from_string(f"video/x-raw(memory:NVMM),width={resolution[0]},height={resolution[1]},framerate={framerate}/1,format=I420")
 
-        nvmm_capsfilter = Gst.ElementFactory.make("capsfilter", "nvmm_caps")
-        nvmm_caps = Gst.Caps.from_string(f"video/x-raw(memory:NVMM),width={resolution[0]},height={resolution[1]},framerate={framerate}/1,format=I420")
-        nvmm_capsfilter.set_property("caps", nvmm_caps)
+            encoder_element = Gst.ElementFactory.make("nvv4l2h264enc", "encoder")
+            if encoder_element:
+                encoder_element.set_property("bitrate", bitrate)
+                if keyframe_interval:
+                    # Start every fragment with a keyframe
+                    encoder_element.set_property("iframeinterval", keyframe_interval)
+        else:
+            # Passes I420 through untouched
+            converter = Gst.ElementFactory.make("videoconvert", "converter")
+            if converter:
+                converter.set_property("n-threads", 0)
 
-        encoder = Gst.ElementFactory.make("nvv4l2h264enc", "encoder")
-        encoder.set_property("bitrate", bitrate)
+            capsfilter = Gst.ElementFactory.make("capsfilter", "i420_caps")
+            caps = Gst.Caps.from_string("video/x-raw,format=I420")
+
+            encoder_element = Gst.ElementFactory.make("x264enc", "encoder")
+            if encoder_element:
+                # x264enc takes kbit/s
+                encoder_element.set_property("bitrate", bitrate // 1000)
+                encoder_element.set_property("threads", threads)
+                encoder_element.set_property("speed-preset", speed_preset)
+                if tune:
+                    encoder_element.set_property("tune", tune)
+                if keyframe_interval:
+                    encoder_element.set_property("key-int-max", keyframe_interval)
+        if capsfilter:
+            capsfilter.set_property("caps", caps)
 
         parser = Gst.ElementFactory.make("h264parse", "parser")
 
         muxer = Gst.ElementFactory.make("qtmux", "muxer")
+        if muxer and fragment_duration > 0:
+            muxer.set_property("fragment-duration", fragment_duration)
 
         self.sink = Gst.ElementFactory.make("filesink", "sink")
 
         # Check for errors
-        elements = [self.appsrc, converter, nvmm_capsfilter, encoder, parser, muxer, self.sink]
+        elements = [self.appsrc, converter, capsfilter, encoder_element, parser, muxer, self.sink]
+        if encoder == "nvidia" and input_format == "BGR":
+            elements.insert(1, pre_converter)
         for element in elements:
             if not element:
-                print(f"Element could not be created. Exiting.")
-                exit(-1)
+                raise RuntimeError(f"GStreamer elements for the {encoder} encoder could not be created")
 
         # Add elements to the pipeline
         for element in elements:
             self.pipeline.add(element)
 
-        if not self.appsrc.link(converter):
-            print("ERROR: Could not link appsrc to converter")
-            exit(-1)
-
-        if not converter.link(nvmm_capsfilter):
-            print("ERROR: Could not link converter to nvmm_capsfilter")
-            exit(-1)
-
-        if not nvmm_capsfilter.link(encoder):
-            print("ERROR: Could not link nvmm_capsfilter to encoder")
-            exit(-1)
-
-        if not encoder.link(parser):
-            print("ERROR: Could not link encoder to parser")
-            exit(-1)
-
-        if not parser.link(muxer):
-            print("ERROR: Could not link parser to muxer")
-            exit(-1)
-
-        if not muxer.link(self.sink):
-            print("ERROR: Could not link muxer to sink")
-            exit(-1)
+        for upstream, downstream in zip(elements[:-1], elements[1:]):
+            if not upstream.link(downstream):
+                raise RuntimeError(f"Could not link {upstream.get_name()} to {downstream.get_name()}")
 
+        self.encoder = encoder
+        self.input_format = input_format
         self.is_recording = False
         self.frame_cnt = 0
+        self.first_timestamp: Optional[float] = None
         self.frame_rate = framerate
         self.resolution = resolution
         self.output_file = ""
 
-        
-
     # ========= context manager ===========
     def __enter__(self):
         return self
@@ -103,12 +150,13 @@ class GstreamerPipeline:
         start_time = time.monotonic()
         self.sink.set_property("location", output_file)
         # self.sink.set_property("location", output_file)
+        self.buffer_pool.set_active(True)
         ret = self.pipeline.set_state(Gst.State.PLAYING)
         if ret == Gst.StateChangeReturn.FAILURE:
-            print("ERROR: Unable to set the pipeline to the playing state.")
-            exit(-1)
+            raise RuntimeError("Unable to set the pipeline to the playing state")
         self.is_recording = True
         self.frame_cnt = 0
+        self.first_timestamp = None
         self.output_file = output_file
         print(f"Recording started. Output file: {output_file}, starting time spent: {time.monotonic() - start_time} s")
 
@@ -117,45 +165,102 @@ class GstreamerPipeline:
             print("Pipeline is not in recording state. Command is ignored.")
             return
         self.appsrc.emit("end-of-stream")
-        time.sleep(0.1)
+        # Wait for the muxer to finish the file before tearing the pipeline down
+        bus = self.pipeline.get_bus()
+        message = bus.timed_pop_filtered(10 * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        if message is not None and message.type == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            sys.stderr.write("Error: %s: %s\n" % (err, debug))
         self.pipeline.set_state(Gst.State.NULL)
+        self.buffer_pool.set_active(False)
         self.is_recording = False
         print(f"Recording stopped. {self.frame_cnt} frames recorded")
 
-    def encode_img(self, img: npt.NDArray[np.uint8]):
-        assert img.shape == (self.resolution[1], self.resolution[0], 3), "Image should be of shape (height, width, 3) and in BGR format"
+    def encode_img(self, img: npt.NDArray[np.uint8], timestamp: Optional[float] = None):
+        """Pushes one frame in `input_format`. The frame is copied once, straight into
+        a pooled buffer, and the caller may reuse it right away.
+
+        timestamp: capture time of the frame (`time.monotonic()`). PTS are taken
+        relative to the first frame's timestamp, so dropped or late frames keep their
+        real timing. Without it, frames are assumed to arrive at exactly `framerate`.
+        """
+        assert img.shape == self.frame_shape, f"Image should be of shape {self.frame_shape} in {self.input_format} format"
         assert self.is_recording, "Pipeline must be in recording state to encode frames"
         assert img.dtype == np.uint8, "Image must be of type np.uint8"
-        frame = cv2.cvtColor(img, cv2.COLOR_BGR2RGBA)
-        duration = 10**9 / self.frame_rate
-        buf = Gst.Buffer.new_wrapped(frame.tobytes())
+        ret, buf = self.buffer_pool.acquire_buffer(None)
+        if ret != Gst.FlowReturn.OK:
+            raise RuntimeError(f"Failed to acquire a frame buffer: {ret}")
+        with buf.map(Gst.MapFlags.WRITE) as map_info:
+            np.ndarray(self.frame_shape, dtype=np.uint8, buffer=map_info.data)[...] = img
+
+        duration = 10**9 // self.frame_rate
+        if timestamp is None:
+            buf.pts = self.frame_cnt * duration
+        else:
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp
+            buf.pts = round((timestamp - self.first_timestamp) * 10**9)
+        buf.duration = duration
         self.frame_cnt += 1
-        buf.pts = self.frame_cnt * 10**9/30
-        buf.duration = 10**9/30
         self.appsrc.emit("push-buffer", buf)
 
 
-if __name__ == "__main__":
-    with GstreamerPipeline(bitrate=6000000) as pipeline:
-        # device_path = "/dev/v4l/by-id/usb-Elgato_Elgato_HD60_X_A00XB320216MTR-video-index0"
-        device_path = "video0"
-        cap = cv2.VideoCapture(device_path)
-        print(f"Capturing from device {device_path}")
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
-        cap.set(cv2.CAP_PROP_FPS, 30)
-
-        for total_duration_s in [10]:
-            pipeline.start_recording(f"test_{total_duration_s}.mp4")
-            start_time = time.monotonic()
-            while time.monotonic() - start_time < total_duration_s:
-                ret, frame = cap.read()
-                if not ret:
-                    print("Failed to capture frame")
-                    time.sleep(0.1)
-                    continue
-                pipeline.encode_img(frame)
-            pipeline.stop_recording()
-        cap.release()
+def record_cameras(
+    devices: List[Union[int, str]],
+    file_name: str,
+    duration: float,
+    resolution: tuple[int, int] = (1920, 1080),
+    **pipeline_kwargs,
+):
+    """Records every device in `devices` to `<file_name>.mp4`, `<file_name>_cam1.mp4`,
+    ... for `duration` seconds, one capture thread and one pipeline per camera. All
+    cameras start at the same point of the `time.monotonic()` clock."""
+    captures = [FrameCapture(device=device, resolution=resolution) for device in devices]
+    pipelines = []
+    for capture in captures:
+        capture.open()
+        pipelines.append(
+            GstreamerPipeline(
+                resolution=(capture.width, capture.height),
+                framerate=round(capture.frame_rate or 30),
+                **pipeline_kwargs,
+            )
+        )
+    # Leave every device time to deliver its first frames before the common start
+    start_monotonic = time.monotonic() + 1.0
+    for camera_idx, (capture, pipeline) in enumerate(zip(captures, pipelines)):
+        pipeline.start_recording(f"{camera_file_name(file_name, camera_idx)}.mp4")
+
+        def record_frame(captured: CapturedFrame, pipeline=pipeline):
+            if captured.timestamp >= start_monotonic:
+                pipeline.encode_img(captured.frame, captured.timestamp)
 
+        capture.consumers.append(record_frame)
+        capture.start()
+    time.sleep(max(0.0, start_monotonic + duration - time.monotonic()))
+    for capture, pipeline in zip(captures, pipelines):
+        capture.stop()
+        pipeline.stop_recording()
+        capture.release()
 
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record one or more cameras with GStreamer")
+    parser.add_argument(
+        "--devices",
+        nargs="+",
+        default=["0"],
+        help="Device indices or paths, e.g. 0 1 /dev/v4l/by-id/...",
+    )
+    parser.add_argument("--encoder", choices=GST_ENCODERS, default="nvidia")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--bitrate", type=int, default=6000000)
+    parser.add_argument("--output", default="test", help="File name stem of the recordings")
+    args = parser.parse_args()
+    record_cameras(
+        [int(device) if device.isdigit() else device for device in args.devices],
+        args.output,
+        args.duration,
+        encoder=args.encoder,
+        bitrate=args.bitrate,
+    )
@@ -0,0 +1,132 @@
+"""HTTP range and conditional request handling for serving recordings (RFC 7232 and
+RFC 7233, single ranges only)."""
+
+import asyncio
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from typing import AsyncGenerator, Callable, Optional, Tuple
+
+
+class RangeNotSatisfiable(ValueError):
+    """The requested range lies entirely beyond the end of the file (HTTP 416)."""
+
+
+def parse_range_header(header: str, total_size: int) -> Optional[Tuple[int, int]]:
+    """Parses a `Range` header into an inclusive (start, end) byte range.
+
+    Handles `bytes=a-b`, open-ended `bytes=a-` and suffix `bytes=-n` ranges. Returns
+    None for headers that should be ignored (other units, malformed or multiple
+    ranges), in which case the whole file is served. Raises `RangeNotSatisfiable` if
+    the range starts beyond the end of the file.
+    """
+    unit, _, range_set = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in range_set:
+        return None
+    first, sep, last = range_set.strip().partition("-")
+    if not sep:
+        return None
+    first, last = first.strip(), last.strip()
+    if not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+        return None
+    if first == "":
+        if last == "":
+            return None
+        suffix_length = int(last)
+        if suffix_length == 0 or total_size == 0:
+            raise RangeNotSatisfiable(header)
+        return max(0, total_size - suffix_length), total_size - 1
+    start = int(first)
+    end = int(last) if last else total_size - 1
+    if start >= total_size:
+        raise RangeNotSatisfiable(header)
+    if end < start:
+        return None
+    return start, min(end, total_size - 1)
+
+
+def file_etag(stat: os.stat_result) -> str:
+    """Strong validator derived from the modification time and size."""
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def http_date(timestamp: float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    tags = [tag.strip() for tag in header.split(",")]
+    # Weak comparison, as required for If-None-Match
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def parse_http_date(header: str) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def is_not_modified(
+    if_none_match: Optional[str],
+    if_modified_since: Optional[str],
+    etag: str,
+    mtime: float,
+) -> bool:
+    """Whether a conditional GET can be answered with 304 Not Modified."""
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if if_modified_since is not None:
+        since = parse_http_date(if_modified_since)
+        # HTTP dates have a resolution of one second
+        return since is not None and int(mtime) <= since
+    return False
+
+
+def if_range_matches(if_range: Optional[str], etag: str, mtime: float) -> bool:
+    """Whether a `Range` header applies, given an optional `If-Range` validator."""
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # If-Range requires a strong match
+        return if_range == etag
+    since = parse_http_date(if_range)
+    return since is not None and int(mtime) == since
+
+
+async def read_file_range(
+    path: str,
+    start: int,
+    end: Optional[int],
+    chunk_size: int = 1024 * 1024,
+    follow: Optional[Callable[[], bool]] = None,
+    poll_interval: float = 0.2,
+) -> AsyncGenerator[bytes, None]:
+    """Yields bytes `start` to `end` (inclusive, or to the end of file if None) of
+    `path`. Each chunk is read with `os.pread` in the default executor, so disk
+    latency never stalls the event loop and nothing is read beyond what the client has
+    consumed so far.
+
+    If `follow` is given, the file is treated as still growing: at the end of file the
+    generator waits for more data for as long as `follow()` returns True.
+    """
+    loop = asyncio.get_running_loop()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = start
+        while end is None or offset <= end:
+            size = chunk_size if end is None else min(chunk_size, end - offset + 1)
+            chunk = await loop.run_in_executor(None, os.pread, fd, size, offset)
+            if not chunk:
+                if follow is None:
+                    break
+                if not follow():
+                    # The writer is done, pick up whatever it wrote last
+                    follow = None
+                    continue
+                await asyncio.sleep(poll_interval)
+                continue
+            yield chunk
+            offset += len(chunk)
+    finally:
+        os.close(fd)
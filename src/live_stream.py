@@ -0,0 +1,262 @@
+"""Low-latency H.264 live preview.
+
+`LiveStreamHub` encodes the capture once with a low-bitrate, zero-latency x264 and
+broadcasts the Annex-B access units to every `/ws_video` viewer, where WebCodecs
+decodes them. Per viewer, the server only forwards bytes, and H.264 takes a fraction
+of the bandwidth of the MJPEG `/video_feed`.
+
+Every viewer first gets a JSON text message `{"type": "config", "codec", "width",
+"height"}` to configure its decoder, followed by binary messages of one access unit
+each, prefixed with `CHUNK_HEADER`: whether it is a keyframe and its timestamp in
+microseconds.
+"""
+
+import asyncio
+import json
+import struct
+import threading
+import time
+from fractions import Fraction
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+
+import av
+from av.video.frame import PictureType
+
+from encoder_backends import VIDEO_TIME_BASE
+from frame_bus import SharedFrameCapture
+from frame_capture import CapturedFrame, FrameCapture
+from preview_hub import PreviewClient
+
+CHUNK_HEADER = struct.Struct("<?q")
+"""(keyframe, timestamp in microseconds)"""
+
+
+def h264_codec_string(data: bytes) -> Optional[str]:
+    """The `avc1.PPCCLL` codec string of the first SPS in Annex-B `data`, or None
+    if it has none."""
+    idx = data.find(b"\x00\x00\x01")
+    while idx != -1 and idx + 6 < len(data):
+        if data[idx + 3] & 0x1F == 7:
+            profile, constraints, level = data[idx + 4 : idx + 7]
+            return f"avc1.{profile:02X}{constraints:02X}{level:02X}"
+        idx = data.find(b"\x00\x00\x01", idx + 3)
+    return None
+
+
+class LiveViewer:
+    """One `/ws_video` connection. Chunks are queued on the viewer's event loop; if
+    the viewer falls `max_queue_size` chunks behind, the backlog is dropped and it
+    resumes at the next keyframe, which bounds its latency."""
+
+    def __init__(
+        self,
+        hub: "LiveStreamHub",
+        client_id: str,
+        loop: asyncio.AbstractEventLoop,
+        max_queue_size: int,
+    ):
+        self.hub = hub
+        self.loop = loop
+        self.queue: "asyncio.Queue[Union[str, bytes]]" = asyncio.Queue(
+            maxsize=max(2, max_queue_size)
+        )
+        self.waiting_for_keyframe = True
+        self.client = PreviewClient(client_id, adaptive=False)
+        """Throughput stats only."""
+        self.dropped_chunk_num = 0
+
+    def push(self, chunk: bytes, is_keyframe: bool, config_message: str):
+        if self.waiting_for_keyframe:
+            if not is_keyframe:
+                return
+            self.waiting_for_keyframe = False
+            self.queue.put_nowait(config_message)
+        if self.queue.full():
+            while not self.queue.empty():
+                self.queue.get_nowait()
+                self.dropped_chunk_num += 1
+            self.waiting_for_keyframe = True
+            self.hub.request_keyframe()
+            return
+        self.queue.put_nowait(chunk)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "client": self.client.client_id,
+            "fps": round(self.client.fps, 1),
+            "bitrate": round(self.client.bitrate),
+            "dropped_chunk_num": self.dropped_chunk_num,
+        }
+
+
+class LiveStreamHub:
+    """Encodes frames of `capture` at `resolution` (the capture resolution by
+    default) to H.264 in a dedicated thread while anyone is watching. x264 runs with
+    the zerolatency tune, no B-frames and inline SPS/PPS on every keyframe, so each
+    packet can be sent as soon as it is encoded. A keyframe comes at least every
+    `keyframe_interval` seconds, and right away when a viewer joins or has to skip
+    ahead.
+
+    This is a separate encoder from the recording one: it runs whether or not
+    anything is recorded, and its bitrate and latency settings suit a live view, not
+    an archive.
+    """
+
+    def __init__(
+        self,
+        capture: Union[FrameCapture, SharedFrameCapture],
+        resolution: Optional[Tuple[int, int]] = None,
+        bitrate: int = 1000000,
+        keyframe_interval: float = 2.0,
+        max_queue_size: int = 30,
+    ):
+        self.capture = capture
+        self.resolution = resolution
+        self.bitrate = bitrate
+        self.keyframe_interval = keyframe_interval
+        self.max_queue_size = max_queue_size
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        self.cond = threading.Condition()
+        self.viewers: List[LiveViewer] = []
+        self.codec_context: Optional[av.CodecContext] = None
+        self.first_timestamp: Optional[float] = None
+        self.last_pts = -1
+        self.keyframe_requested = False
+        self.config_message = ""
+        self.encoded_frame_num = 0
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def request_keyframe(self):
+        self.keyframe_requested = True
+
+    def open_encoder(self, width: int, height: int):
+        frame_rate = round(self.capture.frame_rate or 30)
+        codec_context = av.CodecContext.create("h264", "w")
+        codec_context.width = width
+        codec_context.height = height
+        codec_context.pix_fmt = "yuv420p"
+        codec_context.time_base = VIDEO_TIME_BASE
+        codec_context.framerate = Fraction(frame_rate, 1)
+        codec_context.bit_rate = self.bitrate
+        codec_context.gop_size = max(1, round(frame_rate * self.keyframe_interval))
+        codec_context.max_b_frames = 0
+        codec_context.options = {
+            "preset": "ultrafast",
+            "tune": "zerolatency",
+            "profile": "baseline",
+            "forced-idr": "1",
+        }
+        codec_context.open()
+        self.codec_context = codec_context
+        self.first_timestamp = None
+        self.last_pts = -1
+
+    def run(self):
+        seq = -1
+        while not self.stop_event.is_set():
+            with self.cond:
+                idle = len(self.viewers) == 0
+            if idle:
+                # The next viewer starts a fresh stream
+                self.codec_context = None
+                with self.cond:
+                    self.cond.wait_for(
+                        lambda: len(self.viewers) > 0 or self.stop_event.is_set()
+                    )
+                continue
+            captured = self.capture.wait_for_frame(seq, timeout=0.5)
+            if captured is None:
+                continue
+            seq = captured.seq
+            self.encode(captured)
+
+    def encode(self, captured: CapturedFrame):
+        frame = captured.frame
+        width, height = self.resolution or (frame.shape[1], frame.shape[0])
+        # yuv420p needs even dimensions
+        width, height = width // 2 * 2, height // 2 * 2
+        if self.codec_context is None or (
+            self.codec_context.width,
+            self.codec_context.height,
+        ) != (width, height):
+            self.open_encoder(width, height)
+        # One swscale pass scales and converts to YUV
+        video_frame = av.VideoFrame.from_ndarray(frame, format="bgr24").reformat(
+            width, height, "yuv420p"
+        )
+        # `frame` is a view into the capture ring: skip the frame if the capture
+        # started overwriting it while it was being converted
+        if not self.capture.is_intact(captured.seq):
+            return
+        if self.first_timestamp is None:
+            self.first_timestamp = captured.timestamp
+        pts = max(
+            round((captured.timestamp - self.first_timestamp) / VIDEO_TIME_BASE),
+            self.last_pts + 1,
+        )
+        video_frame.pts = pts
+        video_frame.time_base = VIDEO_TIME_BASE
+        self.last_pts = pts
+        if self.keyframe_requested:
+            self.keyframe_requested = False
+            video_frame.pict_type = PictureType.I
+        for packet in self.codec_context.encode(video_frame):
+            self.broadcast(packet, width, height)
+        self.encoded_frame_num += 1
+
+    def broadcast(self, packet: av.Packet, width: int, height: int):
+        data = bytes(packet)
+        is_keyframe = packet.is_keyframe
+        if is_keyframe:
+            codec = h264_codec_string(data)
+            if codec is not None:
+                self.config_message = json.dumps(
+                    {"type": "config", "codec": codec, "width": width, "height": height}
+                )
+        chunk = (
+            CHUNK_HEADER.pack(is_keyframe, round(packet.pts * VIDEO_TIME_BASE * 1000000))
+            + data
+        )
+        with self.cond:
+            viewers = list(self.viewers)
+        for viewer in viewers:
+            viewer.loop.call_soon_threadsafe(
+                viewer.push, chunk, is_keyframe, self.config_message
+            )
+
+    async def subscribe(self, client_id: str = "") -> AsyncIterator[Union[str, bytes]]:
+        viewer = LiveViewer(
+            self, client_id, asyncio.get_running_loop(), self.max_queue_size
+        )
+        with self.cond:
+            self.viewers.append(viewer)
+            self.cond.notify_all()
+        self.request_keyframe()
+        try:
+            while True:
+                message = await viewer.queue.get()
+                send_start_time = time.monotonic()
+                yield message
+                viewer.client.on_sent(len(message), send_start_time)
+        finally:
+            with self.cond:
+                self.viewers.remove(viewer)
+
+    def viewer_stats(self) -> List[Dict[str, Any]]:
+        with self.cond:
+            return [viewer.stats() for viewer in self.viewers]
@@ -0,0 +1,215 @@
+import json
+import multiprocessing as mp
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Deque, Dict, List, Optional
+
+from av_muxer import compute_audio_offset, mux_audio_video
+
+JOB_STATES = ("queued", "running", "done", "failed")
+
+
+def run_merge_job(job: Dict[str, Any], wait_timeout: float = 10.0) -> int:
+    """Merges one recording and returns the output size in bytes. Runs in a worker
+    process, so it only takes plain data."""
+    start_time = time.monotonic()
+    # The audio of a rolled-over segment is closed a moment after its video
+    for path_key in ("raw_video_path", "video_meta_path", "audio_meta_path"):
+        while not os.path.exists(job[path_key]):
+            if time.monotonic() - start_time > wait_timeout:
+                raise FileNotFoundError(f"{job[path_key]} does not exist.")
+            time.sleep(0.1)
+
+    with open(job["video_meta_path"], "r") as f:
+        video_meta_data = json.load(f)
+    with open(job["audio_meta_path"], "r") as f:
+        audio_meta_data = json.load(f)
+
+    # Audio recording usually starts earlier than video
+    audio_offset = compute_audio_offset(video_meta_data, audio_meta_data)
+    print(f"Merging {job['file_name']} with audio offset {audio_offset:.3f} s")
+    mux_audio_video(
+        job["raw_video_path"],
+        job["audio_path"],
+        job["output_path"],
+        audio_offset=audio_offset,
+    )
+    print(f"Audio merged to {job['output_path']}")
+    return os.path.getsize(job["output_path"])
+
+
+class MergeScheduler:
+    """Runs audio/video merges on a bounded pool of worker processes. Every job is
+    recorded in a JSON journal, so jobs that were queued or running when the server
+    stopped are picked up again on the next start.
+
+    A worker that dies (crash, OOM kill) breaks the whole pool: the pool is then
+    replaced, and the jobs it was running are queued again, up to `max_attempts`
+    runs each."""
+
+    def __init__(
+        self,
+        journal_path: str,
+        max_workers: int = 1,
+        max_finished_jobs: int = 50,
+        max_attempts: int = 2,
+    ):
+        self.journal_path = journal_path
+        self.max_workers = max_workers
+        self.max_finished_jobs = max_finished_jobs
+        """Finished jobs beyond this number are dropped from the journal."""
+        self.max_attempts = max_attempts
+        self.lock = threading.RLock()
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.pending_job_ids: Deque[str] = deque()
+        self.running_job_num = 0
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+        self.load_journal()
+
+    def load_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        try:
+            with open(self.journal_path, "r") as f:
+                jobs: List[Dict[str, Any]] = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Failed to load merge journal {self.journal_path}: {e}")
+            return
+        with self.lock:
+            for job in jobs:
+                if job["state"] in ("queued", "running"):
+                    # Interrupted by a restart, run it again from scratch
+                    job["state"] = "queued"
+                    self.pending_job_ids.append(job["job_id"])
+                self.jobs[job["job_id"]] = job
+        if self.pending_job_ids:
+            print(f"Resuming {len(self.pending_job_ids)} pending merge jobs")
+            self.dispatch()
+
+    def save_journal(self):
+        with self.lock:
+            finished = [
+                job for job in self.jobs.values() if job["state"] in ("done", "failed")
+            ]
+            for job in finished[: max(0, len(finished) - self.max_finished_jobs)]:
+                del self.jobs[job["job_id"]]
+            jobs = list(self.jobs.values())
+            tmp_path = f"{self.journal_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(jobs, f, indent=2)
+            os.replace(tmp_path, self.journal_path)
+
+    def submit(
+        self,
+        file_name: str,
+        raw_video_path: str,
+        audio_path: str,
+        video_meta_path: str,
+        audio_meta_path: str,
+        output_path: str,
+    ) -> Dict[str, Any]:
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "file_name": file_name,
+            "raw_video_path": raw_video_path,
+            "audio_path": audio_path,
+            "video_meta_path": video_meta_path,
+            "audio_meta_path": audio_meta_path,
+            "output_path": output_path,
+            "state": "queued",
+            "submit_time": time.time(),
+            "start_time": None,
+            "duration": None,
+            "output_size": None,
+            "error": None,
+            "attempts": 0,
+        }
+        with self.lock:
+            self.jobs[job["job_id"]] = job
+            self.pending_job_ids.append(job["job_id"])
+            self.save_journal()
+        self.dispatch()
+        return dict(job)
+
+    def dispatch(self):
+        with self.lock:
+            while self.pending_job_ids and self.running_job_num < self.max_workers:
+                if self.executor is None:
+                    # Worker processes are spawned, not forked from the threaded server
+                    self.executor = ProcessPoolExecutor(
+                        max_workers=self.max_workers,
+                        mp_context=mp.get_context("spawn"),
+                    )
+                executor = self.executor
+                job_id = self.pending_job_ids.popleft()
+                job = self.jobs[job_id]
+                try:
+                    future = executor.submit(run_merge_job, dict(job))
+                except BrokenProcessPool:
+                    # A worker died since the last dispatch, retry on a new pool
+                    self.drop_executor(executor)
+                    self.pending_job_ids.appendleft(job_id)
+                    continue
+                job["state"] = "running"
+                job["start_time"] = time.time()
+                job["attempts"] = job.get("attempts", 0) + 1
+                self.running_job_num += 1
+                future.add_done_callback(
+                    lambda future, job_id=job_id, executor=executor: self.on_job_done(
+                        job_id, future, executor
+                    )
+                )
+            self.save_journal()
+
+    def drop_executor(self, executor: ProcessPoolExecutor):
+        """Discards a pool broken by a dead worker; the next dispatch starts a new
+        one."""
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def on_job_done(self, job_id: str, future: Future, executor: ProcessPoolExecutor):
+        with self.lock:
+            self.running_job_num -= 1
+            job = self.jobs[job_id]
+            job["duration"] = time.time() - job["start_time"]
+            try:
+                job["output_size"] = future.result()
+                job["state"] = "done"
+            except BrokenProcessPool as e:
+                self.drop_executor(executor)
+                if job["attempts"] < self.max_attempts:
+                    # Maybe another job killed the worker, run this one again
+                    print(f"Merge worker died, requeueing {job['file_name']}")
+                    job["state"] = "queued"
+                    self.pending_job_ids.appendleft(job_id)
+                else:
+                    job["state"] = "failed"
+                    job["error"] = repr(e)
+                    print(f"Merge job {job['file_name']} failed: {e!r}")
+            except Exception as e:
+                job["state"] = "failed"
+                job["error"] = repr(e)
+                print(f"Merge job {job['file_name']} failed: {e!r}")
+            self.save_journal()
+        self.dispatch()
+
+    def get_jobs(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Returns copies of the most recently submitted jobs, newest first."""
+        with self.lock:
+            jobs = sorted(
+                self.jobs.values(), key=lambda job: job["submit_time"], reverse=True
+            )
+            return [dict(job) for job in jobs[:limit]]
+
+    def shutdown(self, wait: bool = True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
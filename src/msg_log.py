@@ -0,0 +1,493 @@
+"""Columnar on-disk format for recorded ZMQ messages.
+
+Layout (little-endian):
+    header   (64 bytes): magic, message count, blob size, zero padding
+    timestamps  float64[count]   seconds since the start of the recording, ascending
+    offsets     uint64[count+1]  byte offsets of each payload into the blob
+    flags       uint8[count]     `MSG_FLAG_MORE` marks all but the last frame of a
+                                 multipart message, zero padded to 8 bytes
+    blob        uint8[blob_size] all payloads back to back
+
+Frames of a multipart message are stored as consecutive messages with the same
+timestamp.
+
+The whole file is memory-mapped on load, so opening a log is O(1) and payloads are
+sliced out of the page cache without copying.
+
+While recording, messages are appended to a `.mjournal` file instead: a magic
+followed by length-prefixed records (float64 timestamp, uint32 length, uint8 flags,
+payload). The journal is converted to a `.mlog` when recording stops, or on the next
+start if the process died, in which case a torn final record is truncated.
+
+Every `.mlog` gets a `.midx` sidecar that maps fixed time buckets to the first
+message index in each bucket:
+    header   (64 bytes): magic, bucket size, start time, bucket count, message count
+    msg_indices   uint64[bucket_count+1]
+Version 1 sidecars also stored the file offset of each bucket; they are rebuilt.
+Seeking looks up the bucket and only searches the timestamps inside it, so a jump
+touches a couple of pages no matter how large the log is.
+"""
+
+import argparse
+import os
+import pickle
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import numpy.typing as npt
+
+MSG_LOG_EXT = ".mlog"
+LEGACY_MSG_LOG_EXT = ".pkl"
+MAGIC = b"MSGLOG01"
+HEADER_FORMAT = "<8sQQ"
+HEADER_SIZE = 64
+
+JOURNAL_EXT = ".mjournal"
+JOURNAL_MAGIC = b"MSGJRN01"
+RECORD_HEADER_FORMAT = "<dIB"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+
+INDEX_EXT = ".midx"
+INDEX_MAGIC = b"MSGIDX02"
+INDEX_HEADER_FORMAT = "<8sddQQ"
+DEFAULT_BUCKET_SIZE = 1.0
+
+MSG_FLAG_MORE = 1
+"""The message is followed by another frame of the same multipart message."""
+
+
+class MsgLogBase:
+    """Common interface of all message logs: `timestamps`, `flags`, `len()` and
+    payload access by index."""
+
+    timestamps: npt.NDArray[np.float64]
+    flags: npt.NDArray[np.uint8]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def find_index(self, timestamp: float, side: str = "left") -> int:
+        """Same as `np.searchsorted(self.timestamps, timestamp, side)`."""
+        return int(np.searchsorted(self.timestamps, timestamp, side=side))
+
+
+class SeekIndex:
+    """Memory-mapped `.midx` sidecar of a `.mlog`."""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.data = np.memmap(file_path, dtype=np.uint8, mode="r")
+        magic, bucket_size, start_time, bucket_num, msg_num = struct.unpack_from(
+            INDEX_HEADER_FORMAT, self.data, 0
+        )
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{file_path} is not a message log index")
+        self.bucket_size = bucket_size
+        self.start_time = start_time
+        self.bucket_num = bucket_num
+        self.msg_num = msg_num
+        self.msg_indices: npt.NDArray[np.uint64] = self.data[
+            HEADER_SIZE : HEADER_SIZE + 8 * (bucket_num + 1)
+        ].view(np.uint64)
+
+    def bucket_range(self, timestamp: float) -> Tuple[int, int]:
+        """Message index range that contains every message with timestamps in the
+        same bucket as `timestamp`."""
+        bucket = int(np.floor((timestamp - self.start_time) / self.bucket_size))
+        if bucket < 0:
+            return 0, 0
+        if bucket >= self.bucket_num:
+            return self.msg_num, self.msg_num
+        return int(self.msg_indices[bucket]), int(self.msg_indices[bucket + 1])
+
+
+def write_seek_index(
+    file_path: str,
+    timestamps: npt.NDArray[np.float64],
+    bucket_size: float = DEFAULT_BUCKET_SIZE,
+):
+    """`timestamps` must be sorted."""
+    if len(timestamps) == 0:
+        start_time, bucket_num = 0.0, 0
+    else:
+        start_time = float(np.floor(timestamps[0] / bucket_size) * bucket_size)
+        bucket_num = int((timestamps[-1] - start_time) // bucket_size) + 1
+    edges = start_time + bucket_size * np.arange(bucket_num + 1)
+    msg_indices = np.searchsorted(timestamps, edges, side="left").astype(np.uint64)
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        header = struct.pack(
+            INDEX_HEADER_FORMAT,
+            INDEX_MAGIC,
+            bucket_size,
+            start_time,
+            bucket_num,
+            len(timestamps),
+        )
+        f.write(header.ljust(HEADER_SIZE, b"\0"))
+        f.write(msg_indices.tobytes())
+    os.replace(tmp_path, file_path)
+
+
+class MsgLog(MsgLogBase):
+    """Read-only, memory-mapped view of a `.mlog` file."""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        if os.path.getsize(file_path) < HEADER_SIZE:
+            raise ValueError(f"{file_path} is too small to be a message log")
+        self.data = np.memmap(file_path, dtype=np.uint8, mode="r")
+        magic, count, blob_size = struct.unpack_from(HEADER_FORMAT, self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{file_path} is not a message log (magic {magic!r})")
+        timestamps_start = HEADER_SIZE
+        offsets_start = timestamps_start + 8 * count
+        flags_start = offsets_start + 8 * (count + 1)
+        blob_start = flags_start + padded_size(count)
+        self.timestamps: npt.NDArray[np.float64] = self.data[
+            timestamps_start:offsets_start
+        ].view(np.float64)
+        # The offsets end where the flags start, not at the blob
+        self.offsets: npt.NDArray[np.uint64] = self.data[
+            offsets_start:flags_start
+        ].view(np.uint64)
+        self.flags: npt.NDArray[np.uint8] = self.data[flags_start : flags_start + count]
+        self.blob = self.data[blob_start : blob_start + blob_size]
+        self.seek_index = self.load_seek_index()
+
+    def load_seek_index(self) -> Optional[SeekIndex]:
+        """Opens the `.midx` sidecar, (re)building it if it is missing or stale."""
+        index_path = self.file_path[: -len(MSG_LOG_EXT)] + INDEX_EXT
+        if os.path.exists(index_path) and os.path.getmtime(
+            index_path
+        ) >= os.path.getmtime(self.file_path):
+            try:
+                seek_index = SeekIndex(index_path)
+            except ValueError:
+                seek_index = None  # Older format
+            if seek_index is not None and seek_index.msg_num == len(self):
+                return seek_index
+        print(f"Building seek index {index_path}")
+        try:
+            write_seek_index(index_path, self.timestamps)
+        except OSError as e:
+            print(f"Failed to write {index_path}, seeking without index: {e}")
+            return None
+        return SeekIndex(index_path)
+
+    def __getitem__(self, idx: int) -> memoryview:
+        """Zero-copy view of payload `idx`."""
+        return memoryview(self.blob[self.offsets[idx] : self.offsets[idx + 1]])
+
+    def find_index(self, timestamp: float, side: str = "left") -> int:
+        if self.seek_index is None:
+            return super().find_index(timestamp, side)
+        lo, hi = self.seek_index.bucket_range(timestamp)
+        return lo + int(np.searchsorted(self.timestamps[lo:hi], timestamp, side=side))
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes
+
+
+class InMemoryMsgLog(MsgLogBase):
+    """Same interface as `MsgLog` for messages that are already in memory, e.g. a
+    legacy pickled log."""
+
+    def __init__(self, msgs: Sequence[Tuple[float, bytes]]):
+        timestamps = np.array([t for t, _ in msgs], dtype=np.float64)
+        order = np.argsort(timestamps, kind="stable")
+        if np.any(order != np.arange(len(order))):
+            print("Warning: timestamps are not in ascending order. Will be sorted")
+        self.timestamps = timestamps[order]
+        self.payloads: List[bytes] = [msgs[i][1] for i in order]
+        self.flags = np.zeros(len(msgs), dtype=np.uint8)
+
+    def __getitem__(self, idx: int) -> bytes:
+        return self.payloads[idx]
+
+    @property
+    def nbytes(self) -> int:
+        return self.timestamps.nbytes + sum(len(payload) for payload in self.payloads)
+
+
+class MsgJournal(MsgLogBase):
+    """Read-only view of a `.mjournal` file with the same interface as `MsgLog`.
+    Only timestamps and payload offsets are kept in memory; payloads are sliced out of
+    a memory map. Records are in arrival order, so timestamps are ascending."""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.valid_size = len(JOURNAL_MAGIC)
+        """Size of the journal up to the end of the last complete record."""
+        timestamps: List[float] = []
+        payload_offsets: List[int] = []
+        payload_lengths: List[int] = []
+        flags: List[int] = []
+        file_size = os.path.getsize(file_path)
+        if file_size < len(JOURNAL_MAGIC):
+            self.data = np.zeros(0, dtype=np.uint8)
+        else:
+            self.data = np.memmap(file_path, dtype=np.uint8, mode="r")
+            if bytes(self.data[: len(JOURNAL_MAGIC)]) != JOURNAL_MAGIC:
+                raise ValueError(f"{file_path} is not a message journal")
+            pos = len(JOURNAL_MAGIC)
+            while pos + RECORD_HEADER_SIZE <= file_size:
+                timestamp, length, flag = struct.unpack_from(
+                    RECORD_HEADER_FORMAT, self.data, pos
+                )
+                payload_start = pos + RECORD_HEADER_SIZE
+                if payload_start + length > file_size:
+                    break
+                timestamps.append(timestamp)
+                payload_offsets.append(payload_start)
+                payload_lengths.append(length)
+                flags.append(flag)
+                pos = payload_start + length
+            self.valid_size = pos
+        self.timestamps = np.array(timestamps, dtype=np.float64)
+        self.payload_offsets = np.array(payload_offsets, dtype=np.int64)
+        self.payload_lengths = np.array(payload_lengths, dtype=np.int64)
+        self.flags = np.array(flags, dtype=np.uint8)
+
+    def __getitem__(self, idx: int) -> memoryview:
+        start = self.payload_offsets[idx]
+        return memoryview(self.data[start : start + self.payload_lengths[idx]])
+
+
+class MsgJournalWriter:
+    """Appends length-prefixed records to a `.mjournal` file. Records are buffered and
+    reach the disk on `flush`, which the recorder calls every `save_msgs_interval`."""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.file = open(file_path, "wb")
+        self.file.write(JOURNAL_MAGIC)
+        self.record_num = 0
+        self.last_flush_time = time.monotonic()
+        self.sync_lock = threading.Lock()
+        """`sync` and `close` may run in executor threads at the same time."""
+
+    def append(
+        self, timestamp: float, payload: Union[bytes, memoryview], more: bool = False
+    ):
+        """Appends one message, or one frame of a multipart message with `more` set
+        on every frame but the last."""
+        flags = MSG_FLAG_MORE if more else 0
+        self.file.write(
+            struct.pack(RECORD_HEADER_FORMAT, timestamp, len(payload), flags)
+        )
+        self.file.write(payload)
+        self.record_num += 1
+
+    def flush(self):
+        """Hands buffered records to the OS. Cheap, call from the receiving thread."""
+        self.file.flush()
+        self.last_flush_time = time.monotonic()
+
+    def sync(self):
+        """Forces flushed records to disk. May block, so it can run in an executor
+        while the receiving thread keeps appending."""
+        with self.sync_lock:
+            if not self.file.closed:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        """Flushes, syncs and closes the file. Blocks on fsync, so the recorder
+        calls it from an executor."""
+        with self.sync_lock:
+            if self.file.closed:
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+
+class ChainedMsgLog(MsgLogBase):
+    """Several logs viewed back to back, e.g. an existing log plus a new journal."""
+
+    def __init__(self, msg_logs: Sequence["AnyMsgLog"]):
+        self.msg_logs = list(msg_logs)
+        self.timestamps = np.concatenate(
+            [msg_log.timestamps for msg_log in self.msg_logs] + [np.zeros(0)]
+        )
+        self.flags = np.concatenate(
+            [msg_log.flags for msg_log in self.msg_logs]
+            + [np.zeros(0, dtype=np.uint8)]
+        )
+        self.starts = np.cumsum([0] + [len(msg_log) for msg_log in self.msg_logs])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, idx: int):
+        log_idx = int(np.searchsorted(self.starts, idx, side="right")) - 1
+        return self.msg_logs[log_idx][idx - self.starts[log_idx]]
+
+
+AnyMsgLog = Union[MsgLog, InMemoryMsgLog, MsgJournal, ChainedMsgLog]
+
+
+def padded_size(size: int, alignment: int = 8) -> int:
+    return (size + alignment - 1) // alignment * alignment
+
+
+def write_msg_log(
+    file_path: str,
+    timestamps: Union[Sequence[float], npt.NDArray[np.float64]],
+    payloads: Sequence[Union[bytes, memoryview]],
+    flags: Optional[npt.NDArray[np.uint8]] = None,
+):
+    """Writes messages to `file_path`, sorting them by timestamp if needed. The sort
+    is stable, so frames of a multipart message (same timestamp) stay together."""
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    assert len(timestamps) == len(payloads), "Each payload needs a timestamp"
+    if flags is None:
+        flags = np.zeros(len(timestamps), dtype=np.uint8)
+    order = np.argsort(timestamps, kind="stable")
+    lengths = np.array([len(payloads[i]) for i in order], dtype=np.uint64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.uint64)
+    np.cumsum(lengths, out=offsets[1:])
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        header = struct.pack(HEADER_FORMAT, MAGIC, len(timestamps), int(offsets[-1]))
+        f.write(header.ljust(HEADER_SIZE, b"\0"))
+        f.write(timestamps[order].tobytes())
+        f.write(offsets.tobytes())
+        sorted_flags = np.asarray(flags, dtype=np.uint8)[order]
+        f.write(sorted_flags.tobytes().ljust(padded_size(len(sorted_flags)), b"\0"))
+        for i in order:
+            f.write(payloads[i])
+    os.replace(tmp_path, file_path)
+    if file_path.endswith(MSG_LOG_EXT):
+        write_seek_index(file_path[: -len(MSG_LOG_EXT)] + INDEX_EXT, timestamps[order])
+
+
+def load_pkl_msgs(file_path: str) -> InMemoryMsgLog:
+    with open(file_path, "rb") as f:
+        loaded_msgs: List[Tuple[float, bytes]] = pickle.load(f)
+    return InMemoryMsgLog(loaded_msgs)
+
+
+def open_msg_log(file_path: str) -> AnyMsgLog:
+    if file_path.endswith(LEGACY_MSG_LOG_EXT):
+        return load_pkl_msgs(file_path)
+    return MsgLog(file_path)
+
+
+class MsgLogCache:
+    """LRU cache of opened message logs, keyed by path, mtime and size so a log that
+    is rewritten (e.g. appended to) is reopened. Logs are evicted, least recently used
+    first, once their total `nbytes` exceeds `memory_budget`; the most recently used
+    log is always kept. Thread-safe, so logs can be opened in an executor."""
+
+    def __init__(self, memory_budget: int = 1 << 30):
+        self.memory_budget = memory_budget
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, Tuple[Tuple[int, int], int, AnyMsgLog]]" = (
+            OrderedDict()
+        )
+        """file path -> ((mtime, size), nbytes, msg log), least recently used first"""
+        self.nbytes = 0
+        self.hit_num = 0
+        self.miss_num = 0
+
+    def get(self, file_path: str) -> AnyMsgLog:
+        stat = os.stat(file_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(file_path)
+                self.hit_num += 1
+                return entry[2]
+        # Open outside the lock, loading a large pickled log takes a while
+        msg_log = open_msg_log(file_path)
+        nbytes = msg_log.nbytes
+        with self.lock:
+            self.miss_num += 1
+            entry = self.entries.pop(file_path, None)
+            if entry is not None:
+                self.nbytes -= entry[1]
+            self.entries[file_path] = (version, nbytes, msg_log)
+            self.nbytes += nbytes
+            self.evict()
+        return msg_log
+
+    def contains(self, file_path: str) -> bool:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return False
+        with self.lock:
+            entry = self.entries.get(file_path)
+            return entry is not None and entry[0] == (stat.st_mtime_ns, stat.st_size)
+
+    def evict(self):
+        while self.nbytes > self.memory_budget and len(self.entries) > 1:
+            file_path, (_, nbytes, _) = self.entries.popitem(last=False)
+            self.nbytes -= nbytes
+            print(f"Evicted {file_path} from the message log cache")
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+def recover_journal(journal_path: str) -> MsgJournal:
+    """Truncates a torn final record left behind by a crash and returns the journal."""
+    journal = MsgJournal(journal_path)
+    file_size = os.path.getsize(journal_path)
+    if journal.valid_size < file_size:
+        print(
+            f"Truncating {file_size - journal.valid_size} bytes of a torn record from {journal_path}"
+        )
+        valid_size = journal.valid_size
+        del journal  # Release the memory map before shrinking the file
+        with open(journal_path, "r+b") as f:
+            f.truncate(valid_size)
+        journal = MsgJournal(journal_path)
+    return journal
+
+
+def convert_journal_to_msg_log(
+    journal_path: str, output_path: str = "", prev_msg_log: Optional[AnyMsgLog] = None
+) -> int:
+    """Writes the journal (after `prev_msg_log`, if given) to a `.mlog` and removes the
+    journal. Returns the number of messages written."""
+    if output_path == "":
+        output_path = journal_path[: -len(JOURNAL_EXT)] + MSG_LOG_EXT
+    journal = recover_journal(journal_path)
+    msg_log: AnyMsgLog = journal
+    if prev_msg_log is not None:
+        msg_log = ChainedMsgLog([prev_msg_log, journal])
+    msg_num = len(msg_log)
+    if msg_num > 0:
+        write_msg_log(output_path, msg_log.timestamps, msg_log, msg_log.flags)
+    del journal, msg_log
+    os.remove(journal_path)
+    return msg_num
+
+
+def convert_pkl_to_msg_log(pkl_path: str, output_path: str = "") -> str:
+    if output_path == "":
+        output_path = pkl_path[: -len(LEGACY_MSG_LOG_EXT)] + MSG_LOG_EXT
+    msg_log = load_pkl_msgs(pkl_path)
+    write_msg_log(output_path, msg_log.timestamps, msg_log.payloads, msg_log.flags)
+    print(f"Converted {len(msg_log)} msgs from {pkl_path} to {output_path}")
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=f"Convert pickled message logs to the {MSG_LOG_EXT} format"
+    )
+    parser.add_argument("pkl_files", nargs="+")
+    args = parser.parse_args()
+    for pkl_file in args.pkl_files:
+        convert_pkl_to_msg_log(pkl_file)
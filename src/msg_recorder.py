@@ -2,15 +2,26 @@ import asyncio
 import logging
 import os
 from pathlib import Path
-import pickle
 import time
 from datetime import datetime
-from typing import List, Optional, Tuple
+from typing import Dict, Optional, Sequence, Set, Tuple
 
-import numpy as np
 import pytz
 import zmq.asyncio
 
+from msg_log import (
+    JOURNAL_EXT,
+    LEGACY_MSG_LOG_EXT,
+    MSG_FLAG_MORE,
+    MSG_LOG_EXT,
+    AnyMsgLog,
+    InMemoryMsgLog,
+    MsgJournalWriter,
+    MsgLogCache,
+    convert_journal_to_msg_log,
+    open_msg_log,
+)
+
 
 class MsgRecorder:
     def __init__(
@@ -20,6 +31,11 @@ class MsgRecorder:
         data_dir: str = str(Path(__file__).parent.parent) + "/recordings",
         save_msgs_interval: float = 1.0,
         time_zone: str = "America/Los_Angeles",
+        receive_batch_size: int = 1000,
+        zero_copy_receive: bool = False,
+        progress_interval: float = 1.0,
+        msg_cache_budget: int = 1 << 30,
+        replay_send_hwm: int = 100000,
     ):
         self.server_ip = server_ip
         self.server_port = server_port
@@ -32,13 +48,33 @@ class MsgRecorder:
         if not os.path.exists(data_dir + "/messages"):
             os.makedirs(data_dir + "/messages")
         self.save_msgs_interval = save_msgs_interval
+        self.receive_batch_size = receive_batch_size
+        """Max messages drained per wakeup before yielding to the event loop."""
+        self.zero_copy_receive = zero_copy_receive
+        """Receive into `zmq.Frame`s and journal their buffers directly. Only pays off
+        for large payloads (roughly above 64 kB)."""
+        self.progress_interval = progress_interval
         self.receive_start_time_global = time.time()
-        self.received_msgs: List[Tuple[float, bytes]] = []
+        self.received_msg_num = 0
+        self.receive_file_name = ""
+        self.receive_start_monotonic = time.monotonic()
+        """Origin of the timestamps of the log being recorded."""
+        self.journal_writer: Optional[MsgJournalWriter] = None
+        self.rollover: Optional[Tuple[str, float]] = None
+        """(next file name, boundary on the `time.monotonic()` clock) of a pending
+        rollover."""
+        self.saving_futures: Set[asyncio.Future] = set()
+        """Journals being closed and converted in the executor."""
         self.receiving_task: Optional[asyncio.Task] = None
-        self.replay_msgs: List[Tuple[float, bytes]] = []
+        self.flushing_task: Optional[asyncio.Task] = None
+        self.replay_msgs: AnyMsgLog = InMemoryMsgLog([])
         self.replaying_task: Optional[asyncio.Task] = None
         self.replaying_file_name = ""
         self.replaying_idx = 0
+        self.msg_log_cache = MsgLogCache(memory_budget=msg_cache_budget)
+        self.loading_futures: Dict[str, asyncio.Future] = {}
+        """Logs being opened in the executor, shared by everyone waiting for them."""
+        self.replay_switch_lock = asyncio.Lock()
 
         # To be updated during the video replaying. These values should be updated simultaneously.
         self.update_local_time = time.monotonic()
@@ -48,131 +84,410 @@ class MsgRecorder:
         """The most recent local timestamp of the video being replayed."""
         self.video_is_playing = False
         """Whether the video in the browser is playing or paused."""
+        self.video_playback_rate = 1.0
+        """Playback rate of the video in the browser."""
+        self.replay_time_offset = 0.0
+        """Message log time at video time 0 of the recording being replayed."""
 
         self.replay_backtrack_time = 0.1
+        self.jump_threshold = 0.5
+        """A clock update further than this from the extrapolated video time (in
+        seconds) is treated as a seek."""
+        self.replay_spin_time = 0.001
+        """How long before a message is due the scheduler stops sleeping and yields
+        instead, trading a little CPU for sub-millisecond send timing."""
+        self.cursor_jumped = False
+        self.clock_updated = asyncio.Event()
+        self.playback_rate_range = (0.25, 16.0)
+        self.replay_batch_size = 1000
+        """Messages sent in one burst before yielding to the event loop."""
+        self.replay_send_hwm = replay_send_hwm
+        """Messages queued per subscriber before replay drops messages for all of
+        them. The default holds about 6 s of a 1 kHz stream fast-forwarded at the
+        maximum 16x (16000 messages per second), so a subscriber that stalls briefly
+        loses nothing, while a dead one cannot grow the queue without bound. 0 means
+        no limit."""
+        self.send_socket: Optional[zmq.Socket] = None
+        """Synchronous view of `pub_socket` for non-awaiting burst sends."""
+        self.replay_dropped_msg_num = 0
+        """Messages not sent because a subscriber was at the high-water mark."""
+        self.last_drop_report_time = 0.0
 
         self.time_zone = pytz.timezone(time_zone)
 
+        self.recover_journals()
+
     async def run_receive(self):
         self.sub_socket = self.context.socket(zmq.SUB)
         self.sub_socket.connect(f"tcp://{self.server_ip}:{self.server_port}")
         self.sub_socket.setsockopt_string(zmq.SUBSCRIBE, "")
 
-        start_receive_time = time.monotonic()
+        # Synchronous view of the same socket, for non-blocking drains without
+        # creating a future per message
+        drain_socket = zmq.Socket.shadow(self.sub_socket.underlying)
+        copy = not self.zero_copy_receive
+
+        last_progress_time = time.monotonic()
         while True:
-            received_bytes = await self.sub_socket.recv(flags=0)
-            if isinstance(received_bytes, bytes):
-                self.received_msgs.append(
-                    (time.monotonic() - start_receive_time, received_bytes)
+            await self.sub_socket.poll(flags=zmq.POLLIN)
+            for _ in range(self.receive_batch_size):
+                try:
+                    frames = drain_socket.recv_multipart(flags=zmq.NOBLOCK, copy=copy)
+                except zmq.Again:
+                    break
+                # Stamped one by one rather than once per batch: messages keep
+                # arriving while a large batch is drained, and a single stamp would
+                # replay them all as one burst. Messages that were already queued
+                # when the loop woke up can only be stamped as they are drained.
+                receive_time = time.monotonic()
+                if self.rollover is not None:
+                    self.maybe_rollover(receive_time)
+                journal_writer = self.journal_writer
+                if journal_writer is None:
+                    continue
+                timestamp = receive_time - self.receive_start_monotonic
+                last_frame_idx = len(frames) - 1
+                for i, frame in enumerate(frames):
+                    journal_writer.append(
+                        timestamp,
+                        frame if copy else frame.buffer,
+                        more=i < last_frame_idx,
+                    )
+                self.received_msg_num += 1
+            now = time.monotonic()
+            if now - last_progress_time > self.progress_interval:
+                last_progress_time = now
+                print(
+                    f"Time elapsed: {now - self.receive_start_monotonic:.3f}, received {self.received_msg_num} msgs",
+                    end="\r",
                 )
-            print(
-                f"Time elapsed: {time.monotonic() - start_receive_time:.3f}", end="\r"
-            )
 
-    def start_receive(self):
+    async def run_flush(self):
+        """Pushes the journal to disk every `save_msgs_interval`, so a crash or power
+        loss costs at most one interval of messages."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.save_msgs_interval)
+            # Roll over even if no message arrives
+            self.maybe_rollover(time.monotonic())
+            journal_writer = self.journal_writer
+            if journal_writer is None:
+                continue
+            journal_writer.flush()
+            # fsync may block for a while, keep receiving in the meantime
+            await loop.run_in_executor(None, journal_writer.sync)
+
+    def start_receive(self, file_name: str = ""):
         self.receive_start_time_global = time.time()
-        self.received_msgs = []
+        if file_name == "":
+            file_name = datetime.fromtimestamp(
+                self.receive_start_time_global, self.time_zone
+            ).strftime("%Y%m%d_%H%M%S")
         if (
             self.receiving_task is None
             or self.receiving_task.done()
             or self.receiving_task.cancelled()
         ):
+            self.receive_file_name = self.strip_msg_file_ext(file_name)
+            self.received_msg_num = 0
+            self.receive_start_monotonic = time.monotonic()
+            self.rollover = None
+            self.journal_writer = MsgJournalWriter(
+                f"{self.msg_dir}/{self.receive_file_name}{JOURNAL_EXT}"
+            )
             self.receiving_task = asyncio.create_task(self.run_receive())
+            self.flushing_task = asyncio.create_task(self.run_flush())
 
-    def stop_receive(self, data_file_name: str = ""):
+    def stop_receive(self, stop_time: Optional[float] = None):
+        """Stops receiving at `stop_time` (`time.monotonic()`, now by default). A
+        pending rollover at or before it is applied first, so every journal is
+        converted under the name it was recorded for."""
         if self.receiving_task is not None:
             self.receiving_task.cancel()
             self.receiving_task = None
+        if self.flushing_task is not None:
+            self.flushing_task.cancel()
+            self.flushing_task = None
         if self.sub_socket is not None and not self.sub_socket.closed:
             self.sub_socket.close()
-        if self.received_msgs:
-            self.save_msgs(data_file_name)
-        else:
+        if self.journal_writer is None:
+            return
+        self.maybe_rollover(time.monotonic() if stop_time is None else stop_time)
+        # A rollover past the stop time is never reached
+        self.rollover = None
+        self.finish_journal(self.journal_writer, self.receive_file_name)
+        self.journal_writer = None
+
+    def finish_journal(self, journal_writer: MsgJournalWriter, data_file_name: str):
+        """Closes a receive journal and converts it to `data_file_name`, in the
+        executor if there is a running event loop. `wait_saved` waits for that."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.close_journal(journal_writer, data_file_name)
+            return
+        # fsync and converting a long journal take a while, keep the event loop
+        # responsive
+        future = loop.run_in_executor(
+            None, self.close_journal, journal_writer, data_file_name
+        )
+        self.saving_futures.add(future)
+        future.add_done_callback(self.on_journal_saved)
+
+    def close_journal(self, journal_writer: MsgJournalWriter, data_file_name: str):
+        journal_writer.close()
+        journal_path = journal_writer.file_path
+        if journal_writer.record_num == 0:
+            os.remove(journal_path)
             print("No message recorded.")
+            return
+        self.save_msgs(data_file_name, journal_path=journal_path)
+
+    def on_journal_saved(self, future: asyncio.Future):
+        self.saving_futures.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            # The journal stays on disk and is recovered on the next start
+            print(f"Failed to save messages: {future.exception()!r}")
+
+    async def wait_saved(self):
+        """Waits until every finished journal is converted, e.g. before exiting."""
+        while self.saving_futures:
+            await asyncio.gather(*self.saving_futures, return_exceptions=True)
+
+    def request_rollover(self, file_name: str, boundary: float):
+        """Continues receiving into `file_name` from `boundary` (`time.monotonic()`)
+        on. Messages of the new log are timed from the boundary."""
+        self.rollover = (self.strip_msg_file_ext(file_name), boundary)
+
+    def maybe_rollover(self, now: float):
+        rollover = self.rollover
+        if rollover is None or now < rollover[1] or self.journal_writer is None:
+            return
+        self.rollover = None
+        file_name, boundary = rollover
+        self.finish_journal(self.journal_writer, self.receive_file_name)
+        self.receive_file_name = file_name
+        self.receive_start_monotonic = boundary
+        self.journal_writer = MsgJournalWriter(
+            f"{self.msg_dir}/{file_name}{JOURNAL_EXT}"
+        )
+
+    def update_video_clock(
+        self,
+        video_timestamp: float,
+        is_playing: bool,
+        browser_timestamp: float,
+        local_time: Optional[float] = None,
+        playback_rate: float = 1.0,
+    ):
+        """Called whenever the browser reports its playback state. Wakes the replay
+        scheduler so pause, play, seeks and rate changes take effect immediately."""
+        if local_time is None:
+            local_time = time.monotonic()
+        # Decide whether cursor is jumped either forward or backward
+        browser_elapsed_time = browser_timestamp - self.browser_global_timestamp
+        video_elapsed_time = video_timestamp - self.video_replay_timestamp
+        expected_video_elapsed_time = (
+            browser_elapsed_time * self.video_playback_rate
+            if self.video_is_playing
+            else 0.0
+        )
+        if abs(video_elapsed_time - expected_video_elapsed_time) > self.jump_threshold:
+            self.cursor_jumped = True
+            print(
+                f"Cursor jumped from {self.current_video_time():.3f} to {video_timestamp:.3f}"
+            )
+
+        self.update_local_time = local_time
+        self.browser_global_timestamp = browser_timestamp
+        self.video_replay_timestamp = video_timestamp
+        self.video_is_playing = is_playing
+        self.video_playback_rate = min(
+            max(playback_rate, self.playback_rate_range[0]), self.playback_rate_range[1]
+        )
+        self.clock_updated.set()
+
+    def current_video_time(self) -> float:
+        if not self.video_is_playing:
+            return self.video_replay_timestamp
+        return (
+            self.video_replay_timestamp
+            + (time.monotonic() - self.update_local_time) * self.video_playback_rate
+        )
+
+    def current_msg_time(self) -> float:
+        """The video clock on the time axis of the replayed message log."""
+        return self.current_video_time() + self.replay_time_offset
+
+    async def wait_clock_update(self, timeout: Optional[float]):
+        """Sleeps until `timeout` expires or the video clock changes."""
+        try:
+            await asyncio.wait_for(self.clock_updated.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.clock_updated.clear()
+
+    def open_pub_socket(self):
+        # A PUB socket silently drops messages at the HWM. XPUB with XPUB_NODROP
+        # raises zmq.Again instead, so drops can be counted. Subscribers connect to
+        # it the same way.
+        self.pub_socket = self.context.socket(zmq.XPUB)
+        self.pub_socket.setsockopt(zmq.SNDHWM, self.replay_send_hwm)
+        self.pub_socket.setsockopt(zmq.XPUB_NODROP, 1)
+        self.pub_socket.bind(f"tcp://*:{self.server_port}")
+        self.send_socket = zmq.Socket.shadow(self.pub_socket.underlying)
+
+    async def send_replay_msgs(self, start_idx: int, stop_idx: int):
+        """Sends messages `[start_idx, stop_idx)` as non-awaiting bursts. A message
+        that does not fit because a subscriber is at `replay_send_hwm` is dropped
+        and counted in `replay_dropped_msg_num`, rather than stalling the replay
+        for everyone."""
+        flags = self.replay_msgs.flags
+        # Whether the rest of the current multipart message is being dropped
+        dropping = False
+        for batch_start in range(start_idx, stop_idx, self.replay_batch_size):
+            batch_stop = min(batch_start + self.replay_batch_size, stop_idx)
+            for i in range(batch_start, batch_stop):
+                more = bool(flags[i] & MSG_FLAG_MORE)
+                if not dropping:
+                    try:
+                        self.send_socket.send(
+                            self.replay_msgs[i],
+                            flags=(zmq.SNDMORE if more else 0) | zmq.NOBLOCK,
+                            copy=False,
+                        )
+                    except zmq.Again:
+                        # Only the first frame can be refused: the HWM counts
+                        # whole messages
+                        dropping = True
+                if dropping and not more:
+                    dropping = False
+                    self.replay_dropped_msg_num += 1
+            await asyncio.sleep(0)
+        now = time.monotonic()
+        if (
+            self.replay_dropped_msg_num > 0
+            and now - self.last_drop_report_time > self.progress_interval
+        ):
+            self.last_drop_report_time = now
+            print(
+                f"Replay dropped {self.replay_dropped_msg_num} msgs, a subscriber is "
+                "not keeping up"
+            )
 
     async def run_replay(self):
-        recorded_timestamps = np.array([t for t, _ in self.replay_msgs])
+        """Sends each message when the video clock reaches its timestamp. Between
+        messages the task sleeps until the next one is due, or until
+        `update_video_clock` reports a pause, play or seek."""
+        recorded_timestamps = self.replay_msgs.timestamps
         if len(recorded_timestamps) <= 1:
             print("No message loaded, failed to start replaying.")
             return
 
-        self.pub_socket = self.context.socket(zmq.PUB)
-        self.pub_socket.bind(f"tcp://*:{self.server_port}")
+        self.open_pub_socket()
 
-        prev_browser_time = self.browser_global_timestamp
-        prev_video_time = self.video_replay_timestamp
-        prev_end_idx = int(np.searchsorted(recorded_timestamps, prev_video_time))
-        cursor_jumped = False
+        next_idx = self.replay_msgs.find_index(self.current_msg_time())
+        self.cursor_jumped = False
         while True:
-            current_video_time = (
-                self.video_replay_timestamp + time.monotonic() - self.update_local_time
-            )
+            if self.cursor_jumped:
+                self.cursor_jumped = False
+                # Resend the backtrack window before the new cursor position
+                next_idx = self.replay_msgs.find_index(
+                    max(0, self.current_msg_time() - self.replay_backtrack_time)
+                )
+            self.replaying_idx = next_idx
+            if not self.video_is_playing or next_idx >= len(recorded_timestamps):
+                await self.wait_clock_update(None)
+                continue
 
-            # Decide whether cursor is jumped either forward or backward
-            browser_elapsed_time = self.browser_global_timestamp - prev_browser_time
-            video_elapsed_time = self.video_replay_timestamp - prev_video_time
+            current_msg_time = self.current_msg_time()
+            due_idx = self.replay_msgs.find_index(current_msg_time, side="right")
+            if due_idx > next_idx:
+                await self.send_replay_msgs(next_idx, due_idx)
+                next_idx = due_idx
+                continue
 
-            elapsed_time_diff = browser_elapsed_time - video_elapsed_time
-            if abs(elapsed_time_diff) > 0.5 and abs(video_elapsed_time) > 0.5:
-                cursor_jumped = True
-                print(
-                    f"Cursor jumped from {prev_video_time:.3f} to {current_video_time:.3f}"
-                )
+            delay = (
+                recorded_timestamps[next_idx] - current_msg_time
+            ) / self.video_playback_rate
+            if delay > self.replay_spin_time:
+                # Event loop timers are only accurate to about a millisecond, so wake
+                # up slightly early and yield until the message is due
+                await self.wait_clock_update(delay - self.replay_spin_time)
             else:
-                cursor_jumped = False
+                await asyncio.sleep(0)
 
-            prev_browser_time = self.browser_global_timestamp
-            prev_video_time = self.video_replay_timestamp
-            current_idx = int(np.searchsorted(recorded_timestamps, current_video_time))
-            if self.video_is_playing:
-                print(
-                    f"msg_recorder: video replay {self.video_replay_timestamp:.3f}, {current_video_time=:.3f}, {current_idx=}, {prev_end_idx=}"
-                )
-                if cursor_jumped:
-                    prev_end_idx = int(
-                        np.searchsorted(
-                            recorded_timestamps,
-                            max(0, current_video_time - self.replay_backtrack_time),
-                        )
-                    )
+    def strip_msg_file_ext(self, file_name: str) -> str:
+        for ext in (MSG_LOG_EXT, LEGACY_MSG_LOG_EXT):
+            if file_name.endswith(ext):
+                return file_name[: -len(ext)]
+        return file_name
 
-                if current_idx < prev_end_idx:
-                    print(
-                        "Warning: cursor jumped back in time but cursor_jumped is False. Will not send any messages."
-                    )
-                    await asyncio.sleep(0.01)
+    def msg_file_path(self, file_name: str) -> str:
+        """Path of the log for `file_name`, preferring the columnar format over a
+        legacy pickle. Empty if neither exists."""
+        file_name = self.strip_msg_file_ext(file_name)
+        for ext in (MSG_LOG_EXT, LEGACY_MSG_LOG_EXT):
+            if os.path.exists(f"{self.msg_dir}/{file_name}{ext}"):
+                return f"{self.msg_dir}/{file_name}{ext}"
+        return ""
 
-                    continue
+    async def load_msg_log(self, msg_file_path: str) -> AnyMsgLog:
+        """Opens a log through the cache without blocking the event loop. Concurrent
+        requests for the same file wait for a single load."""
+        future = self.loading_futures.get(msg_file_path)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(None, self.msg_log_cache.get, msg_file_path)
+            self.loading_futures[msg_file_path] = future
+            future.add_done_callback(
+                lambda _: self.loading_futures.pop(msg_file_path, None)
+            )
+        # A cancelled waiter must not cancel the load for the others
+        return await asyncio.shield(future)
 
-                # Send all messages between prev_end_idx and current_idx
-                for i in range(prev_end_idx, current_idx):
-                    await self.pub_socket.send(self.replay_msgs[i][1])
-
-                prev_end_idx = current_idx
-            else:  # Video is not playing
-                if cursor_jumped:
-                    prev_end_idx = int(
-                        np.searchsorted(
-                            recorded_timestamps,
-                            max(0, current_video_time - self.replay_backtrack_time),
-                        )
-                    )
-            self.replaying_idx = prev_end_idx
-            await asyncio.sleep(0.01)
-
-    def start_replay(self, file_name: str):
-        if file_name.endswith(".pkl"):
-            file_name = file_name[:-4]
-        if not os.path.exists(f"{self.msg_dir}/{file_name}.pkl"):
-            print(f"{self.msg_dir}/{file_name}.pkl does not exist.")
+    async def prefetch(self, file_names: Sequence[str]):
+        """Opens the logs of `file_names` (most important first) in the background
+        until the cache budget is used up, so switching to them is instant."""
+        for file_name in file_names:
+            msg_file_path = self.msg_file_path(file_name)
+            if msg_file_path == "" or self.msg_log_cache.contains(msg_file_path):
+                continue
+            if self.msg_log_cache.nbytes >= self.msg_log_cache.memory_budget:
+                break
+            try:
+                await self.load_msg_log(msg_file_path)
+            except (OSError, ValueError) as e:
+                print(f"Failed to prefetch {msg_file_path}: {e}")
+
+    async def switch_replay(self, file_name: str, time_offset: float = 0.0):
+        """Replays `file_name` instead of the current log, if it is not already."""
+        file_name = self.strip_msg_file_ext(file_name)
+        async with self.replay_switch_lock:
+            if self.replaying_file_name == file_name:
+                return
+            if self.replaying_file_name != "":
+                self.stop_replay()
+            if self.find_replay_file(file_name):
+                await self.start_replay(file_name, time_offset)
+
+    async def start_replay(self, file_name: str, time_offset: float = 0.0):
+        """Replays the log of `file_name`. `time_offset` is the log time at video
+        time 0."""
+        file_name = self.strip_msg_file_ext(file_name)
+        if not self.find_replay_file(file_name):
+            print(f"{self.msg_dir}/{file_name}{MSG_LOG_EXT} does not exist.")
             return
-        self.load_msgs(file_name)
+        msg_file_path = self.msg_file_path(file_name)
+        self.replay_msgs = await self.load_msg_log(msg_file_path)
+        print(f"Loaded {len(self.replay_msgs)} msgs from {msg_file_path}")
         if len(self.replay_msgs) == 0:
             print("No message loaded, failed to start replaying.")
             return
         # Check whether file_name existed
 
         self.replaying_file_name = file_name
+        self.replay_time_offset = time_offset
         if (
             self.replaying_task is None
             or self.replaying_task.done()
@@ -192,59 +507,64 @@ class MsgRecorder:
             print(f"self.replaying_task is None")
         if self.pub_socket is not None and not self.pub_socket.closed:
             self.pub_socket.close()
-        self.replay_msgs = []
+        self.replay_msgs = InMemoryMsgLog([])
         self.replaying_file_name = ""
 
     def find_replay_file(self, file_name: str):
-        if file_name.endswith(".pkl"):
-            file_name = file_name[:-4]
-        if os.path.exists(f"{self.msg_dir}/{file_name}.pkl"):
-            return True
-        else:
-            return False
+        return self.msg_file_path(file_name) != ""
 
-    def save_msgs(self, file_name: str, enable_append: bool = False):
+    def save_msgs(
+        self, file_name: str, enable_append: bool = False, journal_path: str = ""
+    ):
+        """Converts a receive journal (the current one by default) to a `.mlog`,
+        optionally appending to an existing log of the same name."""
         if file_name == "":
             file_name = datetime.fromtimestamp(
                 self.receive_start_time_global, self.time_zone
             ).strftime("%Y%m%d_%H%M%S")
-        if file_name.endswith(".pkl"):
-            file_name = file_name[:-4]
-        if self.received_msgs:
-            prev_msgs = []
-            if enable_append and os.path.exists(f"{self.msg_dir}/{file_name}.pkl"):
-                with open(f"{self.msg_dir}/{file_name}.pkl", "rb") as f:
-                    prev_msgs = pickle.load(f)
-                print(
-                    f"Loaded {len(prev_msgs)} msgs from {self.msg_dir}/{file_name}.pkl"
-                )
-            with open(f"{self.msg_dir}/{file_name}.pkl", "wb") as f:
-                pickle.dump(prev_msgs + self.received_msgs, f)
-            print(
-                f"Saved {len(prev_msgs + self.received_msgs)} msgs in {self.msg_dir}/{file_name}.pkl"
-            )
-
-            self.received_msgs = []
-            return True
-        else:
+        file_name = self.strip_msg_file_ext(file_name)
+        if journal_path == "":
+            journal_path = f"{self.msg_dir}/{self.receive_file_name}{JOURNAL_EXT}"
+        if not os.path.exists(journal_path):
             return False
+        prev_msg_log = None
+        prev_msg_path = self.msg_file_path(file_name)
+        if enable_append and prev_msg_path:
+            prev_msg_log = open_msg_log(prev_msg_path)
+            print(f"Loaded {len(prev_msg_log)} msgs from {prev_msg_path}")
+        msg_num = convert_journal_to_msg_log(
+            journal_path, f"{self.msg_dir}/{file_name}{MSG_LOG_EXT}", prev_msg_log
+        )
+        print(f"Saved {msg_num} msgs in {self.msg_dir}/{file_name}{MSG_LOG_EXT}")
+        return msg_num > 0
 
-    def load_msgs(self, file_name: str):
-        if file_name.endswith(".pkl"):
-            file_name = file_name[:-4]
-        with open(f"{self.msg_dir}/{file_name}.pkl", "rb") as f:
-            loaded_msgs = pickle.load(f)
-            print(f"Loaded {len(loaded_msgs)} msgs")
-        timestamps = np.array([t for t, _ in loaded_msgs])
-        if np.any(timestamps[1:] < timestamps[:-1]):
-            print("Warning: timestamps are not in ascending order. Will be sorted")
-            self.replay_msgs = sorted(loaded_msgs, key=lambda x: x[0])
-        else:
-            self.replay_msgs = loaded_msgs
+    def recover_journals(self):
+        """Converts journals left behind by a crashed recording."""
+        for journal_file in sorted(os.listdir(self.msg_dir)):
+            if not journal_file.endswith(JOURNAL_EXT):
+                continue
+            file_name = journal_file[: -len(JOURNAL_EXT)]
+            journal_path = f"{self.msg_dir}/{journal_file}"
+            msg_path = f"{self.msg_dir}/{file_name}{MSG_LOG_EXT}"
+            if os.path.exists(msg_path) and os.path.getmtime(
+                msg_path
+            ) >= os.path.getmtime(journal_path):
+                # The log was written from this journal, the crash came before the
+                # journal was removed. Appending it again would duplicate every
+                # message.
+                print(f"{journal_path} was already converted, removing it")
+                os.remove(journal_path)
+                continue
+            print(f"Recovering messages from {journal_path}")
+            self.save_msgs(file_name, enable_append=True, journal_path=journal_path)
 
+    def load_msgs(self, file_name: str):
+        msg_file_path = self.msg_file_path(file_name)
+        self.replay_msgs = self.msg_log_cache.get(msg_file_path)
+        print(f"Loaded {len(self.replay_msgs)} msgs from {msg_file_path}")
 
 if __name__ == "__main__":
     recorder = MsgRecorder("172.24.95.130", 8800, "recordings/messages")
     # asyncio.run(recorder.run())
-    # recorder.load_msgs("20231228_173448.pkl")
+    # recorder.load_msgs("20231228_173448.mlog")
     # asyncio.run(recorder.run_replay())
@@ -0,0 +1,289 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import (
+    AsyncIterator,
+    Any,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import cv2
+
+from frame_bus import SharedFrameCapture
+from frame_capture import FrameCapture, set_future_result
+
+
+class PreviewLevel(NamedTuple):
+    scale: float
+    """Of the preview resolution."""
+    quality: int
+    """JPEG quality, capped at the hub's `quality`."""
+    max_fps: float
+    """0 for every captured frame."""
+
+
+PREVIEW_LEVELS: Tuple[PreviewLevel, ...] = (
+    PreviewLevel(1.0, 100, 0.0),
+    PreviewLevel(0.75, 70, 0.0),
+    PreviewLevel(0.5, 60, 0.0),
+    PreviewLevel(0.5, 50, 15.0),
+    PreviewLevel(0.35, 40, 10.0),
+    PreviewLevel(0.25, 30, 5.0),
+)
+"""From best to cheapest. Each step roughly halves the bytes per second."""
+
+
+class PreviewClient:
+    """Adaptation state of one `/video_feed` subscriber.
+
+    The multipart stream only moves on once the server has handed a part to the
+    socket, so the share of time a subscriber spends sending (`busy_ratio`) tells
+    whether its link keeps up. Close to 1, parts pile up in socket buffers and the
+    viewer falls behind, so the client steps down a level; well below, it steps back
+    up after a while. Both steps wait for the previous one to settle.
+    """
+
+    def __init__(
+        self,
+        client_id: str = "",
+        level: int = 0,
+        adaptive: bool = True,
+        stats_window: float = 2.0,
+    ):
+        self.client_id = client_id
+        self.level = level
+        self.adaptive = adaptive
+        self.stats_window = stats_window
+        self.busy_ratio = 0.0
+        """Exponential moving average of the share of time spent sending."""
+        self.last_sent_time: Optional[float] = None
+        self.last_level_change_time = time.monotonic()
+        self.sent: Deque[Tuple[float, int]] = deque()
+        """(send time, bytes) of the parts sent within `stats_window`."""
+        self.sent_frame_num = 0
+        self.sent_byte_num = 0
+
+    def on_sent(
+        self, nbytes: int, send_start_time: float, now: Optional[float] = None
+    ):
+        """Records a part that took from `send_start_time` until `now` to send."""
+        if now is None:
+            now = time.monotonic()
+        if self.last_sent_time is not None and now > self.last_sent_time:
+            busy = min(1.0, (now - send_start_time) / (now - self.last_sent_time))
+            self.busy_ratio += 0.2 * (busy - self.busy_ratio)
+        self.last_sent_time = now
+        self.sent.append((now, nbytes))
+        while self.sent and self.sent[0][0] < now - self.stats_window:
+            self.sent.popleft()
+        self.sent_frame_num += 1
+        self.sent_byte_num += nbytes
+
+    def adapt(
+        self,
+        level_num: int,
+        now: Optional[float] = None,
+        step_down_ratio: float = 0.7,
+        step_up_ratio: float = 0.25,
+        step_down_interval: float = 1.0,
+        step_up_interval: float = 4.0,
+    ):
+        """Moves one level down or up if the link calls for it."""
+        if not self.adaptive:
+            return
+        if now is None:
+            now = time.monotonic()
+        since_change = now - self.last_level_change_time
+        if (
+            self.busy_ratio > step_down_ratio
+            and since_change >= step_down_interval
+            and self.level < level_num - 1
+        ):
+            self.level += 1
+        elif (
+            self.busy_ratio < step_up_ratio
+            and since_change >= step_up_interval
+            and self.level > 0
+        ):
+            self.level -= 1
+        else:
+            return
+        self.last_level_change_time = now
+        # Judge the new level on its own
+        self.busy_ratio = (step_down_ratio + step_up_ratio) / 2
+
+    @property
+    def fps(self) -> float:
+        return len(self.sent) / self.stats_window
+
+    @property
+    def bitrate(self) -> float:
+        """Bits per second."""
+        return sum(nbytes for _, nbytes in self.sent) * 8 / self.stats_window
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "client": self.client_id,
+            "level": self.level,
+            "fps": round(self.fps, 1),
+            "bitrate": round(self.bitrate),
+            "busy_ratio": round(self.busy_ratio, 2),
+        }
+
+
+class PreviewHub:
+    """JPEG-encodes each captured frame at most once per preview level and broadcasts
+    the same bytes to every `/video_feed` subscriber on that level. Subscribers always
+    get the newest frame, so a slow client skips frames instead of building up a
+    backlog.
+
+    With `adaptive`, every subscriber moves through `levels` (from `PREVIEW_LEVELS`
+    by default) according to how fast its link drains the stream, see
+    `PreviewClient`. Levels nobody is on cost nothing.
+    """
+
+    def __init__(
+        self,
+        capture: Union[FrameCapture, SharedFrameCapture],
+        resolution: Optional[Tuple[int, int]] = None,
+        quality: int = 80,
+        adaptive: bool = True,
+        levels: Sequence[PreviewLevel] = PREVIEW_LEVELS,
+    ):
+        self.capture = capture
+        self.resolution = resolution
+        """(width, height) of the preview. None keeps the capture resolution."""
+        self.quality = quality
+        self.adaptive = adaptive
+        self.levels = list(levels)
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        self.cond = threading.Condition()
+        self.clients: List[PreviewClient] = []
+        self.latest_parts: Dict[int, Tuple[int, bytes]] = {}
+        """Per level, the latest seq and its multipart chunk (boundary, headers and
+        JPEG)."""
+        self.level_encode_times: Dict[int, float] = {}
+        self.encoded_frame_num = 0
+        self.async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    @property
+    def subscriber_num(self) -> int:
+        return len(self.clients)
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def level_size(self, level: PreviewLevel, frame_size: Tuple[int, int]):
+        width, height = self.resolution if self.resolution is not None else frame_size
+        return max(2, round(width * level.scale)), max(2, round(height * level.scale))
+
+    def run(self):
+        seq = -1
+        while not self.stop_event.is_set():
+            with self.cond:
+                # Do not spend any CPU on JPEG while nobody is watching
+                self.cond.wait_for(
+                    lambda: len(self.clients) > 0 or self.stop_event.is_set()
+                )
+                level_idxs = sorted({client.level for client in self.clients})
+            captured = self.capture.wait_for_frame(seq, timeout=0.5)
+            if captured is None:
+                continue
+            seq = captured.seq
+            frame = captured.frame
+            frame_size = (frame.shape[1], frame.shape[0])
+            resized = {frame_size: frame}
+            now = time.monotonic()
+            parts = {}
+            for level_idx in level_idxs:
+                level = self.levels[level_idx]
+                if (
+                    level.max_fps > 0
+                    and now - self.level_encode_times.get(level_idx, 0.0)
+                    < 1 / level.max_fps
+                ):
+                    continue
+                size = self.level_size(level, frame_size)
+                if size not in resized:
+                    resized[size] = cv2.resize(
+                        frame, size, interpolation=cv2.INTER_AREA
+                    )
+                ret, buffer = cv2.imencode(
+                    ".jpg",
+                    resized[size],
+                    [cv2.IMWRITE_JPEG_QUALITY, min(level.quality, self.quality)],
+                )
+                if not ret:
+                    continue
+                self.level_encode_times[level_idx] = now
+                parts[level_idx] = (
+                    b"--frame\r\n"
+                    b"Content-Type: image/jpeg\r\n\r\n" + buffer.tobytes() + b"\r\n"
+                )
+            # `frame` is a view into the capture ring; drop what was encoded from a
+            # slot the capture started overwriting meanwhile
+            if not parts or not self.capture.is_intact(seq):
+                continue
+            with self.cond:
+                for level_idx, part in parts.items():
+                    self.latest_parts[level_idx] = (seq, part)
+                self.encoded_frame_num += 1
+                waiters = self.async_waiters
+                self.async_waiters = []
+            for loop, future in waiters:
+                loop.call_soon_threadsafe(set_future_result, future, None)
+
+    async def wait_for_part(self, level_idx: int, after_seq: int) -> Tuple[int, bytes]:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.cond:
+                latest_seq, part = self.latest_parts.get(level_idx, (-1, b""))
+                if latest_seq > after_seq:
+                    return latest_seq, part
+                future = loop.create_future()
+                self.async_waiters.append((loop, future))
+            await future
+
+    async def subscribe(self, client_id: str = "") -> AsyncIterator[bytes]:
+        client = PreviewClient(client_id, adaptive=self.adaptive)
+        with self.cond:
+            self.clients.append(client)
+            self.cond.notify_all()
+        try:
+            seq = -1
+            while True:
+                seq, part = await self.wait_for_part(client.level, seq)
+                send_start_time = time.monotonic()
+                # Resumes once the server has handed the part to the socket
+                yield part
+                client.on_sent(len(part), send_start_time)
+                with self.cond:
+                    client.adapt(len(self.levels))
+        finally:
+            with self.cond:
+                self.clients.remove(client)
+
+    def client_stats(self) -> List[Dict[str, Any]]:
+        with self.cond:
+            return [client.stats() for client in self.clients]
@@ -0,0 +1,106 @@
+"""Naming and manifest of segmented recording sessions.
+
+A segmented session `<session>` is recorded as segments `<session>_s000`,
+`<session>_s001`, ..., each one a complete recording of its own (video, audio, message
+log and metadata under that name). Segments are cut at shared boundaries on the
+`time.monotonic()` clock, and `<session>_session.json` in the metadata directory lists
+them in order, so the session can be played back as one timeline.
+
+With several cameras, camera 0 records to `<file_name>.mp4` and camera i to
+`<file_name>_cam<i>.mp4`; audio, messages and the manifest stay keyed by
+`<file_name>`.
+"""
+
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+SEGMENT_PATTERN = re.compile(r"^(.+)_s(\d{3,})$")
+CAMERA_PATTERN = re.compile(r"^(.+)_cam(\d+)$")
+
+
+def segment_file_name(session_name: str, segment_idx: int) -> str:
+    return f"{session_name}_s{segment_idx:03d}"
+
+
+def parse_segment_file_name(file_name: str) -> Optional[Tuple[str, int]]:
+    """Returns (session name, segment index), or None if `file_name` (without
+    extension) is not a segment."""
+    match = SEGMENT_PATTERN.match(file_name)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+def camera_file_name(file_name: str, camera_idx: int) -> str:
+    return file_name if camera_idx == 0 else f"{file_name}_cam{camera_idx}"
+
+
+def parse_camera_file_name(file_name: str) -> Tuple[str, int]:
+    """Returns (file name shared by all cameras, camera index)."""
+    match = CAMERA_PATTERN.match(file_name)
+    if match is None:
+        return file_name, 0
+    return match.group(1), int(match.group(2))
+
+
+class SessionManifest:
+    """The `<session>_session.json` file. Every segment entry holds the segment's
+    file name, its `offset` into the session timeline and the video metadata of the
+    segment; the file is rewritten atomically whenever a segment is added."""
+
+    def __init__(self, file_path: str, session_name: str = ""):
+        self.file_path = file_path
+        self.session_name = session_name
+        self.segments: List[Dict[str, Any]] = []
+        self.complete = False
+        """Set when the session has stopped recording."""
+
+    @classmethod
+    def load(cls, file_path: str) -> "SessionManifest":
+        with open(file_path, "r") as f:
+            data = json.load(f)
+        manifest = cls(file_path, data["session_name"])
+        manifest.segments = data["segments"]
+        manifest.complete = data["complete"]
+        return manifest
+
+    @property
+    def duration(self) -> float:
+        if not self.segments:
+            return 0.0
+        return self.segments[-1]["offset"] + self.segments[-1]["duration"]
+
+    def add_segment(self, file_name: str, duration: float, **meta_data: Any):
+        self.segments.append(
+            {
+                "file_name": file_name,
+                "offset": self.duration,
+                "duration": duration,
+                **meta_data,
+            }
+        )
+        self.save()
+
+    def find_segment(self, session_time: float) -> Optional[Dict[str, Any]]:
+        """The segment playing at `session_time` seconds into the session."""
+        for segment in self.segments:
+            if session_time < segment["offset"] + segment["duration"]:
+                return segment
+        return self.segments[-1] if self.segments else None
+
+    def save(self):
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "session_name": self.session_name,
+                    "complete": self.complete,
+                    "duration": self.duration,
+                    "segments": self.segments,
+                },
+                f,
+                indent=2,
+            )
+        os.replace(tmp_path, self.file_path)
@@ -1,17 +1,118 @@
-let reportInterval;
-
 const ws = new WebSocket('ws://' + window.location.host + '/ws');
 
+// High resolution client clock in seconds, immune to wall clock adjustments
+function clientTime() {
+    return (performance.timeOrigin + performance.now()) / 1000;
+}
+
 ws.onmessage = function (event) {
     const data = JSON.parse(event.data);
+    if (data.type === 'ping') {
+        // Answer right away, the server measures the round trip
+        ws.send(JSON.stringify({
+            'type': 'pong',
+            'server_time': data.server_time,
+            'client_time': clientTime(),
+        }));
+        return;
+    }
     document.getElementById('client_ip').textContent = data.client_ip;
     document.getElementById('received_msg_num').textContent = data.received_msg_num;
     document.getElementById('recording_time').textContent = data.recording_time;
+    if (data.merge_jobs) {
+        document.getElementById('merge_status').textContent = data.merge_jobs.map(function (job) {
+            var status = job.file_name + ': ' + job.state;
+            if (job.state === 'done' || job.state === 'failed') {
+                status += ' (' + job.duration.toFixed(1) + ' s';
+                if (job.output_size) {
+                    status += ', ' + (job.output_size / 1024 / 1024).toFixed(1) + ' MB';
+                }
+                status += ')';
+            }
+            return status;
+        }).join('; ');
+    }
+    if (data.preview_clients) {
+        var previewStatus = data.preview_clients.map(function (client) {
+            return client.client + ' cam' + client.camera + ': ' + client.fps.toFixed(1) + ' fps, ' +
+                (client.bitrate / 1e6).toFixed(2) + ' Mbit/s (level ' + client.level + ')';
+        }).concat((data.live_clients || []).map(function (client) {
+            return client.client + ' cam' + client.camera + ' H.264: ' + client.fps.toFixed(1) + ' fps, ' +
+                (client.bitrate / 1e6).toFixed(2) + ' Mbit/s';
+        }));
+        document.getElementById('preview_status').textContent = previewStatus.join('; ');
+    }
     // document.getElementById('loaded_msg_num').textContent = data.loaded_msg_num;
     // document.getElementById('replaying_msg_idx').textContent = data.replaying_msg_idx;
 };
 ws.onopen = () => {
     ws.send("Opened");
+    reportTime();
+}
+
+// H.264 live preview: one access unit per binary message from /ws_video, each with
+// a 9 byte header (keyframe flag, timestamp in microseconds), decoded by WebCodecs
+var liveSockets = [];
+
+function startLivePreview(cameraIdx) {
+    var canvas = document.getElementById('live_preview_' + cameraIdx);
+    var context = canvas.getContext('2d');
+    var decoder = new VideoDecoder({
+        output: function (frame) {
+            // Draw right away, a live view has no use for presentation timing
+            context.drawImage(frame, 0, 0, canvas.width, canvas.height);
+            frame.close();
+        },
+        error: function (error) {
+            console.error('Live preview decoder error', error);
+        },
+    });
+    var socket = new WebSocket('ws://' + window.location.host + '/ws_video/' + cameraIdx);
+    socket.binaryType = 'arraybuffer';
+    socket.onmessage = function (event) {
+        if (typeof event.data === 'string') {
+            var config = JSON.parse(event.data);
+            canvas.width = config.width;
+            canvas.height = config.height;
+            // No description: the stream is Annex-B with inline SPS/PPS
+            decoder.configure({ 'codec': config.codec, 'optimizeForLatency': true });
+            return;
+        }
+        if (decoder.state !== 'configured') {
+            return;
+        }
+        var header = new DataView(event.data, 0, 9);
+        decoder.decode(new EncodedVideoChunk({
+            'type': header.getUint8(0) ? 'key' : 'delta',
+            'timestamp': Number(header.getBigInt64(1, true)),
+            'data': new Uint8Array(event.data, 9),
+        }));
+    };
+    socket.onclose = function () {
+        if (decoder.state !== 'closed') {
+            decoder.close();
+        }
+    };
+    return socket;
+}
+
+function setLivePreview(enabled) {
+    liveSockets.forEach(function (socket) {
+        socket.close();
+    });
+    liveSockets = [];
+    document.querySelectorAll('.camera_preview').forEach(function (img) {
+        var canvas = document.getElementById('live_preview_' + img.dataset.camera);
+        if (enabled) {
+            // Closes the MJPEG stream
+            img.removeAttribute('src');
+            liveSockets.push(startLivePreview(img.dataset.camera));
+        } else {
+            img.src = img.dataset.src;
+        }
+        img.hidden = enabled;
+        canvas.hidden = !enabled;
+    });
 }
 
 function updateVideoPlayer() {
@@ -22,49 +123,189 @@ function updateVideoPlayer() {
     videoPlayer.src = videoURL;
     videoPlayer.load();
     downloadLink.href = videoURL;
+    loadSession(selectedVideo);
+}
+
+// Session timeline: the manifest at /sessions/<session> lists the segments with their
+// offsets, so a position on the session seek bar maps to a segment and a time in it.
+// Replay follows through the usual playback events of the player.
+var session = null;  // {name, cameraSuffix, manifest}
+var sessionSeeking = false;
+var pendingSeek = null;  // {time, play} to apply once the next segment is loaded
+
+function parseSegment(filename) {
+    var match = filename.match(/^(.+)_s(\d{3,})(_cam\d+)?\.mp4$/);
+    if (!match) {
+        return null;
+    }
+    return { 'session': match[1], 'base': match[1] + '_s' + match[2], 'cameraSuffix': match[3] || '' };
 }
 
-function reportTime() {
+function loadSession(filename) {
+    var segment = parseSegment(filename);
+    var timeline = document.getElementById('sessionTimeline');
+    if (!segment) {
+        session = null;
+        timeline.hidden = true;
+        return;
+    }
+    // Refetched on every switch, the manifest grows while the session records
+    fetch('/sessions/' + encodeURIComponent(segment.session)).then(function (response) {
+        if (!response.ok) {
+            throw new Error('No manifest for session ' + segment.session);
+        }
+        return response.json();
+    }).then(function (manifest) {
+        if (document.getElementById('videoList').value !== filename) {
+            return;  // The selection moved on meanwhile
+        }
+        session = { 'name': segment.session, 'cameraSuffix': segment.cameraSuffix, 'manifest': manifest };
+        document.getElementById('sessionSeek').max = manifest.duration;
+        timeline.hidden = false;
+        updateSessionPosition();
+    }).catch(function () {
+        session = null;
+        timeline.hidden = true;
+    });
+}
+
+function findSessionSegment(sessionTime) {
+    var segments = session.manifest.segments;
+    for (var i = 0; i < segments.length; i++) {
+        if (sessionTime < segments[i].offset + segments[i].duration) {
+            return segments[i];
+        }
+    }
+    return segments.length > 0 ? segments[segments.length - 1] : null;
+}
+
+function currentSessionSegment() {
+    var base = parseSegment(document.getElementById('videoList').value);
+    if (!session || !base) {
+        return null;
+    }
+    return session.manifest.segments.find(function (segment) {
+        return segment.file_name === base.base;
+    }) || null;
+}
+
+function formatTime(seconds) {
+    var minutes = Math.floor(seconds / 60);
+    return minutes + ':' + String(Math.floor(seconds % 60)).padStart(2, '0');
+}
+
+function updateSessionPosition() {
+    var segment = currentSessionSegment();
+    if (!segment || sessionSeeking) {
+        return;
+    }
+    var sessionTime = segment.offset + document.getElementById('videoPlayer').currentTime;
+    document.getElementById('sessionSeek').value = sessionTime;
+    document.getElementById('sessionTime').textContent =
+        formatTime(sessionTime) + ' / ' + formatTime(session.manifest.duration);
+}
+
+function seekSession(value) {
+    sessionSeeking = false;
+    if (!session) {
+        return;
+    }
+    var sessionTime = parseFloat(value);
+    var segment = findSessionSegment(sessionTime);
+    if (!segment) {
+        return;
+    }
     var video = document.getElementById('videoPlayer');
-    var time = video.currentTime;
-    // Get the current timestamp of the web client and convert to seconds (float)
-    var client_timestamp = new Date().getTime() / 1000;
-    var video_filename = document.getElementById('videoList').value;
+    var localTime = Math.max(0, Math.min(sessionTime - segment.offset, segment.duration));
+    var filename = segment.file_name + session.cameraSuffix + '.mp4';
+    if (document.getElementById('videoList').value === filename) {
+        video.currentTime = localTime;
+        return;
+    }
+    pendingSeek = { 'time': localTime, 'play': !video.paused };
+    document.getElementById('videoList').value = filename;
+    updateVideoPlayer();
+}
 
+function applyPendingSeek() {
+    if (!pendingSeek) {
+        return;
+    }
+    var video = document.getElementById('videoPlayer');
+    video.currentTime = pendingSeek.time;
+    if (pendingSeek.play) {
+        video.play();
+    }
+    pendingSeek = null;
+}
 
-    fetch('/progress', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
+// Segments of a session are named <session>_s000.mp4, <session>_s001.mp4, ...
+// and <session>_s000_cam1.mp4, ... for further cameras
+function nextSegment(filename) {
+    var match = filename.match(/^(.+)_s(\d{3,})(_cam\d+)?\.mp4$/);
+    if (!match) {
+        return null;
+    }
+    var index = String(parseInt(match[2], 10) + 1).padStart(match[2].length, '0');
+    var next = match[1] + '_s' + index + (match[3] || '') + '.mp4';
+    var options = document.getElementById('videoList').options;
+    for (var i = 0; i < options.length; i++) {
+        if (options[i].value === next) {
+            return next;
+        }
+    }
+    return null;
+}
 
-        // Return the time in the body of the response as well as whether the video is paused
-        body: JSON.stringify({
-            'video_timestamp': time,
-            'is_playing': !video.paused,
-            'client_timestamp': client_timestamp,
-            'video_filename': video_filename,
-        }),
-    });
+// Play a segmented session as one timeline
+function playNextSegment() {
+    var next = nextSegment(document.getElementById('videoList').value);
+    if (next) {
+        document.getElementById('videoList').value = next;
+        updateVideoPlayer();
+        document.getElementById('videoPlayer').play();
+    }
+}
+
+function reportTime(event) {
+    if (ws.readyState !== WebSocket.OPEN) {
+        return;
+    }
+    var video = document.getElementById('videoPlayer');
+    ws.send(JSON.stringify({
+        'type': 'playback',
+        'event': event ? event.type : 'report',
+        'video_timestamp': video.currentTime,
+        'is_playing': !video.paused,
+        'playback_rate': video.playbackRate,
+        'client_timestamp': clientTime(),
+        'video_filename': document.getElementById('videoList').value,
+    }));
 }
 
 function setupVideo() {
     var video = document.getElementById('videoPlayer');
     if (video) {
-        // video.ontimeupdate = reportTime;
-        if (reportInterval) {
-            clearInterval(reportInterval);
-        }
-        reportInterval = setInterval(reportTime, 500); // Report every 200ms
+        // Every change of the playback state is pushed as it happens; timeupdate
+        // keeps correcting drift a few times per second while playing
+        ['play', 'pause', 'seeked', 'ratechange', 'timeupdate', 'loadedmetadata'].forEach(function (type) {
+            video.addEventListener(type, reportTime);
+        });
+        video.onended = playNextSegment;
+        video.addEventListener('loadedmetadata', applyPendingSeek);
+        video.addEventListener('timeupdate', updateSessionPosition);
+        video.addEventListener('seeked', updateSessionPosition);
     }
 }
 
 
 window.onload = function () {
     setupVideo();
+    if (!('VideoDecoder' in window)) {
+        document.getElementById('livePreviewToggle').disabled = true;
+    }
     updateVideoPlayer(); // Set the initial video
 };
 window.onunload = function () {
     ws.send("Closed");
-    clearInterval(reportInterval);
 };
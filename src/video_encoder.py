@@ -0,0 +1,458 @@
+import multiprocessing as mp
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+from encoder_backends import EncoderBackend, make_encoder_backend
+from frame_bus import FrameBus
+
+BACKPRESSURE_POLICIES = ("block", "drop_oldest", "drop_newest")
+
+
+class VideoEncoderWorker:
+    """Encodes frames to an H.264 mp4 in a dedicated thread. Frames are handed over
+    through a bounded queue, so a slow encoder never stalls capture or preview. The
+    encoding itself is done by the `backend` registered in `encoder_backends`, built
+    with `backend_options`.
+
+    When the queue is full, `backpressure` decides what happens:
+    - "drop_oldest" (default): the oldest queued frame is discarded to make room.
+    - "block": `submit` waits until the encoder catches up, stalling the caller.
+    - "drop_newest": the submitted frame is discarded.
+
+    With `fragmented`, the mp4 is written as fragmented MP4: an empty moov up front and
+    one moof/mdat fragment per keyframe, every `fragment_duration` seconds. The file is
+    then playable while it is being written and survives a crash up to the last
+    complete fragment.
+
+    `request_rollover` switches to a new file at a boundary on the capture clock:
+    the first frame captured at or after the boundary starts the new file, so no frame
+    is lost or duplicated between segments. `on_segment_done` is called from the
+    encoder thread with the stats of every finished file.
+
+    If the backend raises (disk full, codec error), the worker stops accepting
+    frames, discards the queued ones and keeps the exception in `error`, so neither
+    `submit` nor `stop` can block on a thread that is gone.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = 32,
+        backpressure: str = "drop_oldest",
+        fragmented: bool = False,
+        fragment_duration: float = 1.0,
+        backend: str = "pyav",
+        backend_options: Optional[Dict[str, Any]] = None,
+    ):
+        assert (
+            backpressure in BACKPRESSURE_POLICIES
+        ), f"backpressure should be one of {BACKPRESSURE_POLICIES}"
+        self.queue_size = queue_size
+        self.backpressure = backpressure
+        self.fragmented = fragmented
+        self.fragment_duration = fragment_duration
+        self.frame_queue: "queue.Queue[Optional[Tuple[float, npt.NDArray[np.uint8]]]]" = (
+            queue.Queue(maxsize=queue_size)
+        )
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        self.accepting = False
+        self.file_path = ""
+        self.encoder: EncoderBackend = make_encoder_backend(
+            backend,
+            fragmented=fragmented,
+            fragment_duration=fragment_duration,
+            **(backend_options or {}),
+        )
+        self.width = 0
+        self.height = 0
+        self.frame_rate = 30.0
+        self.rollover: Optional[Tuple[str, float]] = None
+        """(next file path, boundary capture time) of a pending rollover."""
+        self.on_segment_done: Optional[Callable[[Dict[str, Any]], None]] = None
+        self.last_segment: Optional[Dict[str, Any]] = None
+        """Stats of the file closed by `stop`."""
+        self.error: Optional[Exception] = None
+        """What stopped the encoder thread, if it failed."""
+
+        self.enqueued_frame_num = 0
+        self.encoded_frame_num = 0
+        self.dropped_frame_num = 0
+        self.first_frame_time: Optional[float] = None
+        """`time.time()` when the first frame was accepted."""
+        self.first_frame_timestamp: Optional[float] = None
+        """Capture timestamp (`time.monotonic()`) of the first accepted frame."""
+        self.segment_first_frame_time: Optional[float] = None
+        self.segment_first_frame_timestamp: Optional[float] = None
+        self.segment_last_frame_timestamp: Optional[float] = None
+        self.segment_encoded_frame_num = 0
+        self.segment_frame_timestamps: List[float] = []
+        """Capture timestamps of the frames encoded into the current file."""
+
+    @property
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, file_path: str, width: int, height: int, frame_rate: float):
+        assert not self.is_running, "Encoder worker is already running"
+        self.width = width
+        self.height = height
+        self.frame_rate = frame_rate or 30
+        self.open_container(file_path)
+
+        self.frame_queue = queue.Queue(maxsize=self.queue_size)
+        self.enqueued_frame_num = 0
+        self.encoded_frame_num = 0
+        self.dropped_frame_num = 0
+        self.first_frame_time = None
+        self.first_frame_timestamp = None
+        self.segment_first_frame_time = None
+        self.segment_first_frame_timestamp = None
+        self.segment_last_frame_timestamp = None
+        self.segment_encoded_frame_num = 0
+        self.segment_frame_timestamps = []
+        self.rollover = None
+        self.last_segment = None
+        self.error = None
+        self.accepting = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def open_container(self, file_path: str):
+        self.file_path = file_path
+        self.encoder.open(file_path, self.width, self.height, self.frame_rate)
+
+    def close_container(self) -> Dict[str, Any]:
+        """Flushes and closes the current file, and returns its stats."""
+        self.encoder.close()
+        return self.take_segment_stats()
+
+    def take_segment_stats(self) -> Dict[str, Any]:
+        segment = {
+            "file_path": self.file_path,
+            "first_frame_time": self.segment_first_frame_time,
+            "first_frame_timestamp": self.segment_first_frame_timestamp,
+            "last_frame_timestamp": self.segment_last_frame_timestamp,
+            "encoded_frame_num": self.segment_encoded_frame_num,
+            "frame_timestamps": self.segment_frame_timestamps,
+        }
+        self.segment_first_frame_time = None
+        self.segment_first_frame_timestamp = None
+        self.segment_last_frame_timestamp = None
+        self.segment_encoded_frame_num = 0
+        self.segment_frame_timestamps = []
+        return segment
+
+    def request_rollover(self, file_path: str, boundary: float):
+        """Continues in `file_path` from the first frame captured at or after
+        `boundary` (`time.monotonic()`)."""
+        with self.lock:
+            self.rollover = (file_path, boundary)
+
+    def submit(
+        self, frame: npt.NDArray[np.uint8], timestamp: float, copy: bool = True
+    ) -> bool:
+        """Queues a BGR frame for encoding. The frame is copied, so the caller may
+        reuse its buffer right away, unless `copy` is False and the caller hands the
+        buffer over. Returns False if the frame was dropped."""
+        with self.lock:
+            if not self.accepting:
+                return False
+            if self.first_frame_time is None:
+                self.first_frame_time = time.time()
+                self.first_frame_timestamp = timestamp
+        item = (timestamp, frame.copy() if copy else frame)
+        if self.backpressure == "block":
+            while True:
+                try:
+                    self.frame_queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    # Give up once the worker stopped or failed
+                    if not self.accepting:
+                        self.dropped_frame_num += 1
+                        return False
+        else:
+            try:
+                self.frame_queue.put_nowait(item)
+            except queue.Full:
+                if self.backpressure == "drop_newest":
+                    self.dropped_frame_num += 1
+                    return False
+                try:
+                    self.frame_queue.get_nowait()
+                    self.dropped_frame_num += 1
+                except queue.Empty:
+                    pass
+                self.frame_queue.put_nowait(item)
+        self.enqueued_frame_num += 1
+        return True
+
+    def run(self):
+        try:
+            self.encode_queued()
+        except Exception as e:
+            print(f"Encoder failed, recording to {self.file_path} stopped: {e!r}")
+            with self.lock:
+                self.error = e
+                self.accepting = False
+            self.discard_queued()
+            try:
+                self.encoder.close()
+            except Exception as close_error:
+                print(f"Encoder could not close {self.file_path}: {close_error!r}")
+            self.last_segment = self.take_segment_stats()
+
+    def encode_queued(self):
+        while True:
+            item = self.frame_queue.get()
+            if item is None:
+                break
+            timestamp, frame = item
+            rollover = self.rollover
+            if rollover is not None and timestamp >= rollover[1]:
+                with self.lock:
+                    self.rollover = None
+                segment = self.close_container()
+                self.open_container(rollover[0])
+                if self.on_segment_done is not None:
+                    self.on_segment_done(segment)
+            if self.segment_first_frame_timestamp is None:
+                self.segment_first_frame_timestamp = timestamp
+                self.segment_first_frame_time = time.time() - (
+                    time.monotonic() - timestamp
+                )
+            self.segment_last_frame_timestamp = timestamp
+            self.segment_frame_timestamps.append(timestamp)
+            self.encoder.encode(frame, timestamp)
+            self.encoded_frame_num += 1
+            self.segment_encoded_frame_num += 1
+
+        self.last_segment = self.close_container()
+
+    def discard_queued(self):
+        while True:
+            try:
+                item = self.frame_queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                self.dropped_frame_num += 1
+
+    def stop(self) -> Dict[str, Any]:
+        """Stops accepting frames, encodes everything still queued and closes the
+        file. Blocks until the file is complete."""
+        with self.lock:
+            self.accepting = False
+        if self.thread is not None:
+            # A failed thread no longer drains the queue
+            while self.thread.is_alive():
+                try:
+                    self.frame_queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            self.thread.join()
+            self.thread = None
+        # A blocking `submit` may have slipped a frame in behind the sentinel
+        self.discard_queued()
+        print(
+            f"Encoder stopped. {self.encoded_frame_num} frames encoded, {self.dropped_frame_num} dropped"
+        )
+        return self.stats()
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {
+            "enqueued_frame_num": self.enqueued_frame_num,
+            "encoded_frame_num": self.encoded_frame_num,
+            "dropped_frame_num": self.dropped_frame_num,
+        }
+        if self.error is not None:
+            stats["error"] = repr(self.error)
+        return stats
+
+
+def exit_error(process: Optional[mp.Process]) -> str:
+    exitcode = None if process is None else process.exitcode
+    return f"Encoder process exited with code {exitcode}"
+
+
+class EncoderProcess:
+    """Runs a `VideoEncoderWorker` (built with `worker_kwargs`) in a process of its own
+    that reads frames straight from `bus`, so encoding gets its own interpreter and
+    core instead of competing with capture and the web server for the GIL.
+
+    Controlled like the worker through `start`, `request_rollover` and `stop`.
+    `launch` forks the process once, it then waits for recordings until `shutdown`;
+    `on_segment_done` is called from a listener thread in this process. If the
+    process dies, `stop` returns with an "error" in the stats instead of waiting
+    forever, and `launch` starts a new one.
+    """
+
+    def __init__(self, bus: FrameBus, **worker_kwargs: Any):
+        self.bus = bus
+        self.worker_kwargs = worker_kwargs
+        self.fragmented = worker_kwargs.get("fragmented", False)
+        self.command_queue: "mp.Queue[Tuple[Any, ...]]" = mp.Queue()
+        self.event_queue: "mp.Queue[Tuple[Any, ...]]" = mp.Queue()
+        self.process: Optional[mp.Process] = None
+        self.listener: Optional[threading.Thread] = None
+        self.stopped_event = threading.Event()
+        self.file_path = ""
+        self.on_segment_done: Optional[Callable[[Dict[str, Any]], None]] = None
+        self.last_segment: Optional[Dict[str, Any]] = None
+        self.first_frame_time: Optional[float] = None
+        self.stop_stats: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+        """Set when the encoder process died during a recording."""
+        self.poll_interval = 0.5
+        """How often waits on the process check that it is still alive."""
+
+    def launch(self):
+        if self.process is not None and self.process.is_alive():
+            return
+        if self.process is not None:
+            # Replaces a dead process, whose queues may hold stale commands and
+            # events
+            self.command_queue = mp.Queue()
+            self.event_queue = mp.Queue()
+        self.process = mp.Process(target=self.run, daemon=True)
+        self.process.start()
+        self.listener = threading.Thread(target=self.listen, daemon=True)
+        self.listener.start()
+
+    def shutdown(self):
+        if self.process is None:
+            return
+        self.command_queue.put(("exit",))
+        self.process.join(timeout=5.0)
+        if self.process.is_alive():
+            print("Encoder process did not exit, terminating it")
+            self.process.terminate()
+            self.process.join(timeout=1.0)
+        self.process = None
+        if self.listener is not None:
+            # Returns on the exit event, or once it notices the process is gone
+            self.listener.join(timeout=2 * self.poll_interval)
+            self.listener = None
+
+    def start(
+        self,
+        file_path: str,
+        width: int,
+        height: int,
+        frame_rate: float,
+        start_monotonic: float = 0.0,
+    ):
+        """Records frames captured at or after `start_monotonic` to `file_path`."""
+        self.file_path = file_path
+        self.first_frame_time = None
+        self.last_segment = None
+        self.stop_stats = {}
+        self.error = None
+        self.stopped_event.clear()
+        self.command_queue.put(
+            ("start", file_path, width, height, frame_rate, start_monotonic)
+        )
+
+    def request_rollover(self, file_path: str, boundary: float):
+        self.command_queue.put(("rollover", file_path, boundary))
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def stop(self) -> Dict[str, Any]:
+        """Blocks until the encoder process has finished the file, or has died."""
+        self.command_queue.put(("stop",))
+        while not self.stopped_event.wait(timeout=self.poll_interval):
+            # The stopped event may still be on its way
+            if not self.is_alive() and not self.stopped_event.wait(
+                timeout=self.poll_interval
+            ):
+                self.error = exit_error(self.process)
+                break
+        if self.error is not None:
+            return {**self.stop_stats, "error": self.error}
+        return self.stop_stats
+
+    def listen(self):
+        process, event_queue = self.process, self.event_queue
+        while True:
+            try:
+                event = event_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if process is None or not process.is_alive():
+                    # Nothing more will come, do not leave `stop` waiting
+                    self.error = exit_error(process)
+                    self.stopped_event.set()
+                    return
+                continue
+            if event[0] == "segment":
+                _, segment, self.file_path = event
+                if self.on_segment_done is not None:
+                    self.on_segment_done(segment)
+            elif event[0] == "stopped":
+                _, self.stop_stats, self.last_segment, self.first_frame_time = event
+                self.stopped_event.set()
+            elif event[0] == "exit":
+                return
+
+    def run(self):
+        worker = VideoEncoderWorker(**self.worker_kwargs)
+        worker.on_segment_done = lambda segment: self.event_queue.put(
+            ("segment", segment, worker.file_path)
+        )
+        feed_stop_event = threading.Event()
+        feed_thread: Optional[threading.Thread] = None
+        while True:
+            command = self.command_queue.get()
+            if command[0] == "start":
+                _, file_path, width, height, frame_rate, start_monotonic = command
+                worker.start(file_path, width, height, frame_rate)
+                feed_stop_event.clear()
+                feed_thread = threading.Thread(
+                    target=self.feed,
+                    args=(worker, start_monotonic, feed_stop_event),
+                    daemon=True,
+                )
+                feed_thread.start()
+            elif command[0] == "rollover":
+                worker.request_rollover(command[1], command[2])
+            elif command[0] == "stop":
+                feed_stop_event.set()
+                if feed_thread is not None:
+                    feed_thread.join()
+                    feed_thread = None
+                stats = worker.stop()
+                self.event_queue.put(
+                    ("stopped", stats, worker.last_segment, worker.first_frame_time)
+                )
+            elif command[0] == "exit":
+                self.event_queue.put(("exit",))
+                return
+
+    def feed(
+        self,
+        worker: VideoEncoderWorker,
+        start_monotonic: float,
+        stop_event: threading.Event,
+    ):
+        """Submits every frame on the bus from `start_monotonic` on. Frames already
+        overwritten by the time they are read count as dropped."""
+        seq = self.bus.latest_seq
+        while not stop_event.is_set():
+            if self.bus.wait_for_frame(seq, timeout=0.5) is None:
+                continue
+            latest_seq = self.bus.latest_seq
+            for frame_seq in range(seq + 1, latest_seq + 1):
+                captured = self.bus.read_frame(frame_seq)
+                if captured is None:
+                    if worker.first_frame_timestamp is not None:
+                        worker.dropped_frame_num += 1
+                elif captured.timestamp >= start_monotonic:
+                    worker.submit(captured.frame, captured.timestamp, copy=False)
+            seq = latest_seq
@@ -0,0 +1,113 @@
+import struct
+import time
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+
+
+class StreamingWavWriter:
+    """Appends audio chunks to a WAV file as they arrive instead of holding the whole
+    recording in memory. The RIFF/data sizes are patched every
+    `header_update_interval` seconds and on `close`, so a crashed recording is still a
+    valid WAV file containing everything up to the last update."""
+
+    def __init__(
+        self,
+        file_path: str,
+        sample_rate: int,
+        channels: int,
+        dtype: npt.DTypeLike = np.float32,
+        header_update_interval: float = 1.0,
+    ):
+        self.file_path = file_path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        if self.dtype.kind == "f":
+            self.format_tag = WAVE_FORMAT_IEEE_FLOAT
+        elif self.dtype.kind in "iu":
+            self.format_tag = WAVE_FORMAT_PCM
+        else:
+            raise ValueError(f"Unsupported sample dtype {self.dtype}")
+        self.header_update_interval = header_update_interval
+        self.written_frame_num = 0
+        self.last_header_update_time = time.monotonic()
+        self.fact_size_pos: Optional[int] = None
+        self.data_size_pos = 0
+
+        self.file = open(file_path, "wb")
+        self.write_header()
+
+    def write_header(self):
+        block_align = self.channels * self.dtype.itemsize
+        self.file.write(b"RIFF" + struct.pack("<I", 0) + b"WAVE")
+        fmt_chunk = struct.pack(
+            "<HHIIHH",
+            self.format_tag,
+            self.channels,
+            self.sample_rate,
+            self.sample_rate * block_align,
+            block_align,
+            self.dtype.itemsize * 8,
+        )
+        if self.format_tag != WAVE_FORMAT_PCM:
+            # Non-PCM formats carry a cbSize field and a fact chunk
+            fmt_chunk += struct.pack("<H", 0)
+        self.file.write(b"fmt " + struct.pack("<I", len(fmt_chunk)) + fmt_chunk)
+        if self.format_tag != WAVE_FORMAT_PCM:
+            self.file.write(b"fact" + struct.pack("<I", 4))
+            self.fact_size_pos = self.file.tell()
+            self.file.write(struct.pack("<I", 0))
+        self.file.write(b"data")
+        self.data_size_pos = self.file.tell()
+        self.file.write(struct.pack("<I", 0))
+
+    def write(self, data: npt.NDArray):
+        """Appends a chunk of shape (frames, channels) or (frames * channels,)."""
+        data = np.ascontiguousarray(data, dtype=self.dtype)
+        assert (
+            data.size % self.channels == 0
+        ), f"Chunk size {data.size} is not a multiple of {self.channels} channels"
+        self.file.write(data.data)
+        self.written_frame_num += data.size // self.channels
+        if time.monotonic() - self.last_header_update_time > self.header_update_interval:
+            self.update_header()
+
+    def update_header(self):
+        data_size = self.written_frame_num * self.channels * self.dtype.itemsize
+        end_pos = self.file.tell()
+        self.file.seek(4)
+        # RIFF size excludes the 8-byte RIFF header, chunks are padded to even size
+        riff_size = self.data_size_pos + 4 + data_size + data_size % 2 - 8
+        self.file.write(struct.pack("<I", riff_size))
+        if self.fact_size_pos is not None:
+            self.file.seek(self.fact_size_pos)
+            self.file.write(struct.pack("<I", self.written_frame_num))
+        self.file.seek(self.data_size_pos)
+        self.file.write(struct.pack("<I", data_size))
+        self.file.seek(end_pos)
+        self.file.flush()
+        self.last_header_update_time = time.monotonic()
+
+    def close(self):
+        if self.file.closed:
+            return
+        if (self.written_frame_num * self.channels * self.dtype.itemsize) % 2:
+            self.file.write(b"\x00")
+        self.update_header()
+        self.file.close()
+
+    @property
+    def duration(self) -> float:
+        return self.written_frame_num / self.sample_rate
+
+    # ========= context manager ===========
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -5,10 +5,9 @@ import os
 from pathlib import Path
 import time
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
-import av
-import cv2
+import numpy as np
 import pytz
 from quart import (
     Quart,
@@ -23,18 +22,25 @@ from quart import (
 )
 
 from audio_recorder import AudioRecorder
+from camera import Camera
+from clock_sync import ClockSync
+from http_range import (
+    RangeNotSatisfiable,
+    file_etag,
+    http_date,
+    if_range_matches,
+    is_not_modified,
+    parse_range_header,
+    read_file_range,
+)
 from msg_recorder import MsgRecorder
-
-
-def parse_range_header(header, total_size):
-    # Parse the range header to get start and end byte positions
-    range_type, range_spec = header.split("=")
-    if range_type != "bytes":
-        raise ValueError("Invalid range type")
-    start, end = range_spec.split("-")
-    start = int(start) if start else 0
-    end = int(end) if end else total_size - 1
-    return start, end
+from recording_session import (
+    SessionManifest,
+    camera_file_name,
+    parse_camera_file_name,
+    parse_segment_file_name,
+    segment_file_name,
+)
 
 
 class WebServer:
@@ -45,13 +51,52 @@ class WebServer:
         msg_recorder: Optional[MsgRecorder] = None,
         audio_recorder: Optional[AudioRecorder] = None,
         data_dir=str(Path(__file__).parent.parent) + "/recordings",
+        encoder_queue_size: int = 32,
+        encoder_backpressure: str = "drop_oldest",
+        preview_resolution: Optional[Tuple[int, int]] = None,
+        preview_quality: int = 80,
+        adaptive_preview: bool = True,
+        live_preview_bitrate: int = 1000000,
+        msg_prefetch_num: int = 3,
+        fragmented_recording: bool = False,
+        segment_duration: Optional[float] = None,
+        segment_size: Optional[int] = None,
+        encoder_backend: str = "pyav",
+        encoder_options: Optional[Dict[str, Any]] = None,
+        devices: Optional[Sequence[Union[int, str]]] = None,
+        shared_memory_capture: bool = False,
     ):
+        """`devices` are the capture devices to record from, camera 0 by default.
+        Camera i records to `<file_name>_cam<i>.mp4`, except camera 0, which keeps
+        `<file_name>.mp4`. With `shared_memory_capture`, every camera captures and
+        encodes in processes of its own, see `Camera`. With `adaptive_preview`,
+        each `/video_feed` viewer gets the preview quality its link can keep up with,
+        see `PreviewHub`. `/ws_video` streams an H.264 live preview of
+        `live_preview_bitrate` bit/s instead, see `LiveStreamHub`."""
         self.app = Quart(__name__)
         self.setup_routes()
-        self.cap = cv2.VideoCapture()
+        self.cameras: List[Camera] = [
+            Camera(
+                camera_idx,
+                device,
+                resolution=resolution,
+                preview_resolution=preview_resolution,
+                preview_quality=preview_quality,
+                adaptive_preview=adaptive_preview,
+                live_preview_bitrate=live_preview_bitrate,
+                shared_memory=shared_memory_capture,
+                queue_size=encoder_queue_size,
+                backpressure=encoder_backpressure,
+                fragmented=fragmented_recording,
+                backend=encoder_backend,
+                backend_options=encoder_options,
+            )
+            for camera_idx, device in enumerate(devices if devices else [0])
+        ]
+        for camera in self.cameras:
+            camera.encoder_worker.on_segment_done = self.on_encoder_segment_done
+        self.fragmented_recording = fragmented_recording
         self.is_recording = False
-        self.stream = None
-        self.container = None
         self.data_dir = data_dir
         if audio_recorder is None:
             print(
@@ -70,144 +115,390 @@ class WebServer:
         self.time_zone = pytz.timezone(time_zone)
         self.record_start_time = time.time()
         self.record_file_name = ""
+        self.recording_video_paths: Dict[int, str] = {}
+        """Set per camera while a fragmented recording is being written, so it can be
+        served as it grows."""
         self.record_start_time_accurate = time.time()
         self.replay_start_time = time.time()
-        self.recorded_frame_num = 0
+        self.start_lead_time = 0.2
+        """Cameras start recording this long after the request, so every encoder is
+        open before the first frame that should be recorded."""
+        self.replay_video_file_name = ""
+        self.video_meta_cache: Dict[str, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+        """`_video.json` path -> ((mtime, size), metadata), so replay progress events do
+        not re-parse the metadata of the recording being replayed."""
         self.resolution = resolution
         self.client_ip = ""
-
+        self.msg_prefetch_num = msg_prefetch_num
+        """Message logs of this many most recent recordings are loaded in the
+        background when the index page is served."""
+        self.prefetch_task: Optional[asyncio.Task] = None
+
+        self.segment_duration = segment_duration
+        """Roll over to a new segment every this many seconds."""
+        self.segment_size = segment_size
+        """Roll over to a new segment once the video reaches this many bytes."""
+        self.segment_lead_time = 0.5
+        """Rollovers are requested this long before their boundary, so video, audio
+        and messages all know about it before it passes."""
+        self.session_name = ""
+        self.session_manifest: Optional[SessionManifest] = None
+        self.segment_idx = 0
+        self.segment_start_monotonic = time.monotonic()
+        self.segment_task: Optional[asyncio.Task] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.ws_status_interval = 0.5
+        self.msg_time_origins: Dict[str, float] = {}
+        """`time.monotonic()` time of message log time 0, per recorded file name
+        shared by all cameras."""
+
+        self.app.before_serving(self.quiet_access_log)
         self.app.before_serving(self.setup_camera)
         self.app.after_serving(self.release_camera)
+        self.app.after_serving(self.wait_msgs_saved)
 
         self.app.websocket("/ws")(self.ws)
+        self.app.websocket("/ws_video")(self.ws_video)
+        self.app.websocket("/ws_video/<int:camera_idx>")(self.ws_video)
         self.msg_recorder = msg_recorder
         self.audio_recorder = audio_recorder
 
-    async def ws(self):
-        while True:
-            ws_started_time = time.monotonic()
-            ws_msg_dict: Dict[str, Optional[str]] = {"client_ip": self.client_ip}
-            if self.is_recording:
-                recording_time = time.time() - self.record_start_time
-                # Transform recording_time to MM:SS
-                ws_msg_dict["recording_time"] = time.strftime(
-                    "%M:%S", time.gmtime(recording_time)
-                )
-            else:
-                ws_msg_dict["recording_time"] = "00:00"
+    def ws_status(self) -> Dict[str, Any]:
+        ws_msg_dict: Dict[str, Any] = {"type": "status", "client_ip": self.client_ip}
+        if self.is_recording:
+            recording_time = time.time() - self.record_start_time
+            # Transform recording_time to MM:SS
+            ws_msg_dict["recording_time"] = time.strftime(
+                "%M:%S", time.gmtime(recording_time)
+            )
+        else:
+            ws_msg_dict["recording_time"] = "00:00"
 
-            if self.msg_recorder:
-                ws_msg_dict["received_msg_num"] = str(
-                    len(self.msg_recorder.received_msgs)
-                )
-                ws_msg_dict["loaded_msg_num"] = str(len(self.msg_recorder.replay_msgs))
-                ws_msg_dict["replaying_msg_idx"] = str(self.msg_recorder.replaying_idx)
-            else:
-                ws_msg_dict["received_msg_num"] = str(0)
-                ws_msg_dict["loaded_msg_num"] = str(0)
-                ws_msg_dict["replaying_msg_idx"] = str(0)
+        if self.msg_recorder:
+            ws_msg_dict["received_msg_num"] = str(self.msg_recorder.received_msg_num)
+            ws_msg_dict["loaded_msg_num"] = str(len(self.msg_recorder.replay_msgs))
+            ws_msg_dict["replaying_msg_idx"] = str(self.msg_recorder.replaying_idx)
+            ws_msg_dict["replay_dropped_msg_num"] = str(
+                self.msg_recorder.replay_dropped_msg_num
+            )
+        else:
+            ws_msg_dict["received_msg_num"] = str(0)
+            ws_msg_dict["loaded_msg_num"] = str(0)
+            ws_msg_dict["replaying_msg_idx"] = str(0)
+            ws_msg_dict["replay_dropped_msg_num"] = str(0)
+        ws_msg_dict["preview_clients"] = [
+            {"camera": camera.camera_idx, **client_stats}
+            for camera in self.cameras
+            for client_stats in camera.preview_hub.client_stats()
+        ]
+        ws_msg_dict["live_clients"] = [
+            {"camera": camera.camera_idx, **viewer_stats}
+            for camera in self.cameras
+            for viewer_stats in camera.live_stream_hub.viewer_stats()
+        ]
+        if self.audio_recorder:
+            ws_msg_dict["merge_jobs"] = [
+                {key: job[key] for key in ("file_name", "state", "duration", "output_size")}
+                for job in self.audio_recorder.merge_scheduler.get_jobs(limit=5)
+            ]
+        return ws_msg_dict
+
+    async def send_ws_updates(self):
+        """Sends the status every `ws_status_interval`, each time with a ping that
+        keeps the client's clock offset estimate fresh."""
+        while True:
+            # Ping right after connecting, so the first playback events are synced
+            await websocket.send(
+                json.dumps({"type": "ping", "server_time": time.monotonic()})
+            )
             if self.client_ip:
-                await websocket.send(json.dumps(ws_msg_dict))
-            await asyncio.sleep(0.5)
+                await websocket.send(json.dumps(self.ws_status()))
+            await asyncio.sleep(self.ws_status_interval)
+
+    async def ws(self):
+        """Pushes status to the browser and receives its playback events: play,
+        pause, seeked, ratechange and timeupdate. Event times are translated from the
+        browser clock to ours through the ping/pong clock offset, so the replay
+        follows the video within a round trip's uncertainty."""
+        clock_sync = ClockSync()
+        send_task = asyncio.create_task(self.send_ws_updates())
+        try:
+            while True:
+                try:
+                    data = json.loads(await websocket.receive())
+                except json.JSONDecodeError:
+                    continue  # "Opened" and "Closed" notifications
+                if not isinstance(data, dict):
+                    continue
+                if data.get("type") == "pong":
+                    clock_sync.add_sample(data["server_time"], data["client_time"])
+                elif data.get("type") == "playback":
+                    self.client_ip = websocket.remote_addr
+                    local_time = (
+                        clock_sync.to_local(data["client_timestamp"])
+                        if clock_sync.is_synced
+                        else None
+                    )
+                    await self.apply_playback_state(data, local_time)
+                    if data.get("event") != "timeupdate":
+                        print(
+                            f"{data.get('event')}: {data['video_timestamp']:.3f}, "
+                            f"{data.get('playback_rate', 1.0)}x, RTT {clock_sync.rtt * 1e3:.1f} ms"
+                        )
+        finally:
+            send_task.cancel()
+
+    async def ws_video(self, camera_idx: int = 0):
+        """H.264 live preview of a camera, see `LiveStreamHub`."""
+        if not 0 <= camera_idx < len(self.cameras):
+            return
+        hub = self.cameras[camera_idx].live_stream_hub
+        async for message in hub.subscribe(websocket.remote_addr or ""):
+            await websocket.send(message)
+
+    async def apply_playback_state(
+        self, data: Dict[str, Any], local_time: Optional[float] = None
+    ):
+        """Follows the browser's playback state, as sent on /ws or to /progress."""
+        if not self.msg_recorder:
+            return
+        video_file_name = data["video_filename"]
+        if video_file_name.endswith(".mp4"):
+            video_file_name = video_file_name[:-4]
+        await self.switch_replay(video_file_name)
+        self.prefetch_next_segment(parse_camera_file_name(video_file_name)[0])
+        self.msg_recorder.update_video_clock(
+            data["video_timestamp"],
+            data["is_playing"],
+            data["client_timestamp"],
+            local_time=local_time,
+            playback_rate=data.get("playback_rate", 1.0),
+        )
+
+    def quiet_access_log(self):
+        # Once hypercorn has set up its loggers, not on every request
+        logging.getLogger("hypercorn.access").setLevel(logging.WARNING)
+
+    async def wait_msgs_saved(self):
+        if self.msg_recorder:
+            self.msg_recorder.stop_receive()
+            await self.msg_recorder.wait_saved()
 
     async def release_camera(self):
-        if self.cap.isOpened():
-            self.cap.release()
-        print("Camera released")
+        for camera in self.cameras:
+            camera.release()
 
     def setup_camera(self):
-        if not self.cap.isOpened():
-            self.cap.open(0)
-
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
-        print(f"Camera initialized with resolution {self.resolution}")
+        for camera in self.cameras:
+            camera.start()
 
     def setup_routes(self):
         self.app.route("/")(self.index)
         self.app.route("/video_feed")(self.video_feed)
+        self.app.route("/video_feed/<int:camera_idx>")(self.video_feed)
         self.app.route("/start_recording", methods=["POST"])(self.start_recording)
         self.app.route("/stop_recording", methods=["POST"])(self.stop_recording)
         # self.app.route("/video_replay")(self.video_replay)
         self.app.route("/progress", methods=["POST"])(self.progress)
 
         self.app.route("/recordings/<filename>")(self.serve_recording)
+        self.app.route("/sessions/<session_name>")(self.serve_session)
 
-    async def gen_frames(self):
-        while True:
-            success, frame = self.cap.read()
-            if not success:
-                await asyncio.sleep(0.1)
-            else:
-                start_time = time.monotonic()
-                if self.is_recording:
-                    if self.recorded_frame_num == 0:
-                        print(
-                            f"Record starting time difference: {self.record_start_time_accurate - self.record_start_time:.3f}"
-                        )
-                        if self.msg_recorder:
-                            self.msg_recorder.start_receive()
-                        if self.audio_recorder:
-                            self.audio_recorder.start_recording(self.record_file_name)
-                        self.record_start_time_accurate = time.time()
-
-                    img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                    img = av.VideoFrame.from_ndarray(img, format="rgb24")
-                    for packet in self.stream.encode(img):
-                        self.container.mux(packet)
-                    self.recorded_frame_num += 1
-
-                ret, buffer = cv2.imencode(".jpg", frame)
-                frame = buffer.tobytes()
-                # print(
-                #     f"Recording: {self.is_recording}, single frame fps: {1/(time.monotonic() - start_time):.1f}",
-                #     end="\r",
-                # )
-
-                yield (
-                    b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n"
-                )
-
-            await asyncio.sleep(0)
+    async def gen_frames(self, camera_idx: int = 0, client_id: str = ""):
+        async for part in self.cameras[camera_idx].preview_hub.subscribe(client_id):
+            yield part
 
     async def index(self):
         recording_files = os.listdir(self.video_dir)
         recording_files.sort(reverse=True)
+        if self.msg_recorder and self.msg_prefetch_num > 0:
+            if self.prefetch_task is None or self.prefetch_task.done():
+                msg_file_names = list(
+                    dict.fromkeys(
+                        parse_camera_file_name(
+                            file_name[:-4] if file_name.endswith(".mp4") else file_name
+                        )[0]
+                        for file_name in recording_files
+                    )
+                )[: self.msg_prefetch_num]
+                self.prefetch_task = asyncio.create_task(
+                    self.msg_recorder.prefetch(msg_file_names)
+                )
         return await render_template(
             "index.html",
             video_files=recording_files,
             recording=self.is_recording,
             client_ip=self.client_ip,
+            camera_num=len(self.cameras),
         )
 
-    def video_feed(self):
+    def video_feed(self, camera_idx: int = 0):
+        if not 0 <= camera_idx < len(self.cameras):
+            return Response("Not Found", status=404)
         return Response(
-            self.gen_frames(), mimetype="multipart/x-mixed-replace; boundary=frame"
+            self.gen_frames(camera_idx, request.remote_addr or ""),
+            mimetype="multipart/x-mixed-replace; boundary=frame",
         )
 
+    @property
+    def is_segmented(self) -> bool:
+        return self.segment_duration is not None or self.segment_size is not None
+
     async def start_recording(self):
         print("Enter start_recording")
         if self.is_recording:
             print("Recording already started!")
             return redirect(url_for("index"))
+        self.loop = asyncio.get_running_loop()
         self.record_start_time = time.time()
-        self.recorded_frame_num = 0
-        self.is_recording = True
+        # All cameras record from the first frame captured after the same instant
+        start_monotonic = time.monotonic() + self.start_lead_time
 
-        self.record_file_name = datetime.fromtimestamp(
+        self.session_name = datetime.fromtimestamp(
             self.record_start_time, tz=self.time_zone
         ).strftime("%Y%m%d_%H%M%S")
-        file_path = f"{self.raw_video_dir}/{self.record_file_name}.mp4"
+        self.record_file_name = self.session_name
+        if self.is_segmented:
+            self.segment_idx = 0
+            self.segment_start_monotonic = start_monotonic
+            self.record_file_name = segment_file_name(self.session_name, 0)
+            self.session_manifest = SessionManifest(
+                f"{self.meta_data_dir}/{self.session_name}_session.json",
+                self.session_name,
+            )
+            self.session_manifest.save()
+        for camera in self.cameras:
+            file_path = self.camera_video_path(camera, self.record_file_name)
+            camera.start_recording(file_path, start_monotonic)
+            if self.fragmented_recording:
+                self.recording_video_paths[camera.camera_idx] = file_path
+        self.is_recording = True
+        if self.msg_recorder:
+            self.msg_recorder.start_receive(self.record_file_name)
+            self.msg_time_origins[self.record_file_name] = (
+                self.msg_recorder.receive_start_monotonic
+            )
+        if self.audio_recorder:
+            self.audio_recorder.start_recording(self.record_file_name)
+        if self.is_segmented:
+            self.segment_task = asyncio.create_task(self.run_segment_rollover())
+
+        return redirect(url_for("index"))
 
-        self.container = av.open(file_path, mode="w")
-        self.stream = self.container.add_stream(
-            "h264", rate=self.cap.get(cv2.CAP_PROP_FPS)
+    def camera_video_path(self, camera: Camera, file_name: str) -> str:
+        return f"{self.raw_video_dir}/{camera_file_name(file_name, camera.camera_idx)}.mp4"
+
+    async def run_segment_rollover(self):
+        """Rolls the recording over to a new segment whenever the current one
+        reaches `segment_duration` or `segment_size`."""
+        while self.is_recording:
+            await asyncio.sleep(self.segment_lead_time / 2)
+            now = time.monotonic()
+            boundary = None
+            if self.segment_duration is not None:
+                segment_stop = self.segment_start_monotonic + self.segment_duration
+                if now >= segment_stop - self.segment_lead_time:
+                    boundary = max(segment_stop, now + self.segment_lead_time / 2)
+            if boundary is None and self.segment_size is not None:
+                try:
+                    size = os.path.getsize(
+                        f"{self.raw_video_dir}/{self.record_file_name}.mp4"
+                    )
+                except OSError:
+                    size = 0
+                if size >= self.segment_size:
+                    boundary = now + self.segment_lead_time
+            if boundary is not None:
+                self.rollover_segment(boundary)
+
+    def rollover_segment(self, boundary: float):
+        """Switches video, audio and messages to the next segment at `boundary`
+        (`time.monotonic()`)."""
+        self.segment_idx += 1
+        self.segment_start_monotonic = boundary
+        self.record_file_name = segment_file_name(self.session_name, self.segment_idx)
+        print(f"Rolling over to {self.record_file_name}")
+        for camera in self.cameras:
+            camera.encoder_worker.request_rollover(
+                self.camera_video_path(camera, self.record_file_name), boundary
+            )
+        if self.msg_recorder:
+            self.msg_recorder.request_rollover(self.record_file_name, boundary)
+            self.msg_time_origins[self.record_file_name] = boundary
+        if self.audio_recorder:
+            self.audio_recorder.rollover(self.record_file_name, boundary)
+
+    def on_encoder_segment_done(self, segment: Dict[str, Any]):
+        """Called from the encoder thread when it rolled over to a new file."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.finish_segment, segment)
+
+    def finish_segment(
+        self,
+        segment: Dict[str, Any],
+        stop_time: Optional[float] = None,
+        encoder_stats: Optional[Dict[str, Any]] = None,
+    ):
+        """Writes the metadata of a finished video file, adds it to the session
+        manifest (camera 0 only) and, for segments finished before the recording
+        stops, starts merging it right away."""
+        file_name = os.path.basename(segment["file_path"])[: -len(".mp4")]
+        base_file_name, camera_idx = parse_camera_file_name(file_name)
+        capture = self.cameras[camera_idx].capture
+        frame_duration = 1 / (capture.frame_rate or 30)
+        if segment["first_frame_timestamp"] is None:
+            duration = 0.0
+        else:
+            duration = (
+                segment["last_frame_timestamp"]
+                - segment["first_frame_timestamp"]
+                + frame_duration
+            )
+        final = stop_time is not None
+        if stop_time is None:
+            stop_time = (segment["first_frame_time"] or time.time()) + duration
+        video_meta_data = {
+            "start_time": segment["first_frame_time"] or self.record_start_time,
+            "start_monotonic_time": segment["first_frame_timestamp"],
+            "stop_time": stop_time,
+            "frame_rate": capture.frame_rate,
+            "resolution": [capture.width, capture.height],
+            "recorded_frame_num": segment["encoded_frame_num"],
+            **(encoder_stats or {}),
+        }
+        msg_time_origin = self.msg_time_origins.get(base_file_name)
+        if msg_time_origin is not None and segment["first_frame_timestamp"] is not None:
+            # Message log time at video time 0, for exact replay alignment
+            video_meta_data["msg_time_offset"] = (
+                segment["first_frame_timestamp"] - msg_time_origin
+            )
+        with open(f"{self.meta_data_dir}/{file_name}_video.json", "w") as f:
+            json.dump(video_meta_data, f)
+        # Per frame (PTS in seconds, capture time in `time.monotonic()` clock)
+        frame_timestamps = np.array(segment["frame_timestamps"], dtype=np.float64)
+        np.save(
+            f"{self.meta_data_dir}/{file_name}_video_timestamps.npy",
+            np.stack(
+                [frame_timestamps - segment["first_frame_timestamp"], frame_timestamps],
+                axis=1,
+            )
+            if len(frame_timestamps) > 0
+            else np.zeros((0, 2)),
         )
-        self.stream.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        self.stream.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        self.stream.pix_fmt = "yuv420p"
 
-        return redirect(url_for("index"))
+        if self.session_manifest is not None and camera_idx == 0:
+            self.session_manifest.add_segment(
+                file_name, duration, camera_num=len(self.cameras), **video_meta_data
+            )
+        if not final:
+            if self.fragmented_recording:
+                self.recording_video_paths[camera_idx] = self.cameras[
+                    camera_idx
+                ].encoder_worker.file_path
+            if self.audio_recorder:
+                self.audio_recorder.start_merging_to_video(
+                    self.raw_video_dir, self.video_dir, base_file_name, file_name
+                )
 
     async def stop_recording(self):
         if not self.is_recording:
@@ -215,109 +506,210 @@ class WebServer:
             return redirect(url_for("index"))
 
         self.is_recording = False
-        time.sleep(0.1)
+        if self.segment_task is not None:
+            self.segment_task.cancel()
+            self.segment_task = None
         stop_recording_time = time.time()
-        for packet in self.stream.encode():
-            self.container.mux(packet)
-        self.container.close()
-
-        with open(f"{self.meta_data_dir}/{self.record_file_name}_video.json", "w") as f:
-            json.dump(
-                {
-                    "start_time": self.record_start_time,
-                    "stop_time": stop_recording_time,
-                    "frame_rate": self.cap.get(cv2.CAP_PROP_FPS),
-                    "resolution": [self.stream.width, self.stream.height],
-                    "recorded_frame_num": self.recorded_frame_num,
-                },
-                f,
+        stop_recording_monotonic = time.monotonic()
+        # Flushing the encoder queues may take a while, keep the event loop
+        # responsive and flush all cameras at once
+        loop = asyncio.get_running_loop()
+        all_encoder_stats = await asyncio.gather(
+            *(
+                loop.run_in_executor(None, camera.stop_recording)
+                for camera in self.cameras
+            )
+        )
+        self.recording_video_paths.clear()
+        self.record_start_time_accurate = (
+            self.cameras[0].encoder_worker.first_frame_time or self.record_start_time
+        )
+        print(
+            f"Record starting time difference: {self.record_start_time_accurate - self.record_start_time:.3f}"
+        )
+        # Finish segments whose rollover callbacks are still queued on the loop
+        await asyncio.sleep(0)
+        last_file_names = []
+        for camera, encoder_stats in zip(self.cameras, all_encoder_stats):
+            if "error" in encoder_stats:
+                print(
+                    f"Camera {camera.camera_idx} encoder failed: {encoder_stats['error']}"
+                )
+            last_segment = camera.encoder_worker.last_segment
+            if last_segment is None:
+                print(f"Camera {camera.camera_idx} has no recording to finish")
+                continue
+            # A rollover requested for a boundary the recording never reached is
+            # dropped
+            last_file_names.append(
+                os.path.basename(last_segment["file_path"])[: -len(".mp4")]
             )
+            self.finish_segment(last_segment, stop_recording_time, encoder_stats)
+        if last_file_names:
+            self.record_file_name = parse_camera_file_name(last_file_names[0])[0]
+        self.msg_time_origins.clear()
+        if self.session_manifest is not None:
+            self.session_manifest.complete = True
+            self.session_manifest.save()
+            self.session_manifest = None
 
         if self.msg_recorder:
-            self.msg_recorder.stop_receive(data_file_name=self.record_file_name)
+            self.msg_recorder.stop_receive(stop_time=stop_recording_monotonic)
 
         if self.audio_recorder:
             self.audio_recorder.stop_recording()
-            self.audio_recorder.start_merging_to_video(
-                self.raw_video_dir, self.video_dir
-            )
+            for file_name in last_file_names:
+                self.audio_recorder.start_merging_to_video(
+                    self.raw_video_dir,
+                    self.video_dir,
+                    self.record_file_name,
+                    file_name,
+                )
 
         return redirect(url_for("index"))
 
-    async def limited_stream(self, path, range_header=None, chunk_size=1024 * 1024):
-        start, end = 0, None
-        total_size = os.path.getsize(path)
-
-        if range_header:
-            start, end = parse_range_header(range_header, total_size)
-            if end is None:
-                end = total_size - 1
-
-        with open(path, "rb") as file:
-            file.seek(start)
-            if end is None:
-                end = total_size - 1
-
-            remaining = end - start + 1
-            while remaining > 0:
-                chunk = file.read(min(chunk_size, remaining))
-                if not chunk:
-                    break
-                yield chunk
-                remaining -= len(chunk)
-
     async def serve_recording(self, filename):
         range_header = request.headers.get("Range")
         print(f"serve_recording: filename: {filename}, range_header: {range_header}")
-        total_size = os.path.getsize(f"{self.video_dir}/{filename}")
+        path = f"{self.video_dir}/{filename}"
+        is_growing = False
+        for recording_video_path in self.recording_video_paths.values():
+            if os.path.basename(recording_video_path) == filename:
+                path = recording_video_path
+                is_growing = True
+        if os.path.basename(filename) != filename or not os.path.isfile(path):
+            return Response("Not Found", status=404)
 
         if self.msg_recorder:
-            msg_file_name = filename
-            if msg_file_name.endswith(".mp4"):
-                msg_file_name = msg_file_name[:-4]
-            if self.msg_recorder.replaying_file_name != msg_file_name:
-                if self.msg_recorder.replaying_file_name != "":
-                    self.msg_recorder.stop_replay()
-                if self.msg_recorder.find_replay_file(msg_file_name):
-                    self.msg_recorder.start_replay(msg_file_name)
-
-        if range_header:
-            start, end = parse_range_header(range_header, total_size)
-            content_range_header = f"bytes {start}-{end}/{total_size}"
+            video_file_name = filename
+            if video_file_name.endswith(".mp4"):
+                video_file_name = video_file_name[:-4]
+            await self.switch_replay(video_file_name)
+
+        if is_growing and (
+            range_header is None or range_header.replace(" ", "") == "bytes=0-"
+        ):
+            # Still being written: stream from the start and follow the file as it
+            # grows until recording stops
             return Response(
-                self.limited_stream(f"{self.video_dir}/{filename}", range_header),
-                status=206,  # Partial Content
+                read_file_range(
+                    path,
+                    0,
+                    None,
+                    follow=lambda: path in self.recording_video_paths.values(),
+                ),
                 content_type="video/mp4",
-                headers={"Content-Range": content_range_header},
+                headers={"Cache-Control": "no-cache"},
             )
+
+        stat = os.stat(path)
+        total_size = stat.st_size
+        etag = file_etag(stat)
+        headers = {
+            "Accept-Ranges": "bytes",
+            "ETag": etag,
+            "Last-Modified": http_date(stat.st_mtime),
+        }
+        if is_not_modified(
+            request.headers.get("If-None-Match"),
+            request.headers.get("If-Modified-Since"),
+            etag,
+            stat.st_mtime,
+        ):
+            return Response("", status=304, headers=headers)
+
+        byte_range = None
+        if range_header and if_range_matches(
+            request.headers.get("If-Range"), etag, stat.st_mtime
+        ):
+            try:
+                byte_range = parse_range_header(range_header, total_size)
+            except RangeNotSatisfiable:
+                headers["Content-Range"] = f"bytes */{total_size}"
+                return Response("", status=416, headers=headers)
+
+        if byte_range is None:
+            start, end, status = 0, total_size - 1, 200
         else:
-            return Response(
-                self.limited_stream(f"{self.video_dir}/{filename}"),
-                content_type="video/mp4",
-            )
+            start, end = byte_range
+            status = 206  # Partial Content
+            headers["Content-Range"] = f"bytes {start}-{end}/{total_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return Response(
+            read_file_range(path, start, end),
+            status=status,
+            content_type="video/mp4",
+            headers=headers,
+        )
 
-    async def progress(self):
-        logging.getLogger("hypercorn.access").setLevel(logging.WARNING)
-        data = await request.get_json()
+    async def serve_session(self, session_name):
+        """The manifest of a segmented recording session."""
+        manifest_path = f"{self.meta_data_dir}/{session_name}_session.json"
+        if os.path.basename(session_name) != session_name or not os.path.isfile(
+            manifest_path
+        ):
+            return Response("Not Found", status=404)
+        return await send_from_directory(
+            self.meta_data_dir, f"{session_name}_session.json"
+        )
 
-        if self.msg_recorder:
-            msg_file_name = data["video_filename"]
-            if msg_file_name.endswith(".mp4"):
-                msg_file_name = msg_file_name[:-4]
-
-            if self.msg_recorder.replaying_file_name != msg_file_name:
-                if self.msg_recorder.replaying_file_name != "":
-                    self.msg_recorder.stop_replay()
-                if self.msg_recorder.find_replay_file(msg_file_name):
-                    self.msg_recorder.start_replay(msg_file_name)
-            self.msg_recorder.update_local_time = time.monotonic()
-            self.msg_recorder.browser_global_timestamp = data["client_timestamp"]
-            self.msg_recorder.video_replay_timestamp = data["video_timestamp"]
-            self.msg_recorder.video_is_playing = data["is_playing"]
-            print(
-                f"{data['client_timestamp']:.3f}, {data['video_timestamp']:.3f}, {data['is_playing']}"
+    def load_video_meta(self, file_name: str) -> Dict[str, Any]:
+        """Metadata of a recording, empty if it has none. Parsed again only when the
+        file changes."""
+        meta_path = f"{self.meta_data_dir}/{file_name}_video.json"
+        try:
+            stat = os.stat(meta_path)
+        except OSError:
+            return {}
+        version = (stat.st_mtime_ns, stat.st_size)
+        entry = self.video_meta_cache.get(meta_path)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            meta = {}
+        self.video_meta_cache[meta_path] = (version, meta)
+        return meta
+
+    def load_msg_time_offset(self, file_name: str) -> float:
+        """Message log time at video time 0 of a recording, 0 for recordings made
+        before it was stored."""
+        return self.load_video_meta(file_name).get("msg_time_offset", 0.0)
+
+    async def switch_replay(self, video_file_name: str):
+        """Replays the messages recorded along with `video_file_name`, aligned to
+        that camera's video."""
+        msg_file_name = parse_camera_file_name(video_file_name)[0]
+        if (
+            self.replay_video_file_name == video_file_name
+            and self.msg_recorder.replaying_file_name == msg_file_name
+        ):
+            return
+        self.replay_video_file_name = video_file_name
+        time_offset = self.load_msg_time_offset(video_file_name)
+        if self.msg_recorder.replaying_file_name == msg_file_name:
+            # Another camera of the same recording: same messages, its own offset
+            self.msg_recorder.replay_time_offset = time_offset
+            return
+        await self.msg_recorder.switch_replay(msg_file_name, time_offset=time_offset)
+
+    def prefetch_next_segment(self, msg_file_name: str):
+        """Loads the message log of the segment after `msg_file_name`, so replay
+        continues without a pause when the player moves on to it."""
+        segment = parse_segment_file_name(msg_file_name)
+        if segment is None or self.msg_recorder is None:
+            return
+        if self.prefetch_task is None or self.prefetch_task.done():
+            self.prefetch_task = asyncio.create_task(
+                self.msg_recorder.prefetch([segment_file_name(segment[0], segment[1] + 1)])
             )
 
+    async def progress(self):
+        """Polling alternative to the playback events on /ws, for other clients."""
+        data = await request.get_json()
+        await self.apply_playback_state(data)
         self.client_ip = request.remote_addr
         return jsonify({"status": "success"})
 
@@ -325,8 +717,8 @@ class WebServer:
         self.app.run(host="0.0.0.0", port=5000, use_reloader=False)
 
     def __del__(self):
-        if self.cap.isOpened():
-            self.cap.release()
+        for camera in self.cameras:
+            camera.capture.release()
         if self.msg_recorder:
             self.msg_recorder.stop_receive()
             self.msg_recorder.stop_replay()
@@ -0,0 +1,74 @@
+"""Measures encode throughput and CPU usage of each encoder backend on synthetic frames.
+
+Usage: python tests/benchmark_encoders.py [--backends pyav gst_x264 ...] [--width W]
+       [--height H] [--frame-num N] [--frame-rate FPS]
+
+CPU% is process CPU time over wall time, so 100% is one full core. Backends that
+cannot be created on this machine are skipped.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from encoder_backends import ENCODER_BACKENDS, make_encoder_backend
+
+
+def make_frames(width: int, height: int, frame_num: int):
+    """A moving gradient with some noise, so the encoder has real work to do."""
+    rng = np.random.default_rng(0)
+    x = np.arange(width, dtype=np.uint16)[None, :]
+    y = np.arange(height, dtype=np.uint16)[:, None]
+    noise = rng.integers(0, 16, (height, width, 3), dtype=np.uint8)
+    frames = []
+    for i in range(min(frame_num, 60)):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[..., 0] = (x + 4 * i) % 256
+        frame[..., 1] = (y + 2 * i) % 256
+        frame[..., 2] = (x + y + i) % 256
+        frames.append(frame + noise)
+    return frames
+
+
+def benchmark(backend_name: str, args, frames, output_dir: str):
+    output_path = f"{output_dir}/{backend_name}.mp4"
+    try:
+        encoder = make_encoder_backend(backend_name)
+        encoder.open(output_path, args.width, args.height, args.frame_rate)
+    except Exception as e:
+        print(f"{backend_name:>12}: unavailable ({e!r})")
+        return
+    start_time = time.monotonic()
+    start_cpu_time = time.process_time()
+    for i in range(args.frame_num):
+        encoder.encode(frames[i % len(frames)], start_time + i / args.frame_rate)
+    encoder.close()
+    elapsed = time.monotonic() - start_time
+    cpu_time = time.process_time() - start_cpu_time
+    print(
+        f"{backend_name:>12}: {args.frame_num / elapsed:7.1f} fps, "
+        f"CPU {cpu_time / elapsed * 100:6.1f}%, "
+        f"{os.path.getsize(output_path) / 1024 / 1024:6.1f} MB"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", nargs="+", default=list(ENCODER_BACKENDS))
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--frame-num", type=int, default=300)
+    parser.add_argument("--frame-rate", type=float, default=30)
+    args = parser.parse_args()
+
+    frames = make_frames(args.width, args.height, args.frame_num)
+    print(f"Encoding {args.frame_num} frames of {args.width}x{args.height}")
+    with tempfile.TemporaryDirectory() as output_dir:
+        for backend_name in args.backends:
+            benchmark(backend_name, args, frames, output_dir)
@@ -0,0 +1,92 @@
+"""Measures sustained MsgRecorder receive throughput against a local PUB socket.
+
+Usage: python tests/benchmark_receive.py [--msg-num N] [--msg-size BYTES] [--parts K]
+"""
+
+import argparse
+import asyncio
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import zmq
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from msg_log import MsgLog
+from msg_recorder import MsgRecorder
+
+
+publish_start_time = [0.0]
+
+
+def publish(port: int, msg_num: int, msg_size: int, parts: int, ready: threading.Event):
+    context = zmq.Context()
+    pub_socket = context.socket(zmq.PUB)
+    pub_socket.setsockopt(zmq.SNDHWM, 0)
+    pub_socket.bind(f"tcp://127.0.0.1:{port}")
+    ready.wait()
+    time.sleep(0.5)  # Let the subscription propagate
+    payload = b"x" * msg_size
+    publish_start_time[0] = time.monotonic()
+    for _ in range(msg_num):
+        if parts > 1:
+            pub_socket.send_multipart([payload] * parts)
+        else:
+            pub_socket.send(payload)
+    pub_socket.close(linger=-1)
+    context.term()
+
+
+async def benchmark(args):
+    with tempfile.TemporaryDirectory() as data_dir:
+        recorder = MsgRecorder(
+            "127.0.0.1",
+            args.port,
+            data_dir=data_dir,
+            zero_copy_receive=args.zero_copy,
+        )
+        ready = threading.Event()
+        publisher = threading.Thread(
+            target=publish,
+            args=(args.port, args.msg_num, args.msg_size, args.parts, ready),
+        )
+        publisher.start()
+        recorder.start_receive("benchmark")
+        await asyncio.sleep(0.1)
+        ready.set()
+
+        last_msg_num, last_progress_time = 0, time.monotonic()
+        while recorder.received_msg_num < args.msg_num:
+            await asyncio.sleep(0.01)
+            now = time.monotonic()
+            if recorder.received_msg_num != last_msg_num:
+                last_msg_num, last_progress_time = recorder.received_msg_num, now
+            elif not publisher.is_alive() and now - last_progress_time > 2.0:
+                break  # The rest was dropped at the HWM
+        elapsed = last_progress_time - publish_start_time[0]
+        received_msg_num = recorder.received_msg_num
+        publisher.join()
+
+        recorder.stop_receive()
+        await asyncio.sleep(0)
+        while not Path(f"{data_dir}/messages/benchmark.mlog").exists():
+            await asyncio.sleep(0.1)
+        msg_log = MsgLog(f"{data_dir}/messages/benchmark.mlog")
+        print()
+        print(
+            f"Received {received_msg_num}/{args.msg_num} msgs of {args.parts}x{args.msg_size} bytes "
+            f"in {elapsed:.2f} s: {received_msg_num / max(elapsed, 1e-9):.0f} msgs/s, "
+            f"{len(msg_log)} frames saved"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=18800)
+    parser.add_argument("--msg-num", type=int, default=200000)
+    parser.add_argument("--msg-size", type=int, default=256)
+    parser.add_argument("--parts", type=int, default=1)
+    parser.add_argument("--zero-copy", action="store_true")
+    asyncio.run(benchmark(parser.parse_args()))
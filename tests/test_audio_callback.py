@@ -0,0 +1,131 @@
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+from scipy.io.wavfile import read
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from audio_recorder import AudioRecorder, AudioRingBuffer, AudioSegmentWriter
+
+
+class FakeInputStream:
+    """Stands in for `sd.InputStream` in callback mode: a thread calls the callback
+    with a deterministic ramp signal at the nominal block rate."""
+
+    clock_offset = 1000.0
+
+    def __init__(self, samplerate, channels, dtype, device, blocksize, callback):
+        self.sample_rate = samplerate
+        self.channels = channels
+        self.blocksize = blocksize
+        self.callback = callback
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.produced_frame_num = 0
+
+    @property
+    def time(self):
+        return time.monotonic() - self.clock_offset
+
+    def run(self):
+        status = SimpleNamespace(input_overflow=False, input_underflow=False)
+        while not self.stop_event.is_set():
+            start = self.produced_frame_num
+            indata = (
+                np.arange(start, start + self.blocksize, dtype=np.float32)[:, None]
+                .repeat(self.channels, axis=1)
+                / 1e6
+            )
+            time_info = SimpleNamespace(inputBufferAdcTime=self.time)
+            self.callback(indata, self.blocksize, time_info, status)
+            self.produced_frame_num += self.blocksize
+            time.sleep(self.blocksize / self.sample_rate)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop_event.set()
+        self.thread.join()
+
+
+def test_ring_buffer_drops_when_full():
+    ring = AudioRingBuffer(slot_num=2, chunk_size=4, channels=1)
+    chunk = np.ones((4, 1), dtype=np.float32)
+    assert ring.push(chunk, 0.0)
+    assert ring.push(chunk, 1.0)
+    assert not ring.push(chunk, 2.0)
+    data, adc_time = ring.peek()
+    assert adc_time == 0.0 and data.shape == (4, 1)
+    ring.release()
+    assert ring.push(chunk, 3.0)
+    assert len(ring) == 2
+
+
+def test_callback_recording_with_fake_stream(tmp_path):
+    recorder = AudioRecorder(
+        sample_rate=16000,
+        channels=2,
+        chunk_size=256,
+        data_dir=str(tmp_path),
+        capture_mode="callback",
+        input_stream_factory=FakeInputStream,
+    )
+    recorder.file_name = "fake"
+    record_thread = threading.Thread(target=recorder.record)
+    record_thread.start()
+    time.sleep(0.5)
+    recorder.stop_event.set()
+    record_thread.join()
+
+    _, data = read(f"{tmp_path}/audios/fake.wav")
+    assert data.shape[1] == 2 and len(data) > 0
+    # No chunk is lost or reordered between the callback and the file
+    np.testing.assert_allclose(
+        data[:, 0], np.arange(len(data), dtype=np.float32) / 1e6, rtol=1e-6
+    )
+
+    with open(f"{tmp_path}/meta_data/fake_audio.json") as f:
+        meta_data = json.load(f)
+    assert meta_data["recorded_frame_num"] == len(data)
+    assert meta_data["ring_overflow_num"] == 0
+    assert meta_data["input_overflow_num"] == 0
+
+    # ADC times are converted back to the monotonic clock
+    timestamps = np.load(f"{tmp_path}/meta_data/fake_audio_timestamps.npy")
+    assert timestamps[0, 0] == 0
+    assert abs(timestamps[0, 1] - meta_data["first_sample_monotonic_time"]) < 1e-9
+    assert abs(timestamps[0, 1] - time.monotonic()) < 5.0
+    assert np.all(np.diff(timestamps[:, 1]) > 0)
+
+
+def test_segment_rollover_splits_at_boundary(tmp_path):
+    (tmp_path / "audios").mkdir()
+    (tmp_path / "meta_data").mkdir()
+    sample_rate, chunk_size = 1000, 100
+    segment_writer = AudioSegmentWriter(
+        str(tmp_path / "audios"), str(tmp_path / "meta_data"), sample_rate, 1, "callback"
+    )
+    segment_writer.open("seg_s000", time.time())
+    start_time = 100.0
+    # Boundary falls on sample 250, in the middle of the third chunk
+    segment_writer.request_rollover("seg_s001", start_time + 0.25)
+    for i in range(5):
+        chunk = np.arange(i * chunk_size, (i + 1) * chunk_size, dtype=np.float32)
+        segment_writer.write(chunk[:, None] / 1e6, start_time + i * chunk_size / sample_rate)
+    segment_writer.close(time.time())
+
+    _, first = read(f"{tmp_path}/audios/seg_s000.wav")
+    _, second = read(f"{tmp_path}/audios/seg_s001.wav")
+    assert len(first) == 250 and len(second) == 250
+    np.testing.assert_allclose(
+        np.concatenate([first, second]), np.arange(500, dtype=np.float32) / 1e6, rtol=1e-6
+    )
+    with open(f"{tmp_path}/meta_data/seg_s001_audio.json") as f:
+        meta_data = json.load(f)
+    assert abs(meta_data["first_sample_monotonic_time"] - (start_time + 0.25)) < 1e-9
@@ -0,0 +1,25 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from clock_sync import ClockSync
+
+
+def test_offset_from_symmetric_round_trips():
+    clock_sync = ClockSync()
+    client_offset = 1234.5
+    # Round trips of 10 ms, with the client answering half way
+    for send_time in (0.0, 0.5, 1.0):
+        clock_sync.add_sample(send_time, send_time + 0.005 + client_offset, send_time + 0.01)
+    assert abs(clock_sync.offset - client_offset) < 1e-9
+    assert abs(clock_sync.rtt - 0.01) < 1e-9
+    assert abs(clock_sync.to_local(client_offset + 2.0) - 2.0) < 1e-9
+
+
+def test_prefers_fastest_round_trip():
+    clock_sync = ClockSync()
+    # A ping stuck in a queue on the way back skews its estimate by half its delay
+    clock_sync.add_sample(0.0, 100.005, 0.2)
+    clock_sync.add_sample(1.0, 101.005, 1.01)
+    assert abs(clock_sync.offset - 100.0) < 1e-9
+    assert clock_sync.is_synced
@@ -0,0 +1,83 @@
+import multiprocessing as mp
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from frame_bus import FrameBus
+
+
+def write_frame(bus: FrameBus, value: int, timestamp: float, shape=(4, 6, 3)) -> int:
+    slot = bus.begin_write(shape)
+    slot[...] = value
+    return bus.end_write(shape, timestamp)
+
+
+@pytest.fixture
+def bus():
+    bus = FrameBus((4, 6, 3), ring_size=4)
+    yield bus
+    bus.close()
+    bus.unlink()
+
+
+def test_write_and_read(bus):
+    assert bus.latest_seq == -1
+    assert bus.get_latest() is None
+    seq = write_frame(bus, 7, 1.5)
+    assert seq == 0
+    captured = bus.get_frame(0)
+    assert captured.timestamp == 1.5
+    assert captured.frame.shape == (4, 6, 3)
+    assert np.all(captured.frame == 7)
+    copied = bus.read_frame(0)
+    assert not np.shares_memory(copied.frame, captured.frame)
+    assert np.all(copied.frame == 7)
+
+
+def test_smaller_frames_fit(bus):
+    write_frame(bus, 3, 0.0, shape=(2, 3, 3))
+    assert bus.get_latest().frame.shape == (2, 3, 3)
+    with pytest.raises(AssertionError):
+        bus.begin_write((8, 6, 3))
+
+
+def test_overwritten_frames_are_gone(bus):
+    for i in range(6):
+        write_frame(bus, i, float(i))
+    # Ring of 4: frames 0 and 1 were overwritten by 4 and 5
+    assert bus.get_frame(1) is None
+    assert not bus.is_intact(1)
+    assert bus.get_frame(2).timestamp == 2.0
+    assert np.all(bus.get_frame(5).frame == 5)
+
+
+def test_torn_read_is_detected(bus):
+    write_frame(bus, 1, 0.0)
+    captured = bus.get_frame(0)
+    for i in range(3):
+        write_frame(bus, 2 + i, float(i + 1))
+    # The writer starts filling the slot of frame 0 while it is being read
+    slot = bus.begin_write((4, 6, 3))
+    slot[0] = 99
+    assert not bus.is_intact(captured.seq)
+    assert bus.read_frame(0) is None
+    bus.end_write((4, 6, 3), 4.0)
+    assert bus.get_frame(4).timestamp == 4.0
+
+
+def read_in_child(bus: FrameBus, result_queue):
+    captured = bus.wait_for_frame(-1, timeout=5.0)
+    result_queue.put((captured.seq, captured.timestamp, int(captured.frame.sum())))
+
+
+def test_read_from_forked_process(bus):
+    ctx = mp.get_context("fork")
+    result_queue = ctx.Queue()
+    process = ctx.Process(target=read_in_child, args=(bus, result_queue))
+    process.start()
+    write_frame(bus, 1, 2.5)
+    assert result_queue.get(timeout=5.0) == (0, 2.5, 4 * 6 * 3)
+    process.join()
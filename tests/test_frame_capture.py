@@ -0,0 +1,53 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from frame_capture import FrameCapture
+
+
+class FakeVideoCapture:
+    """Delivers `frame_num` frames filled with their seq, then stops `capture`."""
+
+    def __init__(self, capture: FrameCapture, frame_num: int):
+        self.capture = capture
+        self.frame_num = frame_num
+        self.read_num = 0
+        self.overwritten_seqs = []
+        """Per read, the frame the slot held and whether it was still handed out."""
+
+    def read(self, slot):
+        seq = self.read_num
+        old_seq = seq - self.capture.ring_size
+        if old_seq >= 0:
+            self.overwritten_seqs.append(
+                (
+                    self.capture.get_frame(old_seq) is not None,
+                    self.capture.is_intact(old_seq),
+                )
+            )
+        slot[...] = seq
+        self.read_num += 1
+        if self.read_num >= self.frame_num:
+            self.capture.stop_event.set()
+        return True, slot
+
+    def isOpened(self):
+        return True
+
+
+def test_slot_is_invalidated_before_it_is_overwritten():
+    capture = FrameCapture(resolution=(6, 4), ring_size=4)
+    capture.cap = FakeVideoCapture(capture, frame_num=10)
+    capture.run()
+
+    assert capture.latest_seq == 9
+    # Frames 0 to 5 were gone as soon as their slot started to be refilled
+    assert capture.cap.overwritten_seqs == [(False, False)] * 6
+    assert capture.get_frame(5) is None
+    assert not capture.is_intact(5)
+    copied = capture.read_frame(9)
+    assert copied.timestamp == capture.get_frame(9).timestamp
+    assert np.all(copied.frame == 9)
+    assert not np.shares_memory(copied.frame, capture.frames)
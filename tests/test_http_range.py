@@ -0,0 +1,100 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from http_range import (
+    RangeNotSatisfiable,
+    file_etag,
+    http_date,
+    if_range_matches,
+    is_not_modified,
+    parse_range_header,
+    read_file_range,
+)
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=100-", (100, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=-5000", (0, 999)),
+        ("bytes=500-5000", (500, 999)),
+        ("bytes=5-1", None),
+        ("bytes=0-1,5-6", None),
+        ("items=0-1", None),
+        ("bytes=abc", None),
+    ],
+)
+def test_parse_range_header(header, expected):
+    assert parse_range_header(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=2000-3000", "bytes=-0"])
+def test_unsatisfiable_range(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range_header(header, 1000)
+
+
+def test_conditional_requests(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"x" * 100)
+    stat = os.stat(path)
+    etag = file_etag(stat)
+
+    assert is_not_modified(etag, None, etag, stat.st_mtime)
+    assert is_not_modified(f'"other", W/{etag}', None, etag, stat.st_mtime)
+    assert not is_not_modified('"other"', None, etag, stat.st_mtime)
+    assert is_not_modified(None, http_date(stat.st_mtime), etag, stat.st_mtime)
+    assert not is_not_modified(None, http_date(stat.st_mtime - 10), etag, stat.st_mtime)
+
+    assert if_range_matches(None, etag, stat.st_mtime)
+    assert if_range_matches(etag, etag, stat.st_mtime)
+    assert not if_range_matches(f"W/{etag}", etag, stat.st_mtime)
+
+
+def test_read_file_range(tmp_path):
+    path = tmp_path / "video.mp4"
+    data = os.urandom(10000)
+    path.write_bytes(data)
+
+    async def read(start, end):
+        return b"".join(
+            [chunk async for chunk in read_file_range(str(path), start, end, 1024)]
+        )
+
+    assert asyncio.run(read(0, 9999)) == data
+    assert asyncio.run(read(1000, 4500)) == data[1000:4501]
+
+
+def test_follow_growing_file(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"a" * 100)
+    writing = [True]
+
+    async def grow():
+        await asyncio.sleep(0.05)
+        with open(path, "ab") as f:
+            f.write(b"b" * 100)
+        await asyncio.sleep(0.05)
+        with open(path, "ab") as f:
+            f.write(b"c" * 100)
+        writing[0] = False
+
+    async def read():
+        grow_task = asyncio.create_task(grow())
+        chunks = [
+            chunk
+            async for chunk in read_file_range(
+                str(path), 0, None, follow=lambda: writing[0], poll_interval=0.01
+            )
+        ]
+        await grow_task
+        return b"".join(chunks)
+
+    assert asyncio.run(read()) == b"a" * 100 + b"b" * 100 + b"c" * 100
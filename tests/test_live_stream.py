@@ -0,0 +1,50 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from live_stream import LiveViewer, h264_codec_string
+
+
+class FakeHub:
+    def __init__(self):
+        self.keyframe_request_num = 0
+
+    def request_keyframe(self):
+        self.keyframe_request_num += 1
+
+
+def test_codec_string_from_sps():
+    sps = b"\x00\x00\x00\x01\x67\x42\xc0\x1f\xda\x01"
+    pps = b"\x00\x00\x00\x01\x68\xce\x3c\x80"
+    assert h264_codec_string(sps + pps) == "avc1.42C01F"
+    assert h264_codec_string(pps + sps) == "avc1.42C01F"
+    assert h264_codec_string(pps) is None
+
+
+def test_viewer_starts_at_keyframe_and_skips_ahead_when_behind():
+    hub = FakeHub()
+    viewer = LiveViewer(hub, "viewer", asyncio.new_event_loop(), max_queue_size=4)
+    viewer.push(b"delta", False, "config")
+    assert viewer.queue.empty()
+
+    viewer.push(b"key", True, "config")
+    viewer.push(b"delta1", False, "config")
+    viewer.push(b"delta2", False, "config")
+    assert [viewer.queue.get_nowait() for _ in range(3)] == [
+        "config",
+        b"key",
+        b"delta1",
+    ]
+
+    # The viewer stops draining: once its queue is full the backlog is dropped
+    for i in range(4):
+        viewer.push(b"delta", False, "config")
+    assert viewer.queue.empty()
+    assert viewer.waiting_for_keyframe
+    assert hub.keyframe_request_num == 1
+    assert viewer.dropped_chunk_num == 4
+
+    viewer.push(b"delta", False, "config")
+    viewer.push(b"key", True, "config")
+    assert [viewer.queue.get_nowait() for _ in range(2)] == ["config", b"key"]
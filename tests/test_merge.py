@@ -1,59 +1,57 @@
-import time
-import ffmpeg
-import subprocess
-
-
-def sync_audio_video(video_file, audio_file, output_file):
-    command = [
-        "ffmpeg",
-        "-i",
-        video_file,
-        "-i",
-        audio_file,
-        "-c:v",
-        "copy",
-        "-c:a",
-        "aac",
-        "-strict",
-        "experimental",
-        "-map",
-        "0:v:0",
-        "-map",
-        "1:a:0",
-        output_file,
-    ]
-    subprocess.run(command)
-
-
-video_file = "recordings/raw_videos/20231230_223915.mp4"
-audio_file = "recordings/audios/20231230_223915.wav"
-video_file_with_start_time = "recordings/raw_videos/20231230_223915_new.mp4"
-audio_file = "recordings/audios/20231230_223915.wav"
-audio_file_with_start_time = "recordings/audios/20231230_223915_new.wav"
-output_file = "recordings/videos/20231230_223915.mp4"
-
-# Get current time in seconds since the Epoch
-current_time_seconds = time.time()
-delayed_time_seconds = current_time_seconds - 5
-
-# Convert to a struct_time in local time
-local_time = time.localtime(current_time_seconds)
-# Format the time with milliseconds
-formatted_time = time.strftime("%Y-%m-%d %H:%M:%S", local_time) + ".{:03d}".format(
-    int((current_time_seconds % 1) * 1000)
-)
-
-delayed_formatted_time = time.strftime(
-    "%Y-%m-%d %H:%M:%S", time.localtime(delayed_time_seconds)
-) + ".{:03d}".format(int((delayed_time_seconds % 1) * 1000))
-
-ffmpeg.input(video_file).output(
-    video_file_with_start_time, metadata=f"creation_time={formatted_time}"
-).run()
-
-ffmpeg.input(audio_file).output(
-    audio_file_with_start_time, metadata=f"creation_time={delayed_formatted_time}"
-).run()
-
-
-sync_audio_video(video_file_with_start_time, audio_file_with_start_time, output_file)
+import sys
+from pathlib import Path
+
+import av
+import numpy as np
+from scipy.io import wavfile
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from av_muxer import mux_audio_video
+from video_encoder import VideoEncoderWorker
+
+FRAME_RATE = 30
+FRAME_NUM = 90
+SAMPLE_RATE = 48000
+
+
+def record_video(file_path: str, fragmented: bool):
+    worker = VideoEncoderWorker(backpressure="block", fragmented=fragmented)
+    worker.start(file_path, 64, 48, FRAME_RATE)
+    for i in range(FRAME_NUM):
+        frame = np.full((48, 64, 3), i * 2, dtype=np.uint8)
+        worker.submit(frame, 100.0 + i / FRAME_RATE)
+    worker.stop()
+
+
+def stream_start(stream) -> float:
+    return float(stream.start_time * stream.time_base)
+
+
+def check_merge(tmp_path, fragmented: bool):
+    video_path = str(tmp_path / "video.mp4")
+    audio_path = str(tmp_path / "audio.wav")
+    output_path = str(tmp_path / "merged.mp4")
+    record_video(video_path, fragmented)
+    t = np.arange(SAMPLE_RATE * FRAME_NUM // FRAME_RATE) / SAMPLE_RATE
+    samples = (np.sin(2 * np.pi * 440 * t) * 10000).astype(np.int16)
+    wavfile.write(audio_path, SAMPLE_RATE, samples)
+
+    mux_audio_video(video_path, audio_path, output_path)
+
+    with av.open(output_path) as merged:
+        assert len(merged.streams.video) == 1
+        assert len(merged.streams.audio) == 1
+        video, audio = merged.streams.video[0], merged.streams.audio[0]
+        # Audio starts with the first video frame, give or take the AAC priming
+        assert abs(stream_start(audio) - stream_start(video)) < 1 / FRAME_RATE
+        audio_duration = float(audio.duration * audio.time_base)
+        assert abs(audio_duration - FRAME_NUM / FRAME_RATE) < 0.1
+        assert abs(merged.duration / av.time_base - FRAME_NUM / FRAME_RATE) < 0.2
+
+
+def test_merge(tmp_path):
+    check_merge(tmp_path, fragmented=False)
+
+
+def test_merge_fragmented(tmp_path):
+    check_merge(tmp_path, fragmented=True)
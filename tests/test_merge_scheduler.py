@@ -0,0 +1,78 @@
+import sys
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+import merge_scheduler
+from merge_scheduler import MergeScheduler
+
+
+class FakeExecutor:
+    """Keeps the submitted jobs and their futures instead of running them."""
+
+    def __init__(self, max_workers=1, mp_context=None, broken=False):
+        self.broken = broken
+        self.submitted = []
+        self.is_shutdown = False
+
+    def submit(self, fn, job):
+        if self.broken:
+            raise BrokenProcessPool("A process in the pool was terminated abruptly")
+        future = Future()
+        self.submitted.append((job, future))
+        return future
+
+    def shutdown(self, wait=True):
+        self.is_shutdown = True
+
+
+@pytest.fixture
+def scheduler(tmp_path, monkeypatch):
+    monkeypatch.setattr(merge_scheduler, "ProcessPoolExecutor", FakeExecutor)
+    return MergeScheduler(str(tmp_path / "merge_jobs.json"))
+
+
+def submit_job(scheduler):
+    return scheduler.submit("rec", "raw.mp4", "a.wav", "v.json", "a.json", "out.mp4")
+
+
+def test_job_is_requeued_when_the_worker_dies(scheduler):
+    job_id = submit_job(scheduler)["job_id"]
+    broken_executor = scheduler.executor
+    broken_executor.submitted[0][1].set_exception(BrokenProcessPool("worker died"))
+
+    # Requeued on a new pool
+    assert broken_executor.is_shutdown
+    assert scheduler.executor is not broken_executor
+    assert scheduler.jobs[job_id]["state"] == "running"
+    scheduler.executor.submitted[0][1].set_result(1234)
+
+    job = scheduler.jobs[job_id]
+    assert job["state"] == "done"
+    assert job["attempts"] == 2
+    assert job["output_size"] == 1234
+    assert scheduler.running_job_num == 0
+
+
+def test_job_fails_after_max_attempts(scheduler):
+    job_id = submit_job(scheduler)["job_id"]
+    for _ in range(scheduler.max_attempts):
+        scheduler.executor.submitted[0][1].set_exception(BrokenProcessPool("died"))
+
+    assert scheduler.jobs[job_id]["state"] == "failed"
+    assert "BrokenProcessPool" in scheduler.jobs[job_id]["error"]
+    assert scheduler.running_job_num == 0
+
+
+def test_broken_pool_is_replaced_on_submit(scheduler):
+    broken_executor = FakeExecutor(broken=True)
+    scheduler.executor = broken_executor
+    job_id = submit_job(scheduler)["job_id"]
+
+    assert broken_executor.is_shutdown
+    assert scheduler.jobs[job_id]["state"] == "running"
+    assert scheduler.running_job_num == 1
+    assert len(scheduler.executor.submitted) == 1
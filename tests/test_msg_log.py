@@ -0,0 +1,130 @@
+import pickle
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from msg_log import (
+    MsgJournalWriter,
+    MsgLog,
+    MsgLogCache,
+    convert_journal_to_msg_log,
+    convert_pkl_to_msg_log,
+    open_msg_log,
+    write_msg_log,
+)
+
+
+def test_round_trip_sorts_by_timestamp(tmp_path):
+    file_path = str(tmp_path / "test.mlog")
+    write_msg_log(file_path, [0.2, 0.1, 0.3], [b"b", b"a", b"ccc"])
+
+    msg_log = MsgLog(file_path)
+    assert len(msg_log) == 3
+    np.testing.assert_array_equal(msg_log.timestamps, [0.1, 0.2, 0.3])
+    assert [bytes(msg_log[i]) for i in range(3)] == [b"a", b"b", b"ccc"]
+
+
+def test_empty_payloads(tmp_path):
+    file_path = str(tmp_path / "test.mlog")
+    write_msg_log(file_path, [0.0, 1.0], [b"", b"x"])
+
+    msg_log = MsgLog(file_path)
+    assert bytes(msg_log[0]) == b""
+    assert bytes(msg_log[1]) == b"x"
+
+
+def test_convert_legacy_pickle(tmp_path):
+    msgs = [(float(i) / 10, f"msg{i}".encode()) for i in range(100)]
+    pkl_path = str(tmp_path / "legacy.pkl")
+    with open(pkl_path, "wb") as f:
+        pickle.dump(msgs, f)
+
+    legacy_log = open_msg_log(pkl_path)
+    mlog_path = convert_pkl_to_msg_log(pkl_path)
+    assert mlog_path.endswith("legacy.mlog")
+    msg_log = open_msg_log(mlog_path)
+    np.testing.assert_array_equal(msg_log.timestamps, legacy_log.timestamps)
+    assert [bytes(msg_log[i]) for i in range(len(msgs))] == [m for _, m in msgs]
+
+
+def test_journal_recovery_truncates_torn_record(tmp_path):
+    journal_path = str(tmp_path / "test.mjournal")
+    writer = MsgJournalWriter(journal_path)
+    for i in range(10):
+        writer.append(i * 0.1, f"msg{i}".encode())
+    writer.close()
+    # Simulates a crash in the middle of writing the last record
+    with open(journal_path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 2)
+
+    assert convert_journal_to_msg_log(journal_path) == 9
+    assert not Path(journal_path).exists()
+    msg_log = MsgLog(str(tmp_path / "test.mlog"))
+    expected = [f"msg{i}".encode() for i in range(9)]
+    assert [bytes(msg_log[i]) for i in range(9)] == expected
+
+
+def test_journal_appends_to_existing_log(tmp_path):
+    write_msg_log(str(tmp_path / "test.mlog"), [0.0, 0.1], [b"a", b"b"])
+    writer = MsgJournalWriter(str(tmp_path / "test.mjournal"))
+    writer.append(0.2, b"c")
+    writer.close()
+
+    prev_msg_log = MsgLog(str(tmp_path / "test.mlog"))
+    convert_journal_to_msg_log(
+        str(tmp_path / "test.mjournal"), prev_msg_log=prev_msg_log
+    )
+    msg_log = MsgLog(str(tmp_path / "test.mlog"))
+    assert [bytes(msg_log[i]) for i in range(3)] == [b"a", b"b", b"c"]
+
+
+def test_seek_index_matches_searchsorted(tmp_path):
+    rng = np.random.default_rng(0)
+    timestamps = np.sort(rng.uniform(0, 30, 5000))
+    timestamps[100:110] = timestamps[100]  # Frames of one multipart message
+    file_path = str(tmp_path / "test.mlog")
+    write_msg_log(file_path, timestamps, [b"x"] * len(timestamps))
+    assert (tmp_path / "test.midx").exists()
+
+    msg_log = MsgLog(file_path)
+    assert msg_log.seek_index is not None
+    queries = np.concatenate([rng.uniform(-5, 35, 1000), timestamps[95:115], [0, 1]])
+    for query in queries:
+        for side in ("left", "right"):
+            expected = int(np.searchsorted(timestamps, query, side=side))
+            assert msg_log.find_index(query, side) == expected
+
+
+def test_old_seek_index_is_rebuilt(tmp_path):
+    file_path = str(tmp_path / "test.mlog")
+    write_msg_log(file_path, np.arange(10) * 0.5, [b"x"] * 10)
+    index_path = tmp_path / "test.midx"
+    index_path.write_bytes(b"MSGIDX01" + index_path.read_bytes()[8:])
+
+    msg_log = MsgLog(file_path)
+    assert msg_log.seek_index is not None
+    assert msg_log.find_index(2.0) == 4
+    assert index_path.read_bytes()[:8] == b"MSGIDX02"
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    file_paths = [str(tmp_path / f"{i}.mlog") for i in range(3)]
+    for file_path in file_paths:
+        write_msg_log(file_path, [0.0], [b"x" * 1000])
+    msg_log_size = MsgLog(file_paths[0]).nbytes
+    cache = MsgLogCache(memory_budget=2 * msg_log_size)
+
+    first = cache.get(file_paths[0])
+    cache.get(file_paths[1])
+    assert cache.get(file_paths[0]) is first
+    cache.get(file_paths[2])
+
+    assert cache.contains(file_paths[0])
+    assert not cache.contains(file_paths[1])
+    assert cache.nbytes == 2 * msg_log_size
+
+    # A rewritten log is reopened
+    write_msg_log(file_paths[0], [0.0, 1.0], [b"x", b"y"])
+    assert len(cache.get(file_paths[0])) == 2
@@ -0,0 +1,43 @@
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from msg_log import MsgJournalWriter, MsgLog, write_msg_log
+from msg_recorder import MsgRecorder
+
+
+def write_journal(file_path: str, payloads):
+    writer = MsgJournalWriter(file_path)
+    for i, payload in enumerate(payloads):
+        writer.append(i * 0.1, payload)
+    writer.close()
+
+
+def test_recovery_skips_journal_already_converted(tmp_path):
+    msg_dir = tmp_path / "messages"
+    msg_dir.mkdir()
+    journal_path = str(msg_dir / "rec.mjournal")
+    write_journal(journal_path, [b"a", b"b"])
+    # Crashed after the log was replaced but before the journal was removed
+    write_msg_log(str(msg_dir / "rec.mlog"), [0.0, 0.1], [b"a", b"b"])
+    os.utime(journal_path, (1000, 1000))
+
+    MsgRecorder("127.0.0.1", 18802, data_dir=str(tmp_path))
+
+    assert not os.path.exists(journal_path)
+    assert len(MsgLog(str(msg_dir / "rec.mlog"))) == 2
+
+
+def test_recovery_appends_newer_journal(tmp_path):
+    msg_dir = tmp_path / "messages"
+    msg_dir.mkdir()
+    write_msg_log(str(msg_dir / "rec.mlog"), [0.0], [b"a"])
+    os.utime(msg_dir / "rec.mlog", (1000, 1000))
+    os.utime(msg_dir / "rec.midx", (1000, 1000))
+    write_journal(str(msg_dir / "rec.mjournal"), [b"b", b"c"])
+
+    MsgRecorder("127.0.0.1", 18802, data_dir=str(tmp_path))
+
+    msg_log = MsgLog(str(msg_dir / "rec.mlog"))
+    assert [bytes(msg_log[i]) for i in range(len(msg_log))] == [b"a", b"b", b"c"]
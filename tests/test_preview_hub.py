@@ -0,0 +1,79 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from frame_capture import CapturedFrame
+from preview_hub import PREVIEW_LEVELS, PreviewClient, PreviewHub
+
+
+def send_frames(
+    client: PreviewClient,
+    start: float,
+    frame_num: int,
+    send_duration: float,
+    interval: float,
+) -> float:
+    now = start
+    for _ in range(frame_num):
+        now += interval
+        client.on_sent(10000, now - send_duration, now)
+        client.adapt(len(PREVIEW_LEVELS), now)
+    return now
+
+
+def test_slow_link_steps_down_and_recovers():
+    client = PreviewClient("viewer")
+    client.last_level_change_time = 0.0
+    # Every send blocks for the whole frame interval: the link is saturated
+    now = send_frames(client, 0.0, 90, send_duration=1 / 30, interval=1 / 30)
+    assert client.level >= 2
+    lowest_level = client.level
+    # Link recovered: sends return right away
+    send_frames(client, now, 30 * 20, send_duration=0.001, interval=1 / 30)
+    assert client.level < lowest_level
+
+
+def test_fast_link_stays_at_best_level():
+    client = PreviewClient("viewer")
+    client.last_level_change_time = 0.0
+    send_frames(client, 0.0, 300, send_duration=0.002, interval=1 / 30)
+    assert client.level == 0
+    assert abs(client.fps - 30) < 1
+    assert abs(client.bitrate - 30 * 10000 * 8) < 10000 * 8
+
+
+def test_fixed_level_when_not_adaptive():
+    client = PreviewClient("viewer", adaptive=False)
+    client.last_level_change_time = 0.0
+    send_frames(client, 0.0, 300, send_duration=1 / 30, interval=1 / 30)
+    assert client.level == 0
+
+
+class OverwritingCapture:
+    """Hands out frames 0 and 1; frame 0 is overwritten while it is being encoded."""
+
+    def __init__(self, hub_stop_event):
+        self.frame_rate = 30.0
+        self.hub_stop_event = hub_stop_event
+
+    def wait_for_frame(self, after_seq, timeout=None):
+        if after_seq >= 1:
+            self.hub_stop_event.set()
+            return None
+        seq = after_seq + 1
+        return CapturedFrame(seq, float(seq), np.full((8, 8, 3), seq, dtype=np.uint8))
+
+    def is_intact(self, seq):
+        return seq != 0
+
+
+def test_torn_frames_are_not_published():
+    hub = PreviewHub(None, adaptive=False)
+    hub.capture = OverwritingCapture(hub.stop_event)
+    hub.clients.append(PreviewClient("viewer", adaptive=False))
+    hub.run()
+
+    assert hub.encoded_frame_num == 1
+    assert hub.latest_parts[0][0] == 1
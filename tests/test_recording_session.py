@@ -0,0 +1,47 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from recording_session import (
+    SessionManifest,
+    camera_file_name,
+    parse_camera_file_name,
+    parse_segment_file_name,
+    segment_file_name,
+)
+
+
+def test_segment_file_names():
+    assert segment_file_name("20240101_120000", 7) == "20240101_120000_s007"
+    assert parse_segment_file_name("20240101_120000_s007") == ("20240101_120000", 7)
+    assert parse_segment_file_name("20240101_120000_s1234") == ("20240101_120000", 1234)
+    assert parse_segment_file_name("20240101_120000") is None
+
+
+def test_camera_file_names():
+    assert camera_file_name("20240101_120000_s007", 0) == "20240101_120000_s007"
+    assert camera_file_name("20240101_120000_s007", 2) == "20240101_120000_s007_cam2"
+    assert parse_camera_file_name("20240101_120000_s007_cam2") == (
+        "20240101_120000_s007",
+        2,
+    )
+    assert parse_camera_file_name("20240101_120000") == ("20240101_120000", 0)
+
+
+def test_manifest_timeline(tmp_path):
+    manifest_path = str(tmp_path / "session_session.json")
+    manifest = SessionManifest(manifest_path, "session")
+    manifest.add_segment("session_s000", 60.0, recorded_frame_num=1800)
+    manifest.add_segment("session_s001", 59.5, recorded_frame_num=1785)
+    manifest.add_segment("session_s002", 10.0, recorded_frame_num=300)
+    manifest.complete = True
+    manifest.save()
+
+    loaded = SessionManifest.load(manifest_path)
+    assert loaded.complete
+    assert [segment["offset"] for segment in loaded.segments] == [0.0, 60.0, 119.5]
+    assert loaded.duration == 129.5
+    assert loaded.find_segment(0.0)["file_name"] == "session_s000"
+    assert loaded.find_segment(60.0)["file_name"] == "session_s001"
+    assert loaded.find_segment(125.0)["file_name"] == "session_s002"
+    assert loaded.find_segment(1000.0)["file_name"] == "session_s002"
@@ -0,0 +1,158 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import zmq
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from msg_log import MSG_FLAG_MORE, InMemoryMsgLog
+from msg_recorder import MsgRecorder
+
+
+class FakePubSocket:
+    """Records when each message leaves the replay scheduler."""
+
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def send(self, data, flags=0, copy=True):
+        self.sent.append((time.monotonic(), bytes(data)))
+
+    def close(self):
+        self.closed = True
+
+
+class FullPubSocket(FakePubSocket):
+    """Refuses the message starting at every index in `full_at`, like an XPUB_NODROP
+    socket with a subscriber at the high-water mark."""
+
+    def __init__(self, full_at):
+        super().__init__()
+        self.full_at = set(full_at)
+        self.send_num = 0
+
+    def send(self, data, flags=0, copy=True):
+        self.send_num += 1
+        if self.send_num - 1 in self.full_at:
+            raise zmq.Again()
+        super().send(data, flags, copy)
+
+
+def make_recorder(tmp_path, timestamps):
+    recorder = MsgRecorder("127.0.0.1", 18801, data_dir=str(tmp_path))
+    recorder.replay_msgs = InMemoryMsgLog(
+        [(t, str(i).encode()) for i, t in enumerate(timestamps)]
+    )
+    fake_socket = FakePubSocket()
+
+    def open_pub_socket():
+        recorder.pub_socket = fake_socket
+        recorder.send_socket = fake_socket
+
+    recorder.open_pub_socket = open_pub_socket
+    return recorder, fake_socket
+
+
+MAX_LATENCY = 0.1
+"""Generous bound on how late a message may go out, so that a loaded machine does
+not fail the tests. The scheduler is meant to be well within a millisecond."""
+
+
+async def replay(recorder, duration, pause_at=None, playback_rate=1.0):
+    """Plays the log from t=0 and returns the monotonic times of t=0 and of the pause
+    (None without one)."""
+    replay_task = asyncio.create_task(recorder.run_replay())
+    await asyncio.sleep(0)
+    start_time = time.monotonic()
+    recorder.update_video_clock(
+        0.0, True, time.time(), local_time=start_time, playback_rate=playback_rate
+    )
+    pause_time = None
+    if pause_at is not None:
+        await asyncio.sleep(pause_at)
+        pause_time = time.monotonic()
+        recorder.update_video_clock(
+            pause_time - start_time, False, time.time(), local_time=pause_time
+        )
+        await asyncio.sleep(duration - pause_at)
+    else:
+        await asyncio.sleep(duration)
+    replay_task.cancel()
+    return start_time, pause_time
+
+
+def check_sent(fake_socket, start_time, video_timestamps):
+    """All messages went out in order, never early and not much late."""
+    assert len(fake_socket.sent) == len(video_timestamps)
+    sent_indices = [int(data) for _, data in fake_socket.sent]
+    assert sent_indices == list(range(len(video_timestamps)))
+    errors = np.array([t for t, _ in fake_socket.sent]) - start_time - video_timestamps
+    print(
+        f"Replay timing error: mean {np.mean(np.abs(errors)) * 1e3:.3f} ms, "
+        f"p99 {np.percentile(np.abs(errors), 99) * 1e3:.3f} ms"
+    )
+    assert np.all(errors >= -1e-4)
+    assert np.all(errors < MAX_LATENCY)
+
+
+def test_replay_timing_error(tmp_path):
+    rng = np.random.default_rng(0)
+    timestamps = np.cumsum(rng.uniform(0.001, 0.02, 100))
+    recorder, fake_socket = make_recorder(tmp_path, timestamps)
+
+    start_time, _ = asyncio.run(replay(recorder, timestamps[-1] + 2 * MAX_LATENCY))
+
+    check_sent(fake_socket, start_time, timestamps)
+
+
+def test_pause_stops_sending(tmp_path):
+    timestamps = np.arange(1, 51) * 0.01
+    recorder, fake_socket = make_recorder(tmp_path, timestamps)
+
+    start_time, pause_time = asyncio.run(replay(recorder, 0.5, pause_at=0.2))
+
+    # Only messages due before the pause went out, and nothing after it
+    sent_num = len(fake_socket.sent)
+    assert 0 < sent_num < len(timestamps)
+    assert [int(data) for _, data in fake_socket.sent] == list(range(sent_num))
+    assert all(t <= pause_time for t, _ in fake_socket.sent)
+    assert timestamps[sent_num - 1] <= pause_time - start_time + 1e-4
+
+
+def test_fast_forward_keeps_up(tmp_path):
+    # 20000 messages over 20 s of video, played at 16x
+    timestamps = np.arange(1, 20001) * 0.001
+    recorder, fake_socket = make_recorder(tmp_path, timestamps)
+
+    start_time, _ = asyncio.run(
+        replay(recorder, 1.25 + 2 * MAX_LATENCY, playback_rate=16.0)
+    )
+
+    check_sent(fake_socket, start_time, timestamps / 16)
+
+
+def test_time_offset_shifts_replay(tmp_path):
+    # The message log started 0.2 s before the first video frame
+    timestamps = 0.2 + np.arange(1, 21) * 0.01
+    recorder, fake_socket = make_recorder(tmp_path, timestamps)
+    recorder.replay_time_offset = 0.2
+
+    start_time, _ = asyncio.run(replay(recorder, 0.1 + 2 * MAX_LATENCY))
+
+    check_sent(fake_socket, start_time, timestamps - 0.2)
+
+
+def test_full_subscriber_drops_whole_messages(tmp_path):
+    recorder, _ = make_recorder(tmp_path, np.arange(6) * 0.01)
+    # Messages of two frames each: (0, 1), (2, 3), (4, 5)
+    recorder.replay_msgs.flags[[0, 2, 4]] = MSG_FLAG_MORE
+    full_socket = FullPubSocket(full_at=[2])
+    recorder.send_socket = full_socket
+
+    asyncio.run(recorder.send_replay_msgs(0, 6))
+
+    assert [int(data) for _, data in full_socket.sent] == [0, 1, 4, 5]
+    assert recorder.replay_dropped_msg_num == 1
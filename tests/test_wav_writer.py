@@ -0,0 +1,34 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+from scipy.io.wavfile import read
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from wav_writer import StreamingWavWriter
+
+
+def test_streaming_wav_matches_concatenated_chunks(tmp_path):
+    rng = np.random.default_rng(0)
+    chunks = [rng.uniform(-1, 1, (1024, 2)).astype(np.float32) for _ in range(20)]
+    file_path = str(tmp_path / "test.wav")
+    with StreamingWavWriter(file_path, 44100, 2) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+
+    sample_rate, data = read(file_path)
+    assert sample_rate == 44100
+    np.testing.assert_array_equal(data, np.concatenate(chunks))
+
+
+def test_header_is_valid_before_close(tmp_path):
+    file_path = str(tmp_path / "test.wav")
+    writer = StreamingWavWriter(file_path, 16000, 1, dtype=np.int16)
+    writer.write(np.arange(100, dtype=np.int16))
+    writer.update_header()
+
+    # Simulates a crash: the file is read while the writer is still open
+    sample_rate, data = read(file_path)
+    assert sample_rate == 16000
+    np.testing.assert_array_equal(data, np.arange(100, dtype=np.int16))
+    writer.close()